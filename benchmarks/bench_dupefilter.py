@@ -0,0 +1,69 @@
+"""
+Memory per million URLs and throughput of duplicate filters: Scrapy's
+default set of SHA1 hex fingerprints vs. ScalableBloomFilter at several
+false positive rates (measured false positive rates are printed too).
+
+Usage: python benchmarks/bench_dupefilter.py [number of urls]
+"""
+import hashlib
+import random
+import sys
+import timeit
+
+from scrapy_memex.utils.bloom import ScalableBloomFilter
+from scrapy_memex.utils.url import canonical_url_function
+
+
+def make_urls(n, prefix='', seed=0):
+    rnd = random.Random(seed)
+    for i in xrange(n):
+        yield 'http://www.%shost%d.example.com/page/%d.html?id=%d' % (
+            prefix, rnd.randint(0, 100000), i, rnd.randint(0, 1000))
+
+
+def set_size(fingerprints):
+    return sys.getsizeof(fingerprints) + sum(sys.getsizeof(fp)
+                                             for fp in fingerprints)
+
+
+def report(name, num_bytes, n, elapsed, fp_rate):
+    print '%-24s %12.1f %12.0f %12s' % (
+        name, num_bytes * 1000000.0 / n / 1024 / 1024, n / elapsed,
+        '-' if fp_rate is None else '%.2e' % fp_rate)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    canonicalize = canonical_url_function()
+    digests = [hashlib.md5(canonicalize(url)).digest()
+               for url in make_urls(n)]
+    unseen = [hashlib.md5(canonicalize(url)).digest()
+              for url in make_urls(min(n, 200000), prefix='new')]
+
+    print '%-24s %12s %12s %12s' % ('filter', 'MB / 1M urls', 'adds/s',
+                                    'fp rate')
+    fingerprints = set()
+    start = timeit.default_timer()
+    for digest in digests:
+        fingerprints.add(hashlib.sha1(digest).hexdigest())
+    report('set of sha1 hex', set_size(fingerprints), n,
+           timeit.default_timer() - start, None)
+    del fingerprints
+
+    for capacity in [n, n // 8]:
+        for error_rate in [1e-4, 1e-6, 1e-8]:
+            bloom = ScalableBloomFilter(capacity, error_rate)
+            start = timeit.default_timer()
+            for digest in digests:
+                bloom.add(digest)
+            elapsed = timeit.default_timer() - start
+            fp_rate = sum(d in bloom for d in unseen) / float(len(unseen))
+            report('bloom %.0e, %d filter%s' % (
+                error_rate, len(bloom.filters),
+                's' if len(bloom.filters) > 1 else ''),
+                bloom.num_bytes, n, elapsed, fp_rate)
+            bloom.close()
+
+
+if __name__ == '__main__':
+    main()
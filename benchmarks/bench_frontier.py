@@ -0,0 +1,167 @@
+"""
+Synthetic many-host workload for HostFrontier.
+
+1. Push and pop throughput (real time) and the number of requests kept in
+   memory.
+2. A simulated crawl (simulated time): the engine takes requests while
+   fewer than CONCURRENCY are in the downloader, like Scrapy does, and
+   every host is fetched one request at a time with its own download
+   delay (some hosts have long robots.txt crawl delays). Requests taken
+   from a FIFO queue wait in download slots of slow hosts and use up the
+   concurrency; the frontier only returns requests of ready hosts.
+
+Usage: python benchmarks/bench_frontier.py [number of requests]
+"""
+import collections
+import os
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+
+from scrapy_memex.utils.frontier import HostFrontier
+
+HOSTS = 20000
+CONCURRENCY = 64
+LATENCY = 0.3
+SIM_TIME = 600.0
+TICK = 0.05
+
+
+def make_workload(n, seed=0):
+    rnd = random.Random(seed)
+    delays = {}
+    for i in xrange(HOSTS):
+        r = rnd.random()
+        delays['host%d' % i] = 0.5 if r < 0.7 else 2.0 if r < 0.95 else 10.0
+    # a few hosts have most of the links
+    hosts = ['host%d' % int(HOSTS * rnd.random() ** 3) for _ in xrange(n)]
+    requests = [(host, 'http://%s/page%d' % (host, i), rnd.randint(0, 3))
+                for i, host in enumerate(hosts)]
+    return requests, delays
+
+
+def bench_throughput(requests, directory):
+    frontier = HostFrontier(os.path.join(directory, 'throughput.db'),
+                            hot_window=10000)
+    start = timeit.default_timer()
+    for host, url, priority in requests:
+        frontier.push(host, url, priority)
+    push_time = timeit.default_timer() - start
+    hot_after_push = frontier.hot_count
+    start = timeit.default_timer()
+    count = 0
+    while frontier.pop(now=float('inf')) is not None:
+        count += 1
+    pop_time = timeit.default_timer() - start
+    assert count == len(requests)
+    frontier.close()
+    n = len(requests)
+    print 'push: %.0f requests/s, pop: %.0f requests/s' % (
+        n / push_time, n / pop_time)
+    print 'requests in memory after pushing %d: %d' % (n, hot_after_push)
+
+
+class SimulatedDownloader(object):
+    """ Download slots with per-host delays and concurrency 1 """
+
+    def __init__(self, delays):
+        self.delays = delays
+        self.queues = collections.defaultdict(collections.deque)
+        self.lastseen = {}
+        self.busy = {}  # host => download finish time
+        self.active = 0
+        self.fetched = 0
+        self.wait_total = 0.0
+
+    def enqueue(self, host, now):
+        self.queues[host].append(now)
+        self.active += 1
+
+    def tick(self, now):
+        for host, finish in self.busy.items():
+            if finish <= now:
+                del self.busy[host]
+                self.active -= 1
+                self.fetched += 1
+        for host in [h for h, q in self.queues.iteritems() if q]:
+            if (host not in self.busy and
+                    now >= self.lastseen.get(host, 0) + self.delays[host]):
+                self.wait_total += now - self.queues[host].popleft()
+                self.lastseen[host] = now
+                self.busy[host] = now + LATENCY
+            if not self.queues[host]:
+                del self.queues[host]
+
+    def wait(self, host, now):
+        if self.queues.get(host) or host in self.busy:
+            return self.delays[host]
+        return self.lastseen.get(host, 0) + self.delays[host] - now
+
+
+def simulate(name, requests, delays, make_queue):
+    downloader = SimulatedDownloader(delays)
+    pop, max_in_memory = make_queue(requests, downloader)
+    now = 0.0
+    taken = 0
+    while now < SIM_TIME:
+        downloader.tick(now)
+        while downloader.active < CONCURRENCY:
+            host = pop(now)
+            if host is None:
+                break
+            downloader.enqueue(host, now)
+            taken += 1
+        now += TICK
+    print '%-10s %10.0f %16.1f %14d' % (
+        name, downloader.fetched * 60 / SIM_TIME,
+        downloader.wait_total / max(taken, 1), max_in_memory())
+
+
+def fifo_queue(requests, downloader):
+    queue = collections.deque(host for host, _, _ in requests)
+
+    def pop(now):
+        return queue.popleft() if queue else None
+    return pop, lambda: len(requests)
+
+
+def frontier_queue(directory):
+    def make_queue(requests, downloader):
+        frontier = HostFrontier(os.path.join(directory, 'simulated.db'),
+                                delay=lambda host: delays[host],
+                                wait=downloader.wait, hot_window=10000)
+        delays = downloader.delays
+        for host, _, priority in requests:
+            frontier.push(host, host, priority)
+        max_hot = [frontier.hot_count]
+
+        def pop(now):
+            host = frontier.pop(now)
+            max_hot[0] = max(max_hot[0], frontier.hot_count)
+            return host
+        return pop, lambda: max_hot[0]
+    return make_queue
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    requests, delays = make_workload(n)
+    directory = tempfile.mkdtemp()
+    try:
+        bench_throughput(requests, directory)
+        print
+        print '%d requests, %d hosts, %d concurrent requests, %ds' % (
+            n, len(set(host for host, _, _ in requests)), CONCURRENCY,
+            SIM_TIME)
+        print '%-10s %10s %16s %14s' % ('queue', 'pages/min',
+                                        'slot wait, s', 'in memory')
+        simulate('fifo', requests, delays, fifo_queue)
+        simulate('frontier', requests, delays, frontier_queue(directory))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
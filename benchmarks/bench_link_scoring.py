@@ -0,0 +1,63 @@
+"""
+Links scored per second by HashedLinearScorer: feature extraction alone,
+one link per call and whole pages of links per call.
+
+Usage: python benchmarks/bench_link_scoring.py [number of links]
+"""
+import random
+import sys
+import timeit
+
+import numpy as np
+
+from scrapy_memex.utils.linkscoring import (
+    HashedLinearScorer, hash_features, link_features
+)
+
+DIM = 2 ** 20
+WORDS = ['news', 'article', 'contact', 'about', 'login', 'product', 'item',
+         'category', 'page', 'search', 'tag', 'archive', 'forum', 'thread']
+
+
+def make_links(n, seed=0):
+    rnd = random.Random(seed)
+    links = []
+    for i in xrange(n):
+        host = 'www.host%d.example.com' % rnd.randint(0, 5000)
+        path = '/'.join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 4)))
+        url = 'http://%s/%s/%d.html' % (host, path, i)
+        if rnd.random() < 0.3:
+            url += '?page=%d' % rnd.randint(1, 50)
+        text = u' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(0, 5)))
+        links.append((url, text))
+    return links
+
+
+def bench(name, func, n):
+    start = timeit.default_timer()
+    func()
+    elapsed = timeit.default_timer() - start
+    print '%-32s %12.0f links/s' % (name, n / elapsed)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    links = make_links(n)
+    parent = 'http://www.host1.example.com/'
+    rnd = np.random.RandomState(0)
+    scorer = HashedLinearScorer(rnd.normal(0, 0.1, DIM).astype(np.float32),
+                                bias=-1.0, kind='logistic')
+
+    bench('features only', lambda: [
+        hash_features(link_features(url, text, parent), DIM)
+        for url, text in links], n)
+    bench('one link per call', lambda: [
+        scorer.score_links(parent, [link]) for link in links], n)
+    for page_size in [10, 100, 1000]:
+        pages = [links[i:i + page_size] for i in xrange(0, n, page_size)]
+        bench('%d links per call' % page_size, lambda: [
+            scorer.score_links(parent, page) for page in pages], n)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Cost of SplashEnablerRegexMiddleware rule matching on bodies which match
+no rule (the worst case): one re.search per rule vs. the combined
+RegexRules pattern, for several rule counts and body sizes.
+
+Usage: python benchmarks/bench_splash_regex.py
+"""
+import random
+import re
+import timeit
+
+from scrapy_memex.downloadermiddleware.splashenabler.matcher import RegexRules
+
+
+def make_rules(n):
+    words = ['angular', 'react', 'ng-app', 'data-reactid', 'ember',
+             'backbone', 'vue', 'knockout', 'meteor', 'polymer']
+    rules = []
+    for i in range(n):
+        word = words[i % len(words)]
+        rules.append(('%s-%d[ "=]' % (word, i), 'directive%d' % i))
+    return rules
+
+
+def make_body(size, seed=0):
+    rnd = random.Random(seed)
+    chunk = ''.join('<div class="c%d"><p>lorem ipsum dolor %d</p></div>\n' %
+                    (rnd.randint(0, 100), i) for i in range(200))
+    return (chunk * (size // len(chunk) + 1))[:size]
+
+
+def naive_search(rules, body):
+    for regex, directive in rules:
+        if re.search(regex, body):
+            return regex, directive
+
+
+def bench(func, number):
+    return min(timeit.repeat(func, number=number, repeat=3)) / number
+
+
+def main():
+    print '%6s %10s %12s %12s %8s' % ('rules', 'body', 'naive, ms',
+                                      'combined, ms', 'speedup')
+    for size in [10 * 1024, 1024 * 1024, 4 * 1024 * 1024]:
+        body = make_body(size)
+        number = max(1, 2 * 1024 * 1024 // size)
+        for n in [1, 10, 50]:
+            rules = make_rules(n)
+            compiled = RegexRules(rules)
+            assert naive_search(rules, body) is None
+            assert compiled.search(body) is None
+            naive = bench(lambda: naive_search(rules, body), number)
+            combined = bench(lambda: compiled.search(body), number)
+            print '%6d %9dK %12.3f %12.3f %7.1fx' % (
+                n, size // 1024, naive * 1000, combined * 1000,
+                naive / combined)
+
+
+if __name__ == '__main__':
+    main()
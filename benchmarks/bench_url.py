@@ -0,0 +1,60 @@
+"""
+Per-link cost of host normalization helpers from scrapy_memex.utils.url.
+
+Usage: python benchmarks/bench_url.py [number of links]
+"""
+import re
+import sys
+import timeit
+import urlparse
+
+from scrapy_memex.utils import url as urlutils
+
+
+def naive_is_external_url(source_url, target_url):
+    # What utils.url did before host caching: urlparse + regex per call
+    def hostname(u):
+        host = urlparse.urlparse(urlutils.add_scheme_if_missing(u)).hostname
+        return re.sub(r'^www\d*\.', '', host or '')
+    return hostname(source_url) != hostname(target_url)
+
+
+def make_links(n, hosts=2000):
+    return ['http://www%d.host%d.example.co.uk/path/%d?q=%d' %
+            (i % 3, i % hosts, i, i) for i in xrange(n)]
+
+
+def bench(name, func, links):
+    start = timeit.default_timer()
+    func()
+    elapsed = timeit.default_timer() - start
+    print '%-34s %8.3f us/link' % (name, elapsed / len(links) * 1e6)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    links = make_links(n)
+    source = 'http://www.host1.example.co.uk/'
+
+    def clear_caches():
+        for func in (urlutils._host, urlutils._hostname,
+                     urlutils._registered_domain, urlutils._site_name):
+            func.cache.clear()
+
+    bench('naive is_external_url',
+          lambda: [naive_is_external_url(source, l) for l in links], links)
+    clear_caches()
+    bench('is_external_url (cold cache)',
+          lambda: [urlutils.is_external_url(source, l) for l in links], links)
+    bench('is_external_url (warm cache)',
+          lambda: [urlutils.is_external_url(source, l) for l in links], links)
+    bench('external_url_flags',
+          lambda: urlutils.external_url_flags(source, links), links)
+    bench('get_domain',
+          lambda: [urlutils.get_domain(l) for l in links], links)
+    bench('get_registered_domain',
+          lambda: [urlutils.get_registered_domain(l) for l in links], links)
+
+
+if __name__ == '__main__':
+    main()
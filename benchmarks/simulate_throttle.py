@@ -0,0 +1,145 @@
+"""
+Run ThrottleController against a simulated downloader with synthetic
+latencies and compare it with a fixed download delay.
+
+Every simulated host has a base latency and a capacity: latency grows and
+errors appear when more requests than the capacity are in flight. Some
+hosts have a Crawl-Delay, which must never be violated.
+
+Usage: python benchmarks/simulate_throttle.py [simulated seconds]
+"""
+import heapq
+import itertools
+import random
+import sys
+
+from scrapy_memex.utils.throttle import ThrottleController
+
+
+class SimulatedHost(object):
+    def __init__(self, name, latency, capacity, crawl_delay=None):
+        self.name = name
+        self.latency = latency
+        self.capacity = capacity
+        self.crawl_delay = crawl_delay
+        self.active = 0
+
+    def download(self, rnd):
+        """ Return (latency, error) of a request started now """
+        overload = max(0, self.active - self.capacity)
+        latency = rnd.expovariate(1.0 / self.latency) * (1 + overload)
+        error = rnd.random() < min(0.5, 0.1 * overload)
+        return latency, error
+
+
+class SimulatedSlot(object):
+    """ Mimics scrapy.core.downloader.Slot scheduling """
+    def __init__(self, delay, concurrency):
+        self.delay = delay
+        self.concurrency = concurrency
+        self.lastseen = -1e9
+        self.active = 0
+        self.wakeup = None  # time of the pending 'wake' event
+
+
+def simulate(hosts, duration, controller=None, fixed_delay=1.0,
+             fixed_concurrency=8, seed=0):
+    rnd = random.Random(seed)
+    slots = {}
+    stats = dict((h.name, {'done': 0, 'errors': 0, 'violations': 0,
+                           'last_start': None}) for h in hosts)
+    for host in hosts:
+        if controller is not None:
+            state = controller.set_floor(host.name, host.crawl_delay)
+            slots[host.name] = SimulatedSlot(state.delay, state.concurrency)
+        else:
+            delay = max(fixed_delay, host.crawl_delay or 0)
+            slots[host.name] = SimulatedSlot(delay, fixed_concurrency)
+
+    # (time, sequence number, host, download result or None for wakeups)
+    events = []
+    seq = itertools.count()
+
+    def wake(slot, host, at):
+        if slot.wakeup is None or at < slot.wakeup:
+            slot.wakeup = at
+            heapq.heappush(events, (at, next(seq), host, None))
+
+    for host in hosts:
+        wake(slots[host.name], host, 0.0)
+    while events:
+        now, _, host, result = heapq.heappop(events)
+        if now > duration:
+            break
+        slot = slots[host.name]
+        host_stats = stats[host.name]
+        if result is None:
+            if slot.wakeup != now:
+                continue  # superseded by an earlier wakeup
+            slot.wakeup = None
+        else:
+            latency, error = result
+            slot.active -= 1
+            host.active -= 1
+            host_stats['done'] += 1
+            host_stats['errors'] += error
+            if controller is not None:
+                state = controller.on_response(host.name, latency, error)
+                slot.delay, slot.concurrency = (state.delay,
+                                                state.concurrency)
+        # start a request if the slot allows it
+        if slot.active >= slot.concurrency:
+            continue
+        wait = slot.lastseen + slot.delay - now
+        if wait > 0:
+            wake(slot, host, now + wait)
+            continue
+        last_start = host_stats['last_start']
+        if (host.crawl_delay and last_start is not None and
+                now - last_start < host.crawl_delay - 1e-9):
+            host_stats['violations'] += 1
+        host_stats['last_start'] = now
+        slot.lastseen = now
+        slot.active += 1
+        host.active += 1
+        result = host.download(rnd)
+        heapq.heappush(events, (now + result[0], next(seq), host, result))
+        wake(slot, host, now + slot.delay)
+    return stats, slots
+
+
+def report(title, hosts, stats, slots, duration):
+    print title
+    print '  %-8s %9s %7s %10s %7s %6s' % ('host', 'req/s', 'errors',
+                                            'violations', 'delay', 'conc')
+    for host in hosts:
+        s = stats[host.name]
+        print '  %-8s %9.2f %7d %10d %7.2f %6d' % (
+            host.name, s['done'] / float(duration), s['errors'],
+            s['violations'], slots[host.name].delay,
+            slots[host.name].concurrency)
+
+
+def make_hosts():
+    return [
+        SimulatedHost('fast', latency=0.1, capacity=8),
+        SimulatedHost('slow', latency=2.0, capacity=2),
+        SimulatedHost('fragile', latency=0.3, capacity=1),
+        SimulatedHost('polite', latency=0.1, capacity=8, crawl_delay=3.0),
+    ]
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 3600
+    hosts = make_hosts()
+    stats, slots = simulate(hosts, duration, fixed_delay=1.0)
+    report('fixed delay 1.0s:', hosts, stats, slots, duration)
+
+    hosts = make_hosts()
+    controller = ThrottleController(start_delay=1.0, max_concurrency=8)
+    stats, slots = simulate(hosts, duration, controller)
+    report('ThrottleController:', hosts, stats, slots, duration)
+
+
+if __name__ == '__main__':
+    main()
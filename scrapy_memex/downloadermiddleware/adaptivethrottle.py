@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import logging
+
+from twisted.internet.error import TimeoutError
+
+from scrapy import log, signals
+from scrapy.exceptions import NotConfigured
+
+from scrapy_memex.downloadermiddleware.robotscrawldelay import (
+    crawl_delay_received
+)
+from scrapy_memex.utils.throttle import ThrottleController
+
+
+class AdaptiveThrottleMiddleware(object):
+    """
+    Scrapy downloader middleware which adapts download delay and
+    concurrency of every download slot to observed latencies and error
+    rates, like AutoThrottle, but never goes below Crawl-Delay from
+    robots.txt (reported by RobotsCrawlDelayMiddleware), so both
+    middlewares can be enabled together. See
+    :class:`scrapy_memex.utils.throttle.ThrottleController` for details.
+
+    Settings::
+
+        DOWNLOADER_MIDDLEWARES = {
+            'scrapy_memex.downloadermiddleware.adaptivethrottle.'
+            'AdaptiveThrottleMiddleware': 950,
+        }
+        THROTTLE_ENABLED = True
+        AUTOTHROTTLE_ENABLED = False
+
+        THROTTLE_START_DELAY = 1.0
+        THROTTLE_MIN_DELAY = DOWNLOAD_DELAY
+        THROTTLE_MAX_DELAY = 60.0
+        THROTTLE_TARGET_CONCURRENCY = 1.0  # requests in flight per slot
+        THROTTLE_MAX_CONCURRENCY = CONCURRENT_REQUESTS_PER_DOMAIN
+        THROTTLE_BACKOFF = 2.0
+        THROTTLE_ERROR_CODES = [408, 429, 500, 502, 503, 504]
+        THROTTLE_SLOT_STATS = False  # per-slot state in stats
+        THROTTLE_DEBUG = False  # log every adjustment
+
+    With ``THROTTLE_SLOT_STATS`` per-slot delay, concurrency, smoothed
+    latency and error rate are stored in stats under
+    ``throttle/slots/<slot key>/``; this adds 4 keys per slot, so it is
+    meant for crawls of a few sites.
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('THROTTLE_ENABLED'):
+            raise NotConfigured
+        if settings.getbool('AUTOTHROTTLE_ENABLED'):
+            log.msg("AdaptiveThrottleMiddleware and AutoThrottle are both "
+                    "enabled; they will fight over download delays",
+                    logging.WARNING)
+        self.crawler = crawler
+        self.stats = crawler.stats
+        max_concurrency = (settings.getint('CONCURRENT_REQUESTS_PER_IP') or
+                           settings.getint('CONCURRENT_REQUESTS_PER_DOMAIN'))
+        self.controller = ThrottleController(
+            start_delay=settings.getfloat('THROTTLE_START_DELAY', 1.0),
+            min_delay=settings.getfloat('THROTTLE_MIN_DELAY',
+                                        settings.getfloat('DOWNLOAD_DELAY')),
+            max_delay=settings.getfloat('THROTTLE_MAX_DELAY', 60.0),
+            target_concurrency=settings.getfloat(
+                'THROTTLE_TARGET_CONCURRENCY', 1.0),
+            max_concurrency=settings.getint('THROTTLE_MAX_CONCURRENCY',
+                                            max_concurrency),
+            backoff=settings.getfloat('THROTTLE_BACKOFF', 2.0),
+        )
+        self.error_codes = set(int(code) for code in settings.getlist(
+            'THROTTLE_ERROR_CODES', [408, 429, 500, 502, 503, 504]))
+        self.slot_stats = settings.getbool('THROTTLE_SLOT_STATS')
+        self.debug = settings.getbool('THROTTLE_DEBUG', False)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        mw = cls(crawler)
+        crawler.signals.connect(mw.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(mw.crawl_delay_received,
+                                signal=crawl_delay_received)
+        return mw
+
+    def spider_opened(self, spider):
+        # new slots are created with spider.download_delay
+        spider.download_delay = self.controller.start_delay
+
+    def crawl_delay_received(self, key, delay):
+        state = self.controller.set_floor(key, delay)
+        self._apply(key, state)
+
+    def process_response(self, request, response, spider):
+        error = response.status in self.error_codes
+        self._update(request, request.meta.get('download_latency'), error)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        if isinstance(exception, TimeoutError):
+            latency = request.meta.get('download_timeout')
+        else:
+            latency = None
+        self._update(request, latency, True)
+
+    def _update(self, request, latency, error):
+        key = request.meta.get('download_slot')
+        if key is None or request.meta.get('dont_process_robots'):
+            return  # cached response or robots.txt request
+        if error:
+            self.stats.inc_value('throttle/error_count')
+        state = self.controller.on_response(key, latency, error)
+        self._apply(key, state)
+
+    def _apply(self, key, state):
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is not None:
+            if self.debug and (slot.delay != state.delay or
+                               slot.concurrency != state.concurrency):
+                log.msg("Throttle %s: delay %0.2f -> %0.2f, concurrency "
+                        "%d -> %d (%r)" % (key, slot.delay, state.delay,
+                                           slot.concurrency,
+                                           state.concurrency, state),
+                        logging.DEBUG)
+            slot.delay = state.delay
+            slot.concurrency = state.concurrency
+        if self.slot_stats:
+            prefix = 'throttle/slots/%s/' % key
+            self.stats.set_value(prefix + 'delay', state.delay)
+            self.stats.set_value(prefix + 'concurrency', state.concurrency)
+            self.stats.set_value(prefix + 'latency', state.latency)
+            self.stats.set_value(prefix + 'error_rate', state.error_rate)
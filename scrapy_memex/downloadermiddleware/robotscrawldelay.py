@@ -1,14 +1,32 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
+import json
 import logging
+import time
 import urlparse
+from email.utils import mktime_tz, parsedate_tz
 
 from reppy.parser import Rules
 
-from scrapy import log
+from twisted.internet import reactor
+
+from scrapy import log, signals
 from scrapy.exceptions import NotConfigured
 from scrapy.http import Request
 from scrapy.utils.httpobj import urlparse_cached
+from scrapy.utils.project import data_path
+
+from scrapy_memex.utils.lru import LRUCache
+from scrapy_memex.utils.sqlitecache import SqliteCache
+
+
+# Send this signal to download robots.txt files for ``urls`` ahead of time:
+#   crawler.signals.send_catch_log(robots_prefetch, urls=urls, spider=spider)
+robots_prefetch = object()
+
+# Sent with ``key`` (download slot key) and ``delay`` arguments when
+# Crawl-Delay of a download slot becomes known.
+crawl_delay_received = object()
 
 
 def get_robotstxt_url(url):
@@ -21,6 +39,49 @@ def get_robotstxt_url(url):
     return "%s://%s/robots.txt" % (url.scheme, url.netloc)
 
 
+def get_expiration_time(headers, default_ttl, min_ttl=0, max_ttl=None,
+                        now=None):
+    """
+    Return the time a response with ``headers`` expires at, according to
+    Cache-Control max-age or Expires headers (``default_ttl`` is used
+    if there are none). TTL is clamped to [min_ttl, max_ttl].
+
+    >>> get_expiration_time({'Cache-Control': 'public, max-age=600'}, 60,
+    ...                     now=1000)
+    1600
+    >>> get_expiration_time({'Cache-Control': 'no-cache'}, 60, 10, now=1000)
+    1010
+    >>> get_expiration_time({'Expires': 'Thu, 01 Jan 1970 01:00:00 GMT'},
+    ...                     60, now=0)
+    3600
+    >>> get_expiration_time({}, 60, max_ttl=30, now=0)
+    30
+    """
+    if now is None:
+        now = time.time()
+    ttl = default_ttl
+    cache_control = headers.get('Cache-Control')
+    expires = headers.get('Expires')
+    if cache_control:
+        directives = {}
+        for directive in cache_control.lower().split(','):
+            name, _, value = directive.strip().partition('=')
+            directives[name] = value.strip('"')
+        if 'no-store' in directives or 'no-cache' in directives:
+            ttl = 0
+        elif directives.get('max-age', '').isdigit():
+            ttl = int(directives['max-age'])
+            expires = None
+    if expires:
+        parsed = parsedate_tz(expires)
+        # Invalid dates mean "already expired" (RFC 7234)
+        ttl = mktime_tz(parsed) - now if parsed else 0
+    ttl = max(ttl, min_ttl)
+    if max_ttl is not None:
+        ttl = min(ttl, max_ttl)
+    return now + ttl
+
+
 class RobotRules(Rules):
     def delay(self, agent=None):
         """
@@ -67,60 +128,310 @@ class RobotsCrawlDelayMiddleware(object):
         ROBOTS_CRAWLDELAY_ENABLED = True
         ROBOTS_CRAWLDLAY_VERBOSE = True  # enable stats
 
-        # currently autothrottle doesn't play well with
-        # RobotsCrawlDelayMiddleware
+        # AutoThrottle lowers delays set by RobotsCrawlDelayMiddleware;
+        # use AdaptiveThrottleMiddleware instead (it treats Crawl-Delay
+        # as the minimum delay)
         AUTOTHROTTLE_ENABLED = False
 
+    Parsed robots.txt files are kept in an in-memory LRU cache and, unless
+    ``ROBOTS_CACHE_PERSIST`` is False, in a sqlite database which outlives
+    the crawl and can be shared by several crawler processes on the same
+    machine. Entries expire according to Cache-Control/Expires headers of
+    robots.txt responses, or after ``ROBOTS_CACHE_TTL`` seconds::
+
+        ROBOTS_CACHE_SIZE = 10000  # hosts kept in memory
+        ROBOTS_CACHE_PERSIST = True
+        ROBOTS_CACHE_DB = None  # default is .scrapy/robots.db
+        ROBOTS_CACHE_MAX_ENTRIES = 1000000  # hosts kept on disk
+        ROBOTS_CACHE_TTL = 86400
+        ROBOTS_CACHE_MIN_TTL = 3600
+        ROBOTS_CACHE_MAX_TTL = 7 * 86400
+
+    Failed robots.txt downloads and 5xx responses are not persisted; they
+    are retried after ``ROBOTS_CACHE_MIN_TTL`` seconds.
+    Cache hits, misses and robots.txt downloads are counted in stats
+    under ``robots.txt/``.
+
+    By default requests to a new host are sent with the default delay until
+    its robots.txt is downloaded. With ``ROBOTS_HOLD_REQUESTS = True`` the
+    download slot of the host is held until robots.txt rules arrive, or
+    for at most ``ROBOTS_HOLD_TIMEOUT`` seconds. robots.txt requests use
+    their own download slots, so they don't wait behind held requests::
+
+        ROBOTS_HOLD_REQUESTS = False
+        ROBOTS_HOLD_TIMEOUT = 30
+
+    robots.txt files for start URLs are downloaded when the spider is
+    opened if ``ROBOTS_PREFETCH_START_URLS`` is True; other URLs (e.g. of
+    newly discovered domains) can be prefetched by sending
+    the ``robots_prefetch`` signal.
+
+    Time between the first request to a host and the moment the first
+    request was actually sent (``robots.txt/time_to_first_request``) and
+    the number of requests sent sooner than Crawl-Delay allows
+    (``robots.txt/delay_violation_count``) are estimated from download
+    latencies; per-host values are reported when
+    ``ROBOTS_CRAWLDELAY_VERBOSE`` is set. Note that
+    RANDOMIZE_DOWNLOAD_DELAY makes some delays shorter than Crawl-Delay.
     """
 
     DOWNLOAD_PRIORITY = 1000
     MAX_DOWNLOAD_DELAY = 100
 
     def __init__(self, crawler):
-        if not crawler.settings.getbool('ROBOTS_CRAWLDELAY_ENABLED'):
+        settings = crawler.settings
+        if not settings.getbool('ROBOTS_CRAWLDELAY_ENABLED'):
             raise NotConfigured
-        self.verbose = crawler.settings.getbool('ROBOTS_CRAWLDELAY_VERBOSE',
-                                                False)
+        self.verbose = settings.getbool('ROBOTS_CRAWLDELAY_VERBOSE', False)
         self.crawler = crawler
-        self._robot_rules = {}  # domain => robots.txt rules object
+        self.stats = crawler.stats
+        self.ttl = settings.getint('ROBOTS_CACHE_TTL', 86400)
+        self.min_ttl = settings.getint('ROBOTS_CACHE_MIN_TTL', 3600)
+        self.max_ttl = settings.getint('ROBOTS_CACHE_MAX_TTL', 7 * 86400)
+        # robots.txt url => (robots.txt rules object or None, expires)
+        self._robot_rules = LRUCache(settings.getint('ROBOTS_CACHE_SIZE',
+                                                     10000))
+        self._pending = set()
+        self.hold = settings.getbool('ROBOTS_HOLD_REQUESTS', False)
+        self.hold_timeout = settings.getfloat('ROBOTS_HOLD_TIMEOUT', 30)
+        self.prefetch_start_urls = settings.getbool(
+            'ROBOTS_PREFETCH_START_URLS', False)
+        # robots.txt url => {slot key: (slot, delay, lastseen)}
+        self._held = {}
+        self._hold_timeouts = {}  # robots.txt url => DelayedCall
+        self._crawl_delays = LRUCache(self._robot_rules.maxsize)  # slot key
+        self._first_seen = LRUCache(self._robot_rules.maxsize)
+        self._last_sent = LRUCache(self._robot_rules.maxsize)
+        self.store = None
+        if settings.getbool('ROBOTS_CACHE_PERSIST', True):
+            self.store = SqliteCache(
+                settings.get('ROBOTS_CACHE_DB') or data_path('robots.db'),
+                max_entries=settings.getint('ROBOTS_CACHE_MAX_ENTRIES',
+                                            1000000),
+            )
 
     @classmethod
     def from_crawler(cls, crawler):
-        return cls(crawler)
+        mw = cls(crawler)
+        crawler.signals.connect(mw.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(mw.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(mw.prefetch, signal=robots_prefetch)
+        return mw
+
+    def spider_opened(self, spider):
+        if self.prefetch_start_urls:
+            self.prefetch(getattr(spider, 'start_urls', []), spider)
+
+    def spider_closed(self, spider):
+        for call in self._hold_timeouts.values():
+            if call.active():
+                call.cancel()
+        if self.store is not None:
+            self.store.close()
+        lookups = sum(self.stats.get_value('robots.txt/cache/%s' % key, 0)
+                      for key in ['hit', 'disk_hit', 'miss'])
+        if lookups:
+            misses = self.stats.get_value('robots.txt/cache/miss', 0)
+            self.stats.set_value('robots.txt/cache/hit_rate',
+                                 1.0 - float(misses) / lookups)
 
     def process_request(self, request, spider):
         if request.meta.get('dont_process_robots'):
             return
-        rules = self.robotstxt(request, spider)
-        self._adjust_delay(rules, request, spider)
+        robotstxt_url = get_robotstxt_url(urlparse_cached(request))
+        if robotstxt_url not in self._first_seen:
+            self._first_seen[robotstxt_url] = time.time()
+        rules = self._get_rules(robotstxt_url, spider)
+        if robotstxt_url in self._hold_timeouts:
+            self._hold(robotstxt_url, request, spider)
+        else:
+            self._adjust_delay(rules, request, spider)
 
-    def robotstxt(self, request, spider):
+    def process_response(self, request, response, spider):
+        latency = request.meta.get('download_latency')
+        if request.meta.get('dont_process_robots') or latency is None:
+            return response
         url = urlparse_cached(request)
-        if url.netloc not in self._robot_rules:
-            self._robot_rules[url.netloc] = None
-            req = Request(
-                get_robotstxt_url(url),
-                priority=self.DOWNLOAD_PRIORITY,
-                meta={'dont_process_robots': True}
-            )
-            dfd = self.crawler.engine.download(req, spider)
-            dfd.addCallback(self._parse_robots, spider=spider)
-        return self._robot_rules[url.netloc]
+        robotstxt_url = get_robotstxt_url(url)
+        sent = time.time() - latency
+        last_sent = self._last_sent.get(robotstxt_url)
+        if last_sent is None:
+            self._last_sent[robotstxt_url] = sent
+            first_seen = self._first_seen.get(robotstxt_url)
+            if first_seen is not None:
+                self._time_to_first_request(url.netloc,
+                                            max(0, sent - first_seen))
+            return response
+        self._last_sent[robotstxt_url] = max(sent, last_sent)
 
-    def _parse_robots(self, response, spider):
-        if response.status != 200:
-            return
+        entry = self._robot_rules.get(robotstxt_url)
+        delay = entry[0].delay() if entry and entry[0] else None
+        if delay and abs(sent - last_sent) < min(delay,
+                                                 self.MAX_DOWNLOAD_DELAY):
+            self.stats.inc_value('robots.txt/delay_violation_count')
+            if self.verbose:
+                self.stats.inc_value(
+                    'robots.txt/delay_violation_count/%s' % url.netloc)
+        return response
+
+    def _time_to_first_request(self, netloc, seconds):
+        self.stats.max_value('robots.txt/time_to_first_request/max', seconds)
+        self.stats.inc_value('robots.txt/time_to_first_request/total',
+                             seconds)
+        self.stats.inc_value('robots.txt/time_to_first_request/count')
+        if self.verbose:
+            self.stats.set_value(
+                'robots.txt/time_to_first_request/%s' % netloc, seconds)
+
+    def prefetch(self, urls, spider):
+        """ Start downloading robots.txt files for ``urls`` """
+        for url in urls:
+            self._get_rules(get_robotstxt_url(url), spider)
+
+    def robotstxt(self, request, spider):
+        robotstxt_url = get_robotstxt_url(urlparse_cached(request))
+        return self._get_rules(robotstxt_url, spider)
+
+    def _get_rules(self, robotstxt_url, spider):
+        if robotstxt_url in self._pending:
+            return None
+        entry = self._robot_rules.get(robotstxt_url)
+        if entry is not None and entry[1] > time.time():
+            self.stats.inc_value('robots.txt/cache/hit')
+            return entry[0]
+
+        entry = self._load_rules(robotstxt_url)
+        if entry is not None:
+            # rules are None for robots.txt which allow everything
+            self.stats.inc_value('robots.txt/cache/disk_hit')
+            return entry[0]
 
-        rules = RobotRules(
-            url=response.url,
-            status=response.status,
-            content=response.body_as_unicode(),
-            expires=None
+        self.stats.inc_value('robots.txt/cache/miss')
+        self._pending.add(robotstxt_url)
+        req = Request(
+            robotstxt_url,
+            priority=self.DOWNLOAD_PRIORITY,
+            meta={
+                'dont_process_robots': True,
+                # don't compete with (or wait behind) requests to the host
+                'download_slot': 'robots.txt:%s' % robotstxt_url,
+            }
         )
-        self._robot_rules[urlparse_cached(response).netloc] = rules
-        self._adjust_delay(rules, response, spider)
+        dfd = self.crawler.engine.download(req, spider)
+        dfd.addCallbacks(self._parse_robots, self._robots_error,
+                         callbackArgs=(robotstxt_url, spider),
+                         errbackArgs=(robotstxt_url, spider))
+        if self.hold:
+            self._hold_timeouts[robotstxt_url] = reactor.callLater(
+                self.hold_timeout, self._hold_timeout, robotstxt_url, spider)
+        return None
+
+    def _hold(self, robotstxt_url, request, spider):
+        """ Stop processing of the download slot of ``request`` """
+        key, slot = self._get_slot(request, spider)
+        held = self._held.setdefault(robotstxt_url, {})
+        if key in held:
+            return
+        held[key] = (slot, slot.delay, slot.lastseen, slot.randomize_delay)
+        # Downloader waits for "delay" seconds since "lastseen" before
+        # sending the next request from the slot (down to 0.5 * delay
+        # with RANDOMIZE_DOWNLOAD_DELAY).
+        slot.delay = self.hold_timeout + 1
+        slot.randomize_delay = False
+        slot.lastseen = time.time()
+
+    def _hold_timeout(self, robotstxt_url, spider):
+        self._hold_timeouts.pop(robotstxt_url, None)
+        if robotstxt_url in self._held:
+            self.stats.inc_value('robots.txt/hold_timeout_count')
+        self._release(robotstxt_url, None, spider)
+
+    def _release(self, robotstxt_url, rules, spider):
+        """
+        Restore delays of download slots held until robots.txt arrives
+        and resume processing of their queues.
+        """
+        call = self._hold_timeouts.pop(robotstxt_url, None)
+        if call is not None and call.active():
+            call.cancel()
+        downloader = self.crawler.engine.downloader
+        for key, (slot, delay, lastseen, randomize_delay) in self._held.pop(
+                robotstxt_url, {}).items():
+            slot.delay, slot.lastseen = delay, lastseen
+            slot.randomize_delay = randomize_delay
+            self._adjust_slot_delay(rules, key, slot)
+            latercall = getattr(slot, 'latercall', None)
+            if latercall is not None and latercall.active():
+                latercall.cancel()
+                slot.latercall = None
+            downloader._process_queue(spider, slot)
+
+    def _load_rules(self, robotstxt_url):
+        """
+        Load rules from the persistent store to the memory cache and
+        return the (rules, expires) cache entry, or None if not stored.
+        """
+        if self.store is None:
+            return None
+        data = self.store.get(robotstxt_url)
+        if data is None:
+            return None
+        data = json.loads(data)
+        rules = self._make_rules(data['url'], data['status'],
+                                 data['content'])
+        entry = self._robot_rules[robotstxt_url] = (rules, data['expires'])
+        return entry
+
+    def _make_rules(self, url, status, content):
+        if status != 200:
+            return None
+        return RobotRules(url=url, status=status, content=content,
+                          expires=None)
+
+    def _parse_robots(self, response, robotstxt_url, spider):
+        self._pending.discard(robotstxt_url)
+        self.stats.inc_value('robots.txt/fetch_count')
+        self.stats.inc_value('robots.txt/response_status_count/%d' %
+                             response.status)
+        if response.status >= 500:
+            self._robot_rules[robotstxt_url] = (
+                None, time.time() + self.min_ttl
+            )
+            self._release(robotstxt_url, None, spider)
+            return
+
+        content = (response.body_as_unicode() if response.status == 200
+                   else u'')
+        expires = get_expiration_time(response.headers, self.ttl,
+                                      self.min_ttl, self.max_ttl)
+        rules = self._make_rules(response.url, response.status, content)
+        self._robot_rules[robotstxt_url] = (rules, expires)
+        if self.store is not None:
+            self.store.set(robotstxt_url, json.dumps({
+                'url': response.url,
+                'status': response.status,
+                'content': content,
+                'expires': expires,
+            }), expires)
+        # response.meta has the download slot of robots.txt request
+        self._adjust_delay(rules, Request(robotstxt_url), spider)
+        self._release(robotstxt_url, rules, spider)
+
+    def _robots_error(self, failure, robotstxt_url, spider):
+        self._pending.discard(robotstxt_url)
+        self.stats.inc_value('robots.txt/fetch_error_count')
+        self._robot_rules[robotstxt_url] = (None, time.time() + self.min_ttl)
+        log.msg("Error downloading %s: %s" % (robotstxt_url, failure.value),
+                logging.DEBUG, spider=spider)
+        self._release(robotstxt_url, None, spider)
 
     def _adjust_delay(self, rules, request_or_response, spider):
+        if rules is None or rules.delay() is None:
+            return
+        key, slot = self._get_slot(request_or_response, spider)
+        self._adjust_slot_delay(rules, key, slot)
+
+    def _adjust_slot_delay(self, rules, key, slot):
         if rules is None:
             return
 
@@ -128,7 +439,11 @@ class RobotsCrawlDelayMiddleware(object):
         if robots_delay is None:
             return
 
-        key, slot = self._get_slot(request_or_response, spider)
+        robots_delay = min(robots_delay, self.MAX_DOWNLOAD_DELAY)
+        if self._crawl_delays.get(key) != robots_delay:
+            self._crawl_delays[key] = robots_delay
+            self.crawler.signals.send_catch_log(crawl_delay_received,
+                                                key=key, delay=robots_delay)
 
         delay = min(max(slot.delay, robots_delay), self.MAX_DOWNLOAD_DELAY)
         if delay != slot.delay:
@@ -1,8 +1,12 @@
 class ScorerMiddleware(object):
     """This class is meant to provide website scoring feature, but now it's
-    only dumb implemetation"""
+    only dumb implemetation. Scores already set by
+    :class:`scrapy_memex.spidermiddleware.linkscorer.LinkScorerMiddleware`
+    are kept."""
 
     def process_response(self, request, response, spider):
+        if 'score' in request.meta:
+            return response
         if 'google.' in request.url:
             score = 0.99
         else:
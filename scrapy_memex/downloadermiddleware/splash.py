@@ -1,17 +1,25 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 
-import base64
+import hashlib
 import json
 import logging
 import os
+import time
 
 from urlparse import urljoin
 from urllib import urlencode
 
-from scrapy import log
+from twisted.internet import error
+
+from scrapy import log, signals
 from scrapy.http import HtmlResponse
 from scrapy.utils.conf import closest_scrapy_cfg
+from scrapy.utils.project import data_path
+
+from scrapy_memex.downloadermiddleware.splashpool import SplashPool
+from scrapy_memex.utils.payload import PayloadSpool
+from scrapy_memex.utils.sqlitecache import SqliteCache
 
 
 class SplashMiddleware(object):
@@ -35,6 +43,41 @@ class SplashMiddleware(object):
 
     The response
 
+    Screenshots larger than ``PAYLOAD_SPOOL_THRESHOLD`` are spooled to disk
+    when ``PAYLOAD_SPOOL_ENABLED`` is set; ``response.meta['png']`` is
+    a :class:`scrapy_memex.utils.payload.PayloadRef` then.
+
+    ``SPLASH_URL`` can be a list of Splash instances (or a comma-separated
+    string, or a dict {url: weight}); requests are routed to the least
+    loaded healthy instance, or randomly according to instance weights
+    with ``SPLASH_ROUTING = 'weighted'``. Instances are ejected after
+    ``SPLASH_MAX_FAILURES`` consecutive errors and readmitted when their
+    ``/_ping`` endpoint responds again. Requests which failed with
+    502/503/504 or a network error (e.g. a timeout) are retried on another
+    instance, at most ``SPLASH_POOL_RETRIES`` times::
+
+        SPLASH_URL = ['http://splash1:8050', 'http://splash2:8050']
+        SPLASH_ROUTING = 'least_loaded'
+        SPLASH_INSTANCE_CONCURRENCY = 0  # 0 means no limit
+        SPLASH_MAX_FAILURES = 3
+        SPLASH_PING_INTERVAL = 10
+        SPLASH_PING_TIMEOUT = 5
+        SPLASH_POOL_RETRIES = 2
+
+    Per-instance request, error counts and latency are in stats under
+    ``splash/instances/``.
+
+    Successful renders can be cached on disk; a request with the same
+    target URL, Splash options and directive source is then answered from
+    the cache without contacting Splash::
+
+        SPLASH_CACHE_ENABLED = False
+        SPLASH_CACHE_DB = None  # default is .scrapy/splash_cache.db
+        SPLASH_CACHE_TTL = 86400
+        SPLASH_CACHE_MAX_SIZE = 1024 * 1024 * 1024  # bytes
+
+    Cache hits and misses are counted in ``splash/cache/*`` stats.
+
     .. _Splash: https://github.com/scrapinghub/splash
 
     """
@@ -42,12 +85,35 @@ class SplashMiddleware(object):
     SPLASH_DEFAULT_DIRECTIVES_DIR = 'directives'
     SPLASH_EXTRA_TIMEOUT = 30
     RESPECT_SLOTS = True
+    RETRY_HTTP_CODES = (502, 503, 504)
+    RETRY_EXCEPTIONS = (error.TimeoutError, error.ConnectError,
+                        error.ConnectionDone, error.ConnectionLost)
 
     def __init__(self, crawler, splash_url, directives_dir):
         self.crawler = crawler
-        self.splash_url = splash_url
+        if isinstance(splash_url, basestring):
+            splash_url = splash_url.split(',')
+        self.pool = SplashPool.from_settings(crawler.settings, splash_url,
+                                             crawler.stats)
+        self._instances = dict((i.url, i) for i in self.pool.instances)
+        self.max_retries = crawler.settings.getint('SPLASH_POOL_RETRIES', 2)
         self.directives_dir = directives_dir
         self._lua_cache = {}
+        self.spool = PayloadSpool.from_settings(crawler.settings)
+        self.cache = None
+        if crawler.settings.getbool('SPLASH_CACHE_ENABLED', False):
+            self.cache_ttl = crawler.settings.getint('SPLASH_CACHE_TTL', 86400)
+            self.cache = SqliteCache(
+                crawler.settings.get('SPLASH_CACHE_DB') or
+                data_path('splash_cache.db'),
+                max_bytes=crawler.settings.getint('SPLASH_CACHE_MAX_SIZE',
+                                                  1024 * 1024 * 1024),
+            )
+            crawler.signals.connect(self.cache.close,
+                                    signal=signals.spider_closed)
+        crawler.signals.connect(self.pool.start, signal=signals.engine_started)
+        crawler.signals.connect(self.pool.stop, signal=signals.engine_stopped)
+        crawler.signals.connect(self.spool.close, signal=signals.spider_closed)
 
     @classmethod
     def from_crawler(cls, crawler):
@@ -61,6 +127,7 @@ class SplashMiddleware(object):
     def process_request(self, request, spider):
         # Avoid recursion
         if request.meta.get('_splash'):
+            self._begin_request(request)
             return
 
         splash_options = request.meta.get('splash')
@@ -69,6 +136,15 @@ class SplashMiddleware(object):
         if directive or splash_options:
             if not self._is_request_type_supported(request):
                 return request
+            if self.cache is not None:
+                key = self._cache_key(request, splash_options, directive)
+                cached = self.cache.get(key)
+                if cached is not None:
+                    self.crawler.stats.inc_value('splash/cache/hit')
+                    return self._splash_response(request, request.url,
+                                                 cached, ['splash_cached'])
+                self.crawler.stats.inc_value('splash/cache/miss')
+                request.meta['_splash_cache_key'] = key
             self._increase_stats()
             # Decide which endpoint we'll use
             if directive:
@@ -77,8 +153,8 @@ class SplashMiddleware(object):
                 return self._json_request(request, splash_options)
 
     def _json_request(self, request, splash_options):
-        splash_url = urljoin(self.splash_url, 'render.json')
         meta = self._prepare_meta(request, splash_options)
+        splash_url = self._splash_url(meta, 'render.json')
         splash_options = self._prepare_splash_options(request, splash_options)
         new_request = request.replace(
             url=splash_url,
@@ -90,13 +166,14 @@ class SplashMiddleware(object):
         return new_request
 
     def _lua_request(self, request, splash_options, directive):
-        splash_url = urljoin(self.splash_url, 'execute')
         lua_source = self._load_lua_source(directive)
         js_source = self._load_js_source(directive)
         meta = self._prepare_meta(request, splash_options)
         splash_options['url'] = request.url
+        splash_url = self._splash_url(meta,
+                                      'execute?' + urlencode(splash_options))
         new_request = request.replace(
-            url=splash_url + '?' + urlencode(splash_options),
+            url=splash_url,
             method='POST',
             body=json.dumps({'lua_source': lua_source, 'js_source': js_source}),
             meta=meta,
@@ -104,6 +181,28 @@ class SplashMiddleware(object):
         )
         return new_request
 
+    def _splash_url(self, meta, endpoint, exclude=()):
+        """ Choose a Splash instance and return ``endpoint`` URL on it """
+        # The request goes through the scheduler before it is downloaded
+        # (and may be dropped there), so the instance counts it only when
+        # it is sent, see _begin_request.
+        instance = self.pool.choose(exclude)
+        meta['_splash_endpoint'] = endpoint
+        meta['_splash_instance'] = instance.url
+        meta['_splash_tried'] = meta.get('_splash_tried', []) + [instance.url]
+        return urljoin(instance.url, endpoint)
+
+    def _cache_key(self, request, splash_options, directive):
+        """ Hash of target URL, Splash options and directive source """
+        options = dict((key, value) for key, value
+                       in (splash_options or {}).items()
+                       if key not in ('url', 'headers'))
+        key = [request.url, options]
+        if directive:
+            key += [self._load_lua_source(directive),
+                    self._load_js_source(directive)]
+        return hashlib.sha1(json.dumps(key, sort_keys=True)).hexdigest()
+
     def _load_lua_source(self, directive):
         cache_name = 'lua_' + directive
         cached = self._lua_cache.get(cache_name)
@@ -166,19 +265,68 @@ class SplashMiddleware(object):
         if '_splash' in request.meta:
             self.crawler.stats.inc_value('splash/response_count/%s' %
                                          response.status)
+            failed = response.status in self.RETRY_HTTP_CODES
+            self._release_instance(request, failed)
+            if failed:
+                return self._retry(request, response.status) or response
             if response.status != 200:
                 return response
-            data = json.loads(response.body)
-            response = HtmlResponse(
-                url=request.meta.pop('splash_target_url'),
-                body=data.get('html', u'').encode('utf-8'),
-                encoding='utf-8',
-            )
-            if 'png' in data:
-                request.meta['png'] = base64.b64decode(data['png'])
+            target_url = request.meta.pop('splash_target_url')
+            key = request.meta.pop('_splash_cache_key', None)
+            if key is not None:
+                self.cache.set(key, response.body,
+                               time.time() + self.cache_ttl)
+            response = self._splash_response(request, target_url,
+                                             response.body)
+
+        return response
 
+    def _splash_response(self, request, url, body, flags=None):
+        data = json.loads(body)
+        response = HtmlResponse(
+            url=url,
+            body=data.get('html', u'').encode('utf-8'),
+            encoding='utf-8',
+            flags=flags,
+        )
+        if 'png' in data:
+            request.meta['png'] = self.spool.spool_b64decode(data['png'])
         return response
 
+    def process_exception(self, request, exception, spider):
+        if '_splash' in request.meta:
+            self._release_instance(request, True)
+            if isinstance(exception, self.RETRY_EXCEPTIONS):
+                return self._retry(request, exception)
+
+    def _begin_request(self, request):
+        instance = self._instances.get(request.meta.get('_splash_instance'))
+        if instance is not None and not request.meta.get('_splash_active'):
+            self.pool.begin(instance)
+            request.meta['_splash_active'] = True
+
+    def _release_instance(self, request, failed):
+        instance = self._instances.get(request.meta.get('_splash_instance'))
+        if instance is not None and request.meta.pop('_splash_active', False):
+            self.pool.release(instance, request.meta.get('download_latency'),
+                              failed)
+
+    def _retry(self, request, reason):
+        """ Retry a failed Splash request on another instance """
+        tried = request.meta.get('_splash_tried', [])
+        if len(tried) > self.max_retries:
+            return None
+        meta = request.meta.copy()
+        meta.pop('download_latency', None)
+        exclude = [self._instances[url] for url in tried
+                   if url in self._instances]
+        splash_url = self._splash_url(meta, meta['_splash_endpoint'], exclude)
+        log.msg("Retrying %s on %s (failed on %s: %s)" % (
+            meta['splash_target_url'], meta['_splash_instance'],
+            request.meta['_splash_instance'], reason), logging.DEBUG)
+        self.crawler.stats.inc_value('splash/retry_count')
+        return request.replace(url=splash_url, meta=meta, dont_filter=True)
+
     def _get_slot_key(self, request_or_response):
         return self.crawler.engine.downloader._get_slot_key(
             request_or_response, None
@@ -0,0 +1,205 @@
+import re
+import time
+
+from lxml import etree
+
+from scrapy.http import HtmlResponse, XmlResponse
+
+from . import splash_request
+from .matcher import RegexRules
+from .memory import SplashDecisionMemoryMixin
+
+XPATH_NAMESPACES = {'re': 'http://exslt.org/regular-expressions'}
+
+# Rule types, cheapest first
+RULE_TYPES = ('url', 'header', 'score', 'body', 'xpath')
+
+
+def normalize_rules(config):
+    """
+    Return rules from ``config`` as dicts with 'type', 'name' and
+    'directive' keys, ordered cheapest first (see RULE_TYPES); rules of
+    the same type keep their order.
+
+    >>> rules = normalize_rules([
+    ...     {'type': 'xpath', 'xpath': '//*[@ng-app]', 'directive': 'ng'},
+    ...     {'type': 'url', 'regex': r'\\.aspx', 'name': 'aspx'},
+    ... ])
+    >>> [(r['type'], r['name'], r['directive']) for r in rules]
+    [('url', 'aspx', None), ('xpath', 'xpath0', 'ng')]
+    """
+    rules = []
+    for i, rule in enumerate(config):
+        rule = dict(rule)
+        if rule.get('type') not in RULE_TYPES:
+            raise ValueError("Unknown splash enabler rule type: %r" % rule)
+        rule.setdefault('name', '%s%d' % (rule['type'], i))
+        rule.setdefault('directive', None)
+        rules.append(rule)
+    rules.sort(key=lambda r: RULE_TYPES.index(r['type']))
+    return rules
+
+
+class SplashEnablerMiddleware(SplashDecisionMemoryMixin):
+    """
+    Downloader middleware which enables Splash for requests matching one
+    of ``SPLASH_ENABLE_RULES``. Rules are evaluated cheapest first: URL
+    regexes when the request is sent, then (after a plain download)
+    header regexes, ``score`` meta values, body regexes and XPaths; the
+    first matching rule wins::
+
+        SPLASH_ENABLE_RULES = [
+            {'type': 'url', 'regex': r'/app/', 'directive': 'scroll'},
+            {'type': 'header', 'header': 'X-Powered-By', 'regex': 'Next'},
+            {'type': 'score', 'min_score': 0.9},
+            {'type': 'body', 'regex': 'ng-app', 'name': 'angular'},
+            {'type': 'xpath', 'xpath': '//*[@data-reactroot]',
+             'required': ['data-reactroot']},
+        ]
+        SPLASH_ENABLE_MAX_BYTES = 0  # search only the head of bodies
+
+    ``name`` (used in stats) and ``directive`` keys are optional. URL and
+    body regexes are matched in a single pass each (see
+    :class:`.matcher.RegexRules`); XPath rules may list byte strings
+    ``required`` in the body, and the body is parsed only for
+    HTML/XML responses when some XPath rule passes this check.
+
+    Hit counts and evaluation time (in seconds) of every rule are in
+    ``splash_enabler/<name>/rules/`` stats; URL and body regexes are
+    evaluated together, so their time is in
+    ``splash_enabler/<name>/rules/url`` and ``.../rules/body``.
+    Per-host decision memory is available as well, see
+    :class:`.memory.SplashDecisionMemoryMixin`.
+    """
+
+    name = 'rules'
+
+    def __init__(self, crawler, rules, max_bytes=None):
+        self.stats = crawler.stats
+        if max_bytes is None:
+            max_bytes = crawler.settings.getint('SPLASH_ENABLE_MAX_BYTES', 0)
+        self.max_bytes = max_bytes
+        rules = normalize_rules(rules)
+        by_type = dict((t, [r for r in rules if r['type'] == t])
+                       for t in RULE_TYPES)
+        self.url_rules = RegexRules((r['regex'], r) for r in by_type['url'])
+        self.body_rules = RegexRules((r['regex'], r) for r in by_type['body'])
+        self.header_rules = by_type['header']
+        for rule in self.header_rules:
+            rule['compiled'] = re.compile(rule['regex'])
+        self.score_rules = by_type['score']
+        self.xpath_rules = by_type['xpath']
+        for rule in self.xpath_rules:
+            rule['compiled'] = etree.XPath(rule['xpath'],
+                                           namespaces=XPATH_NAMESPACES)
+            required = rule.get('required', ())
+            if isinstance(required, basestring):
+                required = (required,)
+            rule['required'] = tuple(required)
+        self._has_response_rules = len(self.url_rules) < len(rules)
+        self._setup_memory(crawler, self.name)
+        if not self._has_response_rules:
+            self.memory = None  # decisions don't depend on responses
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler, crawler.settings.getlist('SPLASH_ENABLE_RULES',
+                                                     []))
+
+    def process_request(self, request, spider):
+        if '_splash' in request.meta:
+            return
+        if self.url_rules:
+            start = time.time()
+            rule = self.url_rules.search(request.url)
+            self._inc_time('url', start)
+            if rule is not None:
+                self._hit(rule[1])
+                return splash_request(request, rule[1]['directive'])
+        return super(SplashEnablerMiddleware, self).process_request(
+            request, spider)
+
+    def process_response(self, request, response, spider):
+        """
+        Check a plain response and send the request to Splash if a rule
+        matches. Responses rendered by Splash, including renders served
+        from the Splash cache (flagged 'splash_cached', their request has
+        no '_splash' meta key), are never checked again.
+
+        >>> from scrapy.http import HtmlResponse, Request
+        >>> from scrapy.utils.test import get_crawler
+        >>> mw = SplashEnablerMiddleware(
+        ...     get_crawler(), [{'type': 'body', 'regex': 'ng-app'}])
+        >>> request = Request('http://example.com')
+        >>> plain = HtmlResponse(request.url, body='<div ng-app>')
+        >>> mw.process_response(request, plain, None) is request
+        True
+        >>> request = Request('http://example.com')
+        >>> cached = HtmlResponse(request.url, body='<div ng-app>',
+        ...                       flags=['splash_cached'])
+        >>> mw.process_response(request, cached, None) is cached
+        True
+        """
+        if (not self._has_response_rules or '_splash' in request.meta or
+                'splash_cached' in response.flags or
+                self._skip_checks(request)):
+            return response
+        rule = self._match_response(request, response)
+        if rule is not None:
+            self._hit(rule)
+            self._observe(request, True, rule['directive'])
+            return splash_request(request, rule['directive'], True)
+        self._observe(request, False)
+        return response
+
+    def _match_response(self, request, response):
+        for rule in self.header_rules:
+            start = time.time()
+            values = response.headers.getlist(rule['header'])
+            matched = any(rule['compiled'].search(value) for value in values)
+            self._inc_time(rule['name'], start)
+            if matched:
+                return rule
+
+        score = request.meta.get('score', 0)
+        for rule in self.score_rules:
+            if score >= rule.get('min_score', 1):
+                return rule
+
+        body = response.body
+        if self.max_bytes:
+            body = body[:self.max_bytes]
+        if self.body_rules:
+            start = time.time()
+            rule = self.body_rules.search(body)
+            self._inc_time('body', start)
+            if rule is not None:
+                return rule[1]
+
+        if self.xpath_rules and isinstance(response,
+                                           (HtmlResponse, XmlResponse)):
+            return self._match_xpath(response)
+
+    def _match_xpath(self, response):
+        body = response.body
+        root = None
+        for rule in self.xpath_rules:
+            start = time.time()
+            if all(s in body for s in rule['required']):
+                if root is None:
+                    # response.selector is cached, so the spider doesn't
+                    # parse the page again
+                    root = response.selector._root
+                matched = root is not None and bool(rule['compiled'](root))
+            else:
+                matched = False
+            self._inc_time(rule['name'], start)
+            if matched:
+                return rule
+
+    def _hit(self, rule):
+        self._inc_stats('rules/%s/hit_count' % rule['name'])
+
+    def _inc_time(self, name, start):
+        self.stats.inc_value('splash_enabler/%s/rules/%s/time' %
+                             (self.name, name), time.time() - start)
@@ -0,0 +1,138 @@
+import re
+import sre_constants
+import sre_parse
+
+MIN_PREFIX_LENGTH = 3
+
+
+def literal_prefix(regex):
+    """
+    Return the literal string every match of ``regex`` starts with.
+
+    >>> literal_prefix(r'ng-app\\b')
+    'ng-app'
+    >>> literal_prefix(r'data-(react|ng)')
+    'data-'
+    >>> literal_prefix(r'(?i)angular')
+    ''
+    >>> literal_prefix(r'foo|bar')
+    ''
+    """
+    parsed = sre_parse.parse(regex)
+    if parsed.pattern.flags & (re.IGNORECASE | re.LOCALE | re.UNICODE):
+        return ''
+    prefix = []
+    for op, av in parsed:
+        if op != sre_constants.LITERAL:
+            break
+        prefix.append(chr(av) if av < 256 else unichr(av))
+    return ''.join(prefix)
+
+
+def trie_regex(words):
+    """
+    Regex matching any of ``words``, with common prefixes factored out;
+    Python's re engine checks alternatives one by one, so a trie is much
+    faster than a plain alternation of many words.
+
+    >>> trie_regex(['ng-app', 'ng-view', 'react'])
+    '(?:ng\\\\-(?:app|view)|react)'
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = None
+
+    def build(node):
+        if '' in node and len(node) == 1:
+            return ''
+        alternatives = [re.escape(char) + build(node[char])
+                        for char in sorted(node) if char]
+        if len(alternatives) == 1 and '' not in node:
+            return alternatives[0]
+        pattern = '(?:%s)' % '|'.join(alternatives)
+        return pattern + '?' if '' in node else pattern
+    return build(trie)
+
+
+class RegexRules(object):
+    """
+    Ordered (regex, directive) rules; :meth:`search` returns the first rule
+    (in order) which matches the text, like searching every rule in turn,
+    but text is scanned once for all rules starting with a literal prefix.
+
+    A single pattern of all rule prefixes (see :func:`trie_regex`) finds
+    every position where some rule can match; only rules whose prefix is
+    there are tried at that position. Rules without a literal prefix (or
+    case-insensitive ones) are searched separately, and only if they come
+    before the best match found.
+
+    >>> rules = RegexRules([('foo', 'a'), ('b.r', 'b'), ('bar', 'c')])
+    >>> rules.search('bar foo')
+    ('foo', 'a')
+    >>> rules.search('xx bar')
+    ('b.r', 'b')
+    >>> rules.search('nothing') is None
+    True
+    """
+
+    def __init__(self, rules, min_prefix_length=MIN_PREFIX_LENGTH):
+        self.rules = list(rules)
+        self.compiled = [re.compile(regex) for regex, _ in self.rules]
+        self._separate = []
+        # first char of prefix => [(prefix, rule index), ...]
+        self._by_first_char = {}
+        prefixes = set()
+        for i, (regex, _) in enumerate(self.rules):
+            prefix = literal_prefix(regex)
+            if len(prefix) < min_prefix_length:
+                self._separate.append(i)
+                continue
+            prefixes.add(prefix)
+            self._by_first_char.setdefault(prefix[0], []).append((prefix, i))
+        self._first_prefixed = min(i for candidates in
+                                   self._by_first_char.values()
+                                   for _, i in candidates) if prefixes else None
+        self.prefilter = (re.compile(trie_regex(prefixes)) if prefixes
+                          else None)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def index(self, text):
+        """ Return the index of the first rule matching ``text`` or None """
+        best = self._prefixed_index(text)
+        for i in self._separate:
+            if best is not None and i > best:
+                break
+            if self.compiled[i].search(text):
+                return i
+        return best
+
+    def _prefixed_index(self, text):
+        if self.prefilter is None:
+            return None
+        best = None
+        search = self.prefilter.search
+        compiled = self.compiled
+        pos = 0
+        while True:
+            m = search(text, pos)
+            if m is None:
+                return best
+            start = m.start()
+            for prefix, i in self._by_first_char[text[start]]:
+                if ((best is None or i < best) and
+                        text.startswith(prefix, start) and
+                        compiled[i].match(text, start)):
+                    best = i
+            if best == self._first_prefixed:
+                return best
+            pos = start + 1
+
+    def search(self, text):
+        """ Return the first (regex, directive) rule matching ``text`` """
+        i = self.index(text)
+        return None if i is None else self.rules[i]
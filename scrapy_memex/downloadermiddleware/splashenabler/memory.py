@@ -0,0 +1,145 @@
+import random
+
+from scrapy_memex.utils.lru import LRUCache
+from scrapy_memex.utils.url import get_hostname
+
+from . import splash_request
+
+SPLASH = 'splash'
+PLAIN = 'plain'
+
+
+class SplashDecisionMemory(object):
+    """
+    Per-host memory of splash enabler decisions. Every observation is
+    weighted by ``decay ** age``, so old decisions fade out.
+
+    After ``min_observations`` observations (decayed, so it must be below
+    ``1 / (1 - decay)``) a host which needed Splash at least
+    ``splash_threshold`` of the time is routed to Splash directly, and
+    a host which needed it at most ``plain_threshold`` of the time is
+    downloaded without Splash and without checks. A fraction ``explore``
+    of requests is still checked, to notice changes.
+
+    >>> memory = SplashDecisionMemory(min_observations=3, explore=0)
+    >>> for i in range(4):
+    ...     memory.observe('http://js.example.com/%d' % i, True, 'scroll')
+    ...     memory.observe('http://www.example.org/%d' % i, False)
+    >>> memory.decide('http://js.example.com/foo')
+    ('splash', 'scroll')
+    >>> memory.decide('http://example.org/bar')
+    ('plain', None)
+    >>> memory.decide('http://new.example.net/')
+    (None, None)
+    """
+
+    def __init__(self, decay=0.9, min_observations=5, splash_threshold=0.9,
+                 plain_threshold=0.05, explore=0.05, max_hosts=100000,
+                 seed=None):
+        self.decay = decay
+        self.min_observations = min_observations
+        self.splash_threshold = splash_threshold
+        self.plain_threshold = plain_threshold
+        self.explore = explore
+        self.random = random.Random(seed)
+        # host => [decayed splash count, decayed total count, directive]
+        self.hosts = LRUCache(max_hosts)
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            decay=settings.getfloat('SPLASH_ENABLER_MEMORY_DECAY', 0.9),
+            min_observations=settings.getfloat(
+                'SPLASH_ENABLER_MEMORY_MIN_OBSERVATIONS', 5),
+            splash_threshold=settings.getfloat(
+                'SPLASH_ENABLER_MEMORY_SPLASH_THRESHOLD', 0.9),
+            plain_threshold=settings.getfloat(
+                'SPLASH_ENABLER_MEMORY_PLAIN_THRESHOLD', 0.05),
+            explore=settings.getfloat('SPLASH_ENABLER_MEMORY_EXPLORE', 0.05),
+            max_hosts=settings.getint('SPLASH_ENABLER_MEMORY_SIZE', 100000),
+        )
+
+    def observe(self, url, needs_splash, directive=None):
+        host = get_hostname(url)
+        entry = self.hosts.get(host)
+        if entry is None:
+            entry = self.hosts[host] = [0.0, 0.0, None]
+        entry[0] = entry[0] * self.decay + bool(needs_splash)
+        entry[1] = entry[1] * self.decay + 1
+        if needs_splash:
+            entry[2] = directive
+
+    def decide(self, url):
+        """
+        Return ``(SPLASH, directive)``, ``(PLAIN, None)`` or
+        ``(None, None)`` if the response should be checked.
+        """
+        entry = self.hosts.get(get_hostname(url))
+        if entry is None or entry[1] < self.min_observations:
+            return None, None
+        if self.explore and self.random.random() < self.explore:
+            return None, None
+        rate = entry[0] / entry[1]
+        if rate >= self.splash_threshold:
+            return SPLASH, entry[2]
+        if rate <= self.plain_threshold:
+            return PLAIN, None
+        return None, None
+
+
+class SplashDecisionMemoryMixin(object):
+    """
+    Mixin for response-based splash enablers. With
+    ``SPLASH_ENABLER_MEMORY = True`` it remembers per-host decisions (see
+    :class:`SplashDecisionMemory`): requests to hosts which reliably need
+    Splash are sent to Splash right away instead of being downloaded
+    twice, and responses from hosts which never need it are not checked.
+
+    Settings (with defaults)::
+
+        SPLASH_ENABLER_MEMORY = False
+        SPLASH_ENABLER_MEMORY_DECAY = 0.9
+        SPLASH_ENABLER_MEMORY_MIN_OBSERVATIONS = 5
+        SPLASH_ENABLER_MEMORY_SPLASH_THRESHOLD = 0.9
+        SPLASH_ENABLER_MEMORY_PLAIN_THRESHOLD = 0.05
+        SPLASH_ENABLER_MEMORY_EXPLORE = 0.05
+        SPLASH_ENABLER_MEMORY_SIZE = 100000  # hosts
+
+    Saved downloads and skipped checks are counted in
+    ``splash_enabler/<name>/`` stats.
+    """
+
+    memory = None
+    stats = None
+    name = None
+
+    def _setup_memory(self, crawler, name):
+        self.name = name
+        self.stats = crawler.stats
+        if crawler.settings.getbool('SPLASH_ENABLER_MEMORY', False):
+            self.memory = SplashDecisionMemory.from_settings(crawler.settings)
+
+    def process_request(self, request, spider):
+        if (self.memory is None or '_splash' in request.meta or
+                request.meta.get('splash') or
+                request.meta.get('splash_directive')):
+            return
+        decision, directive = self.memory.decide(request.url)
+        if decision == SPLASH:
+            self._inc_stats('saved_download_count')
+            return splash_request(request, directive, True)
+        if decision == PLAIN:
+            request.meta['_splash_skip_checks_' + self.name] = True
+
+    def _skip_checks(self, request):
+        if request.meta.pop('_splash_skip_checks_' + self.name, False):
+            self._inc_stats('skipped_check_count')
+            return True
+        return False
+
+    def _observe(self, request, needs_splash, directive=None):
+        if self.memory is not None:
+            self.memory.observe(request.url, needs_splash, directive)
+
+    def _inc_stats(self, key):
+        self.stats.inc_value('splash_enabler/%s/%s' % (self.name, key))
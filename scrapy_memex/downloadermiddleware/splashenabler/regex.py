@@ -1,22 +1,24 @@
-import re
+from . import rule_directive
+from .engine import SplashEnablerMiddleware
 
-from . import splash_request, rule_directive
 
+class SplashEnablerRegexMiddleware(SplashEnablerMiddleware):
+    """
+    Enable Splash for responses whose body matches one of
+    ``SPLASH_ENABLE_REGEXES``; with ``SPLASH_ENABLE_REGEXES_MAX_BYTES``
+    only the head of the body is searched. See
+    :class:`.engine.SplashEnablerMiddleware`.
+    """
 
-class SplashEnablerRegexMiddleware(object):
+    name = 'regex'
 
     @classmethod
     def from_crawler(cls, crawler):
         cls.SPLASH_ENABLE_REGEXES = crawler.settings.getlist(
             'SPLASH_ENABLE_REGEXES', []
         )
-        return cls()
-
-    def process_response(self, request, response, spider):
-        if '_splash' in request.meta:
-            return response
-        for regex, directive in map(rule_directive,
-                                    self.SPLASH_ENABLE_REGEXES):
-            if re.search(regex, response.body):
-                return splash_request(request, directive, True)
-        return response
+        rules = [{'type': 'body', 'regex': regex, 'directive': directive}
+                 for regex, directive in map(rule_directive,
+                                             cls.SPLASH_ENABLE_REGEXES)]
+        return cls(crawler, rules, crawler.settings.getint(
+            'SPLASH_ENABLE_REGEXES_MAX_BYTES', 0))
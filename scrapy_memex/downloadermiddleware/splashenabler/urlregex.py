@@ -1,19 +1,22 @@
-import re
+from . import rule_directive
+from .engine import SplashEnablerMiddleware
 
-from . import splash_request, rule_directive
 
+class SplashEnablerUrlRegexMiddleware(SplashEnablerMiddleware):
+    """
+    Enable Splash for requests whose URL matches one of
+    ``SPLASH_ENABLE_URL_REGEXES``. See
+    :class:`.engine.SplashEnablerMiddleware`.
+    """
 
-class SplashEnablerUrlRegexMiddleware(object):
+    name = 'urlregex'
 
     @classmethod
     def from_crawler(cls, crawler):
         cls.SPLASH_ENABLE_URL_REGEXES = crawler.settings.getlist(
             'SPLASH_ENABLE_URL_REGEXES', []
         )
-        return cls()
-
-    def process_request(self, request, spider):
-        for regex, directive in map(rule_directive,
-                                    self.SPLASH_ENABLE_URL_REGEXES):
-            if re.search(regex, request.url):
-                return splash_request(request, directive)
+        rules = [{'type': 'url', 'regex': regex, 'directive': directive}
+                 for regex, directive in map(rule_directive,
+                                             cls.SPLASH_ENABLE_URL_REGEXES)]
+        return cls(crawler, rules)
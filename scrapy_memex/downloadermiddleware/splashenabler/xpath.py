@@ -1,23 +1,51 @@
-import scrapy
+from .engine import SplashEnablerMiddleware
 
-from . import splash_request, rule_directive
 
+def xpath_rule(value):
+    """
+    Return (xpath, directive, required substrings) for a
+    SPLASH_ENABLE_XPATHS rule.
 
-class SplashEnablerXpathMiddleware(object):
+    >>> xpath_rule('//div[@ng-app]')
+    ('//div[@ng-app]', None, ())
+    >>> xpath_rule(['//div[@ng-app]', 'angular', 'ng-app'])
+    ('//div[@ng-app]', 'angular', ('ng-app',))
+    """
+    if not isinstance(value, (list, tuple)):
+        return value, None, ()
+    xpath, directive = value[0], value[1] if len(value) > 1 else None
+    required = value[2] if len(value) > 2 else ()
+    if isinstance(required, basestring):
+        required = (required,)
+    return xpath, directive, tuple(required)
+
+
+class SplashEnablerXpathMiddleware(SplashEnablerMiddleware):
+    """
+    Enable Splash for HTML/XML responses where one of
+    ``SPLASH_ENABLE_XPATHS`` matches. A rule is an XPath, or a list of
+    XPath, directive and optional byte strings which must all be present
+    in the body for the XPath to match (case-sensitive)::
+
+        SPLASH_ENABLE_XPATHS = [
+            ['//*[@ng-app]', 'angular', 'ng-app'],
+            ['//script[contains(@src, "react")]', None, ['<script', 'react']],
+        ]
+
+    The body is parsed only if some rule passes its substring check, and
+    the parsed tree (``response.selector``) is reused by the spider. See
+    :class:`.engine.SplashEnablerMiddleware`.
+    """
+
+    name = 'xpath'
 
     @classmethod
     def from_crawler(cls, crawler):
         cls.SPLASH_ENABLE_XPATHS = crawler.settings.getlist(
             'SPLASH_ENABLE_XPATHS', []
         )
-        return cls()
-
-    def process_response(self, request, response, spider):
-        if '_splash' in request.meta:
-            return response
-        sel = scrapy.Selector(response)
-        for xpath, directive in map(rule_directive,
-                                    self.SPLASH_ENABLE_XPATHS):
-            if sel.xpath(xpath):
-                return splash_request(request, directive, True)
-        return response
+        rules = [{'type': 'xpath', 'xpath': xpath, 'directive': directive,
+                  'required': required}
+                 for xpath, directive, required in map(
+                     xpath_rule, cls.SPLASH_ENABLE_XPATHS)]
+        return cls(crawler, rules)
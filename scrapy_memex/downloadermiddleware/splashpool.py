@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import logging
+import random
+from urlparse import urljoin
+
+from twisted.internet import task
+from twisted.web.client import getPage
+
+from scrapy import log
+
+
+class SplashInstance(object):
+    """ A Splash server and its load / health state """
+
+    def __init__(self, url, weight=1.0, max_concurrency=None):
+        self.url = url
+        self.weight = float(weight)
+        self.max_concurrency = max_concurrency
+        self.active = 0  # requests being downloaded
+        self.chosen = 0  # requests routed to this instance
+        self.healthy = True
+        self.failures = 0  # consecutive failures
+        self.latency = None  # smoothed latency
+
+    def __repr__(self):
+        return "<SplashInstance %s active=%d healthy=%s>" % (
+            self.url, self.active, self.healthy)
+
+    @property
+    def load(self):
+        return self.active / self.weight
+
+    @property
+    def full(self):
+        return (self.max_concurrency is not None and
+                self.active >= self.max_concurrency)
+
+
+class SplashPool(object):
+    """
+    Pool of Splash instances with least-loaded or weighted random routing,
+    per-instance concurrency caps and health checks.
+
+    An instance is ejected after ``max_failures`` consecutive failed
+    requests or ``/_ping`` probes and readmitted after a successful probe.
+    If all instances are ejected or full, requests are routed to the least
+    loaded instance anyway (concurrency caps are soft: Scrapy downloader
+    middlewares can't delay requests). Load is the number of requests being
+    downloaded; requests routed to an instance but still in the scheduler
+    are not counted, as they may be dropped there.
+
+    >>> pool = SplashPool.from_urls(['http://a:8050', 'http://b:8050'],
+    ...                             max_concurrency=1)
+    >>> a = pool.acquire()
+    >>> b = pool.acquire()
+    >>> a.url, b.url
+    ('http://a:8050', 'http://b:8050')
+    >>> pool.release(a, latency=1.0)
+    >>> pool.acquire(exclude=[a]).url
+    'http://b:8050'
+    >>> for i in range(3):
+    ...     pool.release(b, error=True)
+    >>> b.healthy, pool.acquire().url
+    (False, 'http://a:8050')
+    """
+
+    ROUTING = ('least_loaded', 'weighted')
+
+    def __init__(self, instances, routing='least_loaded', max_failures=3,
+                 ping_interval=10.0, ping_timeout=5.0, stats=None,
+                 smoothing=0.3):
+        if not instances:
+            raise ValueError("No Splash instances")
+        if routing not in self.ROUTING:
+            raise ValueError("Unknown Splash routing: %r" % routing)
+        self.instances = instances
+        self.routing = routing
+        self.max_failures = max_failures
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.stats = stats
+        self.smoothing = smoothing
+        self.random = random.Random()
+        self._health_check = None
+
+    @classmethod
+    def from_urls(cls, urls, max_concurrency=None, **kwargs):
+        """
+        ``urls`` is a list of Splash URLs or a dict {url: weight}.
+        """
+        if isinstance(urls, dict):
+            items = urls.items()
+        else:
+            items = [(url, 1.0) for url in urls]
+        instances = [SplashInstance(url.strip(), weight, max_concurrency)
+                     for url, weight in sorted(items)]
+        return cls(instances, **kwargs)
+
+    @classmethod
+    def from_settings(cls, settings, urls, stats=None):
+        max_concurrency = settings.getint('SPLASH_INSTANCE_CONCURRENCY', 0)
+        return cls.from_urls(
+            urls,
+            max_concurrency=max_concurrency or None,
+            routing=settings.get('SPLASH_ROUTING', 'least_loaded'),
+            max_failures=settings.getint('SPLASH_MAX_FAILURES', 3),
+            ping_interval=settings.getfloat('SPLASH_PING_INTERVAL', 10.0),
+            ping_timeout=settings.getfloat('SPLASH_PING_TIMEOUT', 5.0),
+            stats=stats,
+        )
+
+    def start(self):
+        if len(self.instances) > 1 and self.ping_interval:
+            self._health_check = task.LoopingCall(self.check_health)
+            self._health_check.start(self.ping_interval, now=False)
+
+    def stop(self):
+        if self._health_check is not None and self._health_check.running:
+            self._health_check.stop()
+
+    def acquire(self, exclude=()):
+        """ Choose an instance for a request which is sent right away """
+        instance = self.choose(exclude)
+        self.begin(instance)
+        return instance
+
+    def choose(self, exclude=()):
+        """
+        Choose an instance for a new request; call :meth:`begin` when the
+        request is actually sent, and :meth:`release` when it is done.
+        """
+        candidates = [i for i in self.instances
+                      if i.healthy and not i.full and i not in exclude]
+        if not candidates:
+            candidates = ([i for i in self.instances if i not in exclude] or
+                          self.instances)
+            self._inc_stats('splash/pool/overflow_count')
+        if self.routing == 'weighted':
+            instance = self._weighted_choice(candidates)
+        else:
+            # requests chosen in a burst are not sent yet, so ties are
+            # broken round-robin
+            instance = min(candidates,
+                           key=lambda i: (i.load, i.chosen / i.weight))
+        instance.chosen += 1
+        self._inc_stats('splash/instances/%s/request_count' % instance.url)
+        return instance
+
+    def begin(self, instance):
+        """ Count a request being sent to ``instance`` """
+        instance.active += 1
+
+    def release(self, instance, latency=None, error=False):
+        """ Record the result of a request sent to ``instance`` """
+        instance.active = max(0, instance.active - 1)
+        if latency is not None:
+            if instance.latency is None:
+                instance.latency = latency
+            else:
+                a = self.smoothing
+                instance.latency = a * latency + (1 - a) * instance.latency
+            self._set_stats('splash/instances/%s/latency' % instance.url,
+                            instance.latency)
+        if error:
+            self._inc_stats('splash/instances/%s/error_count' % instance.url)
+            self._failure(instance)
+        else:
+            instance.failures = 0
+
+    def check_health(self):
+        for instance in self.instances:
+            dfd = getPage(urljoin(instance.url, '_ping'),
+                          timeout=self.ping_timeout)
+            dfd.addCallbacks(self._ping_ok, self._ping_failed,
+                             callbackArgs=(instance,),
+                             errbackArgs=(instance,))
+
+    def _ping_ok(self, body, instance):
+        instance.failures = 0
+        if not instance.healthy:
+            instance.healthy = True
+            log.msg("Splash instance %s is back" % instance.url,
+                    logging.INFO)
+            self._inc_stats('splash/instances/%s/readmitted_count' %
+                            instance.url)
+
+    def _ping_failed(self, failure, instance):
+        self._inc_stats('splash/instances/%s/ping_error_count' %
+                        instance.url)
+        self._failure(instance)
+
+    def _failure(self, instance):
+        instance.failures += 1
+        if instance.healthy and instance.failures >= self.max_failures:
+            instance.healthy = False
+            log.msg("Splash instance %s is ejected after %d failures" %
+                    (instance.url, instance.failures), logging.WARNING)
+            self._inc_stats('splash/instances/%s/ejected_count' %
+                            instance.url)
+
+    def _weighted_choice(self, instances):
+        # prefer instances with free capacity proportionally to weight
+        weights = [i.weight / (1 + i.active) for i in instances]
+        r = self.random.uniform(0, sum(weights))
+        for instance, weight in zip(instances, weights):
+            r -= weight
+            if r <= 0:
+                return instance
+        return instances[-1]
+
+    def _inc_stats(self, key):
+        if self.stats is not None:
+            self.stats.inc_value(key)
+
+    def _set_stats(self, key, value):
+        if self.stats is not None:
+            self.stats.set_value(key, value)
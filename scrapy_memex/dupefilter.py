@@ -0,0 +1,92 @@
+import hashlib
+import logging
+import os
+
+from scrapy import log
+from scrapy.dupefilter import BaseDupeFilter
+from scrapy.utils.job import job_dir
+
+from scrapy_memex.utils.bloom import ScalableBloomFilter
+from scrapy_memex.utils.url import canonical_url_function
+
+
+class BloomDupeFilter(BaseDupeFilter):
+    """
+    Duplicate request filter for broad crawls which keeps fingerprints in
+    a scalable Bloom filter (a few bytes per request at the default
+    false positive rate, instead of a SHA1 string in a set)::
+
+        DUPEFILTER_CLASS = 'scrapy_memex.dupefilter.BloomDupeFilter'
+        BLOOM_DUPEFILTER_CAPACITY = 1000000  # requests in the first filter
+        BLOOM_DUPEFILTER_ERROR_RATE = 1e-6   # false positive rate
+
+    Fingerprints are computed from canonical URLs (see
+    :func:`scrapy_memex.utils.url.canonicalize_url`): 'www' prefixes are
+    stripped, http and https URLs are the same and query arguments are
+    sorted, unless ``BLOOM_DUPEFILTER_STRIP_WWW`` or
+    ``BLOOM_DUPEFILTER_IGNORE_SCHEME`` are False. Query arguments listed
+    in ``BLOOM_DUPEFILTER_STRIP_PARAMS`` (e.g. ``['utm_*', 'sessionid']``)
+    are ignored. Method and body are a part of the fingerprint for
+    requests other than plain GETs, and Splash requests differ from
+    plain ones.
+
+    With JOBDIR the filter is kept in ``JOBDIR/bloomfilter`` (bit arrays
+    are mmapped files) and reopened when the crawl is resumed.
+    A false positive means a request is dropped, so the error rate should
+    be much lower than 1 / (number of requests).
+    """
+
+    def __init__(self, path=None, debug=False, capacity=1000000,
+                 error_rate=1e-6, canonicalize=None):
+        self.debug = debug
+        self.logdupes = True
+        self.canonicalize = canonicalize or canonical_url_function()
+        directory = os.path.join(path, 'bloomfilter') if path else None
+        self.fingerprints = ScalableBloomFilter(capacity, error_rate,
+                                                directory=directory)
+
+    @classmethod
+    def from_settings(cls, settings):
+        canonicalize = canonical_url_function(
+            strip_www=settings.getbool('BLOOM_DUPEFILTER_STRIP_WWW', True),
+            ignore_scheme=settings.getbool('BLOOM_DUPEFILTER_IGNORE_SCHEME',
+                                           True),
+            strip_params=settings.getlist('BLOOM_DUPEFILTER_STRIP_PARAMS'),
+        )
+        return cls(
+            path=job_dir(settings),
+            debug=settings.getbool('DUPEFILTER_DEBUG'),
+            capacity=settings.getint('BLOOM_DUPEFILTER_CAPACITY', 1000000),
+            error_rate=settings.getfloat('BLOOM_DUPEFILTER_ERROR_RATE', 1e-6),
+            canonicalize=canonicalize,
+        )
+
+    def request_seen(self, request):
+        return self.fingerprints.add(self.request_fingerprint(request))
+
+    def request_fingerprint(self, request):
+        """ Return the md5 digest identifying ``request`` """
+        fp = hashlib.md5(self.canonicalize(request.url))
+        if request.method != 'GET' or request.body:
+            fp.update(request.method)
+            fp.update(request.body)
+        if request.meta.get('splash'):
+            fp.update('splash')
+        return fp.digest()
+
+    def close(self, reason):
+        log.msg("Bloom dupefilter: %d requests, %.1f MB" % (
+            len(self.fingerprints),
+            self.fingerprints.num_bytes / 1024.0 / 1024), logging.INFO)
+        self.fingerprints.close()
+
+    def log(self, request, spider):
+        if self.debug:
+            log.msg("Filtered duplicate request: %s" % request,
+                    logging.DEBUG, spider=spider)
+        elif self.logdupes:
+            log.msg("Filtered duplicate request: %s - no more duplicates "
+                    "will be shown (see DUPEFILTER_DEBUG to show all "
+                    "duplicates)" % request, logging.DEBUG, spider=spider)
+            self.logdupes = False
+        spider.crawler.stats.inc_value('dupefilter/filtered', spider=spider)
@@ -0,0 +1,68 @@
+import codecs
+import json
+import uuid
+
+from scrapy.contrib.exporter import JsonLinesItemExporter
+from scrapy.item import BaseItem
+
+from scrapy_memex.utils.payload import PayloadRef, iter_payload
+
+
+class PayloadJsonLinesItemExporter(JsonLinesItemExporter):
+    """
+    JsonLinesItemExporter which can export items with spooled payloads
+    (:class:`scrapy_memex.utils.payload.PayloadRef` values, holding UTF-8
+    text). Payloads are streamed from disk into the output as JSON
+    strings instead of being loaded into memory.
+
+    Use it for feed exports with::
+
+        FEED_EXPORTERS = {
+            'jsonlines': 'scrapy_memex.exporters.PayloadJsonLinesItemExporter',
+        }
+
+    """
+
+    def export_item(self, item):
+        refs = {}
+        itemdict = self._replace_refs(
+            dict(self._get_serialized_fields(item)), refs
+        )
+        if not refs:
+            self.file.write(self.encoder.encode(itemdict) + '\n')
+            return
+
+        # Encode the item with placeholders and stream payloads in
+        # place of them.
+        encoded = self.encoder.encode(itemdict)
+        quoted = dict((json.dumps(p), ref) for p, ref in refs.iteritems())
+        pos = 0
+        for start, placeholder in sorted((encoded.index(p), p)
+                                         for p in quoted):
+            self.file.write(encoded[pos:start])
+            self._write_json_string(quoted[placeholder])
+            pos = start + len(placeholder)
+        self.file.write(encoded[pos:] + '\n')
+
+    def _replace_refs(self, value, refs):
+        if isinstance(value, PayloadRef):
+            placeholder = 'payload-%s' % uuid.uuid4().hex
+            refs[placeholder] = value
+            return placeholder
+        if isinstance(value, BaseItem):  # nested items
+            value = dict(value)
+        if isinstance(value, dict):
+            return dict((k, self._replace_refs(v, refs))
+                        for k, v in value.iteritems())
+        if isinstance(value, (list, tuple)):
+            return [self._replace_refs(v, refs) for v in value]
+        return value
+
+    def _write_json_string(self, ref):
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        self.file.write('"')
+        for chunk in iter_payload(ref):
+            text = decoder.decode(chunk)
+            self.file.write(json.dumps(text)[1:-1])
+        self.file.write(json.dumps(decoder.decode('', final=True))[1:-1])
+        self.file.write('"')
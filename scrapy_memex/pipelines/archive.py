@@ -0,0 +1,140 @@
+import logging
+import os
+import shutil
+from urlparse import urlparse
+
+from twisted.internet import defer, task
+
+from scrapy import log
+from scrapy.utils.project import data_path
+
+from scrapy_memex.utils.segments import SegmentWriter, format_locator
+
+
+class LocalSegmentStore(object):
+    """Publish finished segments by moving them into a local directory"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def url_for(self, keyname):
+        return 'file://' + self._path(keyname)
+
+    def publish(self, path, keyname):
+        dest = self._path(keyname)
+        if not os.path.exists(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest))
+        shutil.move(path, dest)
+        return defer.succeed(self.url_for(keyname))
+
+    def _path(self, keyname):
+        return os.path.join(self.directory, keyname.lstrip('/'))
+
+
+class S3SegmentStore(object):
+    """Publish finished segments through an S3Pipeline's upload pool"""
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self._bucket = None
+
+    def url_for(self, keyname):
+        # No request is made: get_bucket(validate=False) and
+        # generate_url(query_auth=False) only build the URL.
+        if self._bucket is None:
+            self._bucket = self.pipeline._connect()
+        key = self._bucket.new_key(keyname)
+        return key.generate_url(expires_in=0, query_auth=False)
+
+    def publish(self, path, keyname):
+        # Payload is streamed from disk; it doesn't count against the
+        # in-flight memory budget.
+        d = self.pipeline.uploader.upload(self.pipeline._store_file, 0,
+                                          keyname, path)
+        d.addCallback(self._remove, path)
+        return d
+
+    def _remove(self, url, path):
+        os.remove(path)
+        return url
+
+
+class SegmentArchive(object):
+    """
+    Archive mode for S3 pipelines: payloads are appended to rolling tar
+    segments which are uploaded once they are finished, instead of
+    storing one object per URL. :meth:`add` returns a ranged-read
+    locator (see :func:`scrapy_memex.utils.segments.format_locator`).
+
+    Settings::
+
+        S3_ARCHIVE_ENABLED = True
+        S3_ARCHIVE_DIR = None  # local staging dir; default .scrapy/s3archive
+        S3_ARCHIVE_MAX_SIZE = 256 * 1024 * 1024
+        S3_ARCHIVE_MAX_AGE = 600  # seconds
+
+    Target URIs with ``file://`` scheme are published to the local
+    filesystem, which is handy for testing.
+    """
+
+    def __init__(self, store, directory, keyprefix, name,
+                 max_size=256 * 1024 * 1024, max_age=600):
+        self.store = store
+        self.keyprefix = keyprefix
+        self.max_age = max_age
+        self.writer = SegmentWriter(directory, name, max_size, max_age,
+                                    on_close=self._publish)
+        self._publishing = set()
+        self._rotate_task = task.LoopingCall(self.writer.maybe_rotate)
+
+    @classmethod
+    def from_pipeline(cls, pipeline, settings, spider):
+        if urlparse(pipeline.uri).scheme == 'file':
+            store = LocalSegmentStore('/')
+        else:
+            store = S3SegmentStore(pipeline)
+        directory = settings.get('S3_ARCHIVE_DIR') or data_path('s3archive')
+        directory = os.path.join(directory, pipeline.STATS_PREFIX)
+        keyprefix = '%s/%s/%s/segments' % (pipeline.root, spider.name,
+                                           pipeline.time_str)
+        return cls(
+            store, directory, keyprefix, spider.name,
+            max_size=settings.getint('S3_ARCHIVE_MAX_SIZE',
+                                     256 * 1024 * 1024),
+            max_age=settings.getfloat('S3_ARCHIVE_MAX_AGE', 600),
+        )
+
+    def open(self):
+        self._rotate_task.start(max(1, min(self.max_age, 60)), now=False)
+
+    def add(self, key, name, data):
+        segment_name, offset, length = self.writer.append(key, name, data)
+        url = self.store.url_for(self._keyname(segment_name))
+        return format_locator(url, offset, length)
+
+    def close(self):
+        if self._rotate_task.running:
+            self._rotate_task.stop()
+        self.writer.close()
+        return defer.DeferredList(list(self._publishing))
+
+    def _keyname(self, segment_name):
+        return '%s/%s' % (self.keyprefix, segment_name)
+
+    def _publish(self, segment_path, index_path):
+        segment_name = os.path.basename(segment_path)
+        for path in (segment_path, index_path):
+            keyname = self._keyname(os.path.basename(path))
+            d = self.store.publish(path, keyname)
+            d.addErrback(self._publish_failed, path)
+            self._publishing.add(d)
+            d.addBoth(self._published, d)
+        log.msg("Closed archive segment %s" % segment_name, logging.DEBUG)
+
+    def _publish_failed(self, failure, path):
+        log.msg("Failed to publish archive segment %s (kept locally): %s" %
+                (path, failure.getErrorMessage()), logging.ERROR)
+
+    def _published(self, result, d):
+        self._publishing.discard(d)
+        return result
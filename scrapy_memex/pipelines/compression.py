@@ -0,0 +1,57 @@
+import gzip
+import tempfile
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from scrapy_memex.utils.payload import iter_payload, open_payload
+
+
+CHUNK_SIZE = 1024 * 1024
+ENCODINGS = ('gzip', 'zstd')
+
+
+def check_encoding(encoding):
+    if encoding not in ENCODINGS:
+        raise ValueError("Unsupported compression %r, use one of %s" %
+                         (encoding, ', '.join(ENCODINGS)))
+    if encoding == 'zstd' and zstandard is None:
+        raise ImportError("zstd compression requires 'zstandard' package")
+
+
+def payload_file(data, encoding=None, level=None):
+    """
+    Return a file object with ``data`` (a str or a PayloadRef),
+    compressed with ``encoding`` if it is set. Compressed output goes
+    to a temporary file chunk by chunk, so only the original payload is
+    held in memory; uncompressed payloads are wrapped without copying.
+    """
+    if encoding is None:
+        return open_payload(data)
+    f = tempfile.TemporaryFile()
+    chunks = iter_payload(data, CHUNK_SIZE)
+    if encoding == 'gzip':
+        gz = gzip.GzipFile(fileobj=f, mode='wb',
+                           compresslevel=level or 6)
+        for chunk in chunks:
+            gz.write(chunk)
+        gz.close()  # doesn't close the underlying file
+    elif encoding == 'zstd':
+        compressor = zstandard.ZstdCompressor(level=level or 3).compressobj()
+        for chunk in chunks:
+            f.write(compressor.compress(chunk))
+        f.write(compressor.flush())
+    else:
+        raise ValueError("Unsupported compression %r" % encoding)
+    f.seek(0)
+    return f
+
+
+def file_size(f):
+    pos = f.tell()
+    f.seek(0, 2)
+    size = f.tell()
+    f.seek(pos)
+    return size
@@ -0,0 +1,95 @@
+import hashlib
+import os
+import sqlite3
+
+from scrapy_memex.utils.payload import iter_payload
+
+
+def payload_digest(data):
+    """
+    >>> payload_digest('foo')
+    '0beec7b5ea3f0fdbc95d0dd47f3c5bc275da8a33'
+    """
+    digest = hashlib.sha1()
+    for chunk in iter_payload(data):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DigestIndex(object):
+    """
+    Persistent digest => URL mapping of payloads which are already stored,
+    backed by sqlite. ``namespace`` separates pipelines sharing one
+    database file (e.g. HTML and screenshots buckets).
+
+    Inserts are committed in batches of ``commit_every``; up to that many
+    most recent entries may be lost if the process is killed, which only
+    costs a duplicate upload.
+
+    Indexes on the same file share one connection: a second connection
+    would wait for the first one's open write transaction and fail with
+    "database is locked".
+
+    >>> html = DigestIndex(':memory:', 'html')
+    >>> screenshots = DigestIndex(':memory:', 'screenshots')
+    >>> html.add('d1', 'http://a'); screenshots.add('d1', 'http://b')
+    >>> html.get('d1'), screenshots.get('d1'), html.db is screenshots.db
+    (u'http://a', u'http://b', True)
+    >>> html.close(); screenshots.close()
+    """
+
+    _databases = {}  # path => [connection, number of indexes using it]
+
+    def __init__(self, path, namespace, commit_every=100):
+        self.path = path
+        self.namespace = namespace
+        self.commit_every = commit_every
+        self._uncommitted = 0
+        shared = self._databases.get(path)
+        if shared is None:
+            shared = self._databases[path] = [self._connect(path), 0]
+        shared[1] += 1
+        self.db = shared[0]
+
+    @staticmethod
+    def _connect(path):
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        db = sqlite3.connect(path)
+        db.execute('PRAGMA synchronous = OFF')
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS digests ('
+            ' namespace TEXT, digest TEXT, url TEXT,'
+            ' PRIMARY KEY (namespace, digest))'
+        )
+        db.commit()
+        return db
+
+    def get(self, digest):
+        row = self.db.execute(
+            'SELECT url FROM digests WHERE namespace = ? AND digest = ?',
+            (self.namespace, digest)
+        ).fetchone()
+        return row[0] if row else None
+
+    def add(self, digest, url):
+        self.db.execute(
+            'INSERT OR REPLACE INTO digests (namespace, digest, url) '
+            'VALUES (?, ?, ?)', (self.namespace, digest, url)
+        )
+        self._uncommitted += 1
+        if self._uncommitted >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self._uncommitted = 0
+
+    def close(self):
+        self.commit()
+        shared = self._databases[self.path]
+        shared[1] -= 1
+        if shared[1] == 0:
+            del self._databases[self.path]
+            self.db.close()
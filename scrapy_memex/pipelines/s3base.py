@@ -1,33 +1,224 @@
+import mimetypes
 import time
+from base64 import urlsafe_b64encode
 from urlparse import urlparse
 
-from twisted.internet.threads import deferToThread
+from twisted.internet import defer
 import boto
 
+from scrapy.utils.project import data_path
+
+from scrapy_memex.pipelines.archive import SegmentArchive
+from scrapy_memex.pipelines.compression import (
+    check_encoding, payload_file, file_size
+)
+from scrapy_memex.pipelines.dedup import DigestIndex, payload_digest
+from scrapy_memex.pipelines.uploader import UploadPool
+
 
 class S3Pipeline(object):
+    """
+    Base class for pipelines uploading item payloads to S3.
+
+    Optional compression and multipart upload settings::
+
+        S3_COMPRESSION = 'gzip'  # or 'zstd'; default is no compression
+        S3_COMPRESSION_LEVEL = None  # codec default
+        S3_MULTIPART_THRESHOLD = 16 * 1024 * 1024
+        S3_MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024  # S3 minimum is 5MB
+
+    Compression runs in upload threads, never in the reactor thread.
+    It isn't applied to archive segments (``S3_ARCHIVE_ENABLED``).
+
+    Payloads of items flagged by
+    :class:`scrapy_memex.spidermiddleware.neardup.NearDuplicateMiddleware`
+    can be skipped::
+
+        S3_SKIP_NEAR_DUPLICATES = True
+
+    Only items whose class declares a ``near_duplicate`` field
+    (``near_duplicate = scrapy.Field()``) are flagged; payloads of other
+    items are always uploaded.
+    """
+
+    STATS_PREFIX = 's3'
 
     @classmethod
     def from_crawler(cls, crawler):
-        return cls(crawler.settings)
+        return cls(crawler.settings, crawler.stats)
 
-    def __init__(self, settings):
+    def __init__(self, settings, stats=None):
         u = urlparse(self.uri)
-        bucketname = u.hostname
-        access_key = u.username or settings['AWS_ACCESS_KEY_ID']
-        secret_key = u.password or settings['AWS_SECRET_ACCESS_KEY']
-        conn = boto.connect_s3(access_key, secret_key)
+        self.bucketname = u.hostname
+        self.access_key = u.username or settings['AWS_ACCESS_KEY_ID']
+        self.secret_key = u.password or settings['AWS_SECRET_ACCESS_KEY']
         self.root = u.path
-        self.bucket = conn.get_bucket(bucketname, validate=False)
         self.time_str = time.strftime('%Y%m%d%H%M%S')
+        self.settings = settings
+        self.stats = stats
+        self.uploader = UploadPool.from_settings(settings, self._connect,
+                                                 stats, self.STATS_PREFIX)
+        self.archive_enabled = settings.getbool('S3_ARCHIVE_ENABLED', False)
+        self.archive = None
+        self.digests = None
+        if settings.getbool('S3_DEDUP_ENABLED', False):
+            path = settings.get('S3_DEDUP_DB') or data_path('s3dedup.db')
+            namespace = '%s%s' % (self.bucketname, self.root)
+            self.digests = DigestIndex(path, namespace)
+        self._pending_digests = {}  # digest => deferreds waiting for upload
+        self.compression = settings.get('S3_COMPRESSION') or None
+        if self.compression is not None:
+            check_encoding(self.compression)
+        self.compression_level = (settings.getint('S3_COMPRESSION_LEVEL') or
+                                  None)
+        self.multipart_threshold = settings.getint('S3_MULTIPART_THRESHOLD',
+                                                   16 * 1024 * 1024)
+        self.multipart_chunk_size = settings.getint('S3_MULTIPART_CHUNK_SIZE',
+                                                    8 * 1024 * 1024)
+        self.skip_near_duplicates = settings.getbool(
+            'S3_SKIP_NEAR_DUPLICATES', False)
+
+    def skip_item(self, item):
+        """ Return True if payloads of ``item`` shouldn't be uploaded """
+        if self.skip_near_duplicates and item.get('near_duplicate'):
+            if self.stats is not None:
+                self.stats.inc_value('%s/near_duplicate_skipped' %
+                                     self.STATS_PREFIX)
+            return True
+        return False
+
+    def open_spider(self, spider):
+        self.uploader.start()
+        if self.archive_enabled:
+            self.archive = SegmentArchive.from_pipeline(self, self.settings,
+                                                        spider)
+            self.archive.open()
+
+    @defer.inlineCallbacks
+    def close_spider(self, spider):
+        if self.archive is not None:
+            yield self.archive.close()
+        self.uploader.stop()
+        if self.digests is not None:
+            self.digests.close()
+            self._set_hit_rate()
 
-    def store(self, keyname, data):
-        return deferToThread(self._store, keyname, data)
+    def store_payload(self, spider, url, extension, data):
+        """
+        Store ``data`` downloaded from ``url``. Return a Deferred with
+        the URL of the stored object or, in archive mode, with
+        a ranged-read locator of the record.
 
-    def _store(self, keyname, data):
-        key = self.bucket.new_key(keyname)
-        key.set_contents_from_string(data)
+        With ``S3_DEDUP_ENABLED`` payloads are content-addressed: if the
+        same bytes were stored before (in this or a previous run, see
+        ``S3_DEDUP_DB``) the upload is skipped and the existing URL is
+        returned.
+        """
+        if self.digests is not None:
+            return self._store_unique_payload(spider, url, extension, data)
+        return self._store_payload(spider, url, extension, data)
+
+    @defer.inlineCallbacks
+    def _store_unique_payload(self, spider, url, extension, data):
+        digest = payload_digest(data)
+        stored_url = self.digests.get(digest)
+        while stored_url is None and digest in self._pending_digests:
+            # The same payload is being uploaded right now; if that upload
+            # fails, the first waiter uploads it and the others wait again
+            d = defer.Deferred()
+            self._pending_digests[digest].append(d)
+            stored_url = (yield d) or self.digests.get(digest)
+        if stored_url is not None:
+            self._inc_stats('dedup/hit_count')
+            self._inc_stats('dedup/bytes_saved', len(data))
+            defer.returnValue(stored_url)
+
+        self._inc_stats('dedup/miss_count')
+        waiters = self._pending_digests[digest] = []
+        try:
+            stored_url = yield self._store_payload(spider, url, extension,
+                                                   data)
+            self.digests.add(digest, stored_url)
+        finally:
+            if self._pending_digests.get(digest) is waiters:
+                del self._pending_digests[digest]
+            for d in waiters:
+                d.callback(stored_url)
+        defer.returnValue(stored_url)
+
+    def _store_payload(self, spider, url, extension, data):
+        filename = urlsafe_b64encode(url) + extension
+        if self.archive is not None:
+            return defer.succeed(self.archive.add(url, filename, data))
+        keyname = '%s/%s/%s/%s' % (
+            self.root, spider.name, self.time_str, filename
+        )
+        content_type, _ = mimetypes.guess_type(filename)
+        return self.store(keyname, data, content_type)
+
+    def store(self, keyname, data, content_type=None):
+        return self.uploader.upload(self._store, len(data), keyname, data,
+                                    content_type)
+
+    def _connect(self):
+        # Called once per upload thread (connections are not thread-safe)
+        conn = boto.connect_s3(self.access_key, self.secret_key)
+        return conn.get_bucket(self.bucketname, validate=False)
+
+    def _store(self, bucket, keyname, data, content_type=None):
+        headers = {}
+        if content_type is not None:
+            headers['Content-Type'] = content_type
+        if self.compression is not None:
+            headers['Content-Encoding'] = self.compression
+        fp = payload_file(data, self.compression, self.compression_level)
+        try:
+            if file_size(fp) >= self.multipart_threshold:
+                self._store_multipart(bucket, keyname, fp, headers)
+                key = bucket.new_key(keyname)
+            else:
+                key = bucket.new_key(keyname)
+                key.set_contents_from_file(fp, headers=headers)
+                key.set_acl('public-read')
+                key.close()
+        finally:
+            fp.close()
+        url = key.generate_url(expires_in=0, query_auth=False)
+        return url
+
+    def _store_multipart(self, bucket, keyname, fp, headers):
+        size = file_size(fp)
+        upload = bucket.initiate_multipart_upload(keyname, headers=headers,
+                                                  policy='public-read')
+        try:
+            part_num = 0
+            while fp.tell() < size:
+                part_num += 1
+                chunk_size = min(self.multipart_chunk_size, size - fp.tell())
+                upload.upload_part_from_file(fp, part_num, size=chunk_size)
+            upload.complete_upload()
+        except Exception:
+            upload.cancel_upload()
+            raise
+
+    def _store_file(self, bucket, keyname, path):
+        key = bucket.new_key(keyname)
+        key.set_contents_from_filename(path)
         key.set_acl('public-read')
         key.close()
         url = key.generate_url(expires_in=0, query_auth=False)
         return url
+
+    def _inc_stats(self, name, count=1):
+        if self.stats is not None:
+            self.stats.inc_value('%s/%s' % (self.STATS_PREFIX, name), count)
+
+    def _set_hit_rate(self):
+        if self.stats is None:
+            return
+        prefix = '%s/dedup' % self.STATS_PREFIX
+        hits = self.stats.get_value('%s/hit_count' % prefix, 0)
+        misses = self.stats.get_value('%s/miss_count' % prefix, 0)
+        if hits + misses:
+            self.stats.set_value('%s/hit_rate' % prefix,
+                                 round(float(hits) / (hits + misses), 4))
@@ -0,0 +1,172 @@
+import logging
+import multiprocessing
+import traceback
+from io import BytesIO
+
+from PIL import Image
+from twisted.internet import defer, reactor
+
+from scrapy import log
+
+from scrapy_memex.utils.payload import PayloadRef
+
+
+def transcode(image_file, format, quality, max_size=None,
+              thumbnail_size=None):
+    """
+    Convert image from ``image_file`` (a filename or a file object) to
+    ``format``, downscaling it to fit into ``max_size`` (width, height)
+    if needed. If ``thumbnail_size`` is set return a thumbnail as well.
+    Return (image_data, thumbnail_data).
+    """
+    image = Image.open(image_file)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    if max_size:
+        image.thumbnail(max_size, Image.ANTIALIAS)
+    thumbnail = None
+    if thumbnail_size:
+        thumb = image.copy()
+        thumb.thumbnail(thumbnail_size, Image.ANTIALIAS)
+        thumbnail = _save(thumb, format, quality)
+    return _save(image, format, quality), thumbnail
+
+
+def _save(image, format, quality):
+    out = BytesIO()
+    image.save(out, format, quality=quality)
+    return out.getvalue()
+
+
+def _transcode_in_worker(path, data, args):
+    # Exceptions are passed back as a value because Pool.apply_async
+    # has no error callback in Python 2.
+    try:
+        return True, transcode(path or BytesIO(data), *args)
+    except Exception:
+        return False, traceback.format_exc()
+
+
+class TranscodeScreenshotsPipeline(object):
+    """
+    Transcode screenshots (``item['png']``) before they are uploaded by
+    UploadScreenshotsPipeline; it should have a lower order number::
+
+        ITEM_PIPELINES = {
+            'scrapy_memex.pipelines.transcodescreenshots.TranscodeScreenshotsPipeline': 90,
+            'scrapy_memex.pipelines.uploadscreenshots.UploadScreenshotsPipeline': 100,
+        }
+        SCREENSHOT_FORMAT = 'JPEG'  # or 'WEBP'
+        SCREENSHOT_QUALITY = 80
+        SCREENSHOT_MAX_SIZE = None  # e.g. (1280, 10000)
+        SCREENSHOT_THUMBNAIL_SIZE = None  # e.g. (320, 240)
+        SCREENSHOT_KEEP_ORIGINAL = False
+        SCREENSHOT_PROCESSES = None  # default is the number of CPUs
+        SCREENSHOT_TRANSCODE_TIMEOUT = 60  # seconds
+
+    Images are converted in a process pool, so the reactor is never
+    blocked. Thumbnails are stored in ``item['screenshot_thumbnail']``
+    and originals in ``item['screenshot_original']``; items must declare
+    these fields when the corresponding options are enabled.
+    Screenshots which fail to transcode, or are not transcoded in
+    ``SCREENSHOT_TRANSCODE_TIMEOUT`` seconds (e.g. because the worker
+    died: the pool replaces it but the task is lost), are left untouched.
+    If tasks are still lost when the spider closes, the pool is terminated
+    instead of waiting for them.
+    """
+
+    def __init__(self, settings, stats=None):
+        self.format = settings.get('SCREENSHOT_FORMAT', 'JPEG').upper()
+        self.quality = settings.getint('SCREENSHOT_QUALITY', 80)
+        self.max_size = self._size(settings.getlist('SCREENSHOT_MAX_SIZE'))
+        self.thumbnail_size = self._size(
+            settings.getlist('SCREENSHOT_THUMBNAIL_SIZE')
+        )
+        self.keep_original = settings.getbool('SCREENSHOT_KEEP_ORIGINAL',
+                                              False)
+        self.processes = settings.getint('SCREENSHOT_PROCESSES') or None
+        self.timeout = settings.getfloat('SCREENSHOT_TRANSCODE_TIMEOUT', 60)
+        self.stats = stats
+        self.pool = None
+        # Deferreds of tasks which timed out and have no result yet
+        self._lost = set()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings, crawler.stats)
+
+    def open_spider(self, spider):
+        self.pool = multiprocessing.Pool(self.processes)
+
+    def close_spider(self, spider):
+        if self._lost:
+            # Pool.join() waits for lost tasks forever
+            log.msg("Terminating screenshot transcoding pool: %d tasks "
+                    "timed out" % len(self._lost), logging.WARNING)
+            self.pool.terminate()
+        else:
+            self.pool.close()
+            self.pool.join()
+
+    @defer.inlineCallbacks
+    def process_item(self, item, spider):
+        png = item.get('png')
+        if png is None:
+            defer.returnValue(item)
+
+        args = (self.format, self.quality, self.max_size,
+                self.thumbnail_size)
+        ok, result = yield self._run(png, args)
+        if not ok:
+            log.msg("Can't transcode screenshot of %s:\n%s" %
+                    (item.get('url'), result), logging.WARNING)
+            self._inc_stats('screenshots/transcode_failed_count')
+            defer.returnValue(item)
+
+        image, thumbnail = result
+        if self.keep_original:
+            item['screenshot_original'] = png
+        if thumbnail is not None:
+            item['screenshot_thumbnail'] = thumbnail
+        item['png'] = image
+        self._inc_stats('screenshots/transcoded_count')
+        self._inc_stats('screenshots/original_bytes', len(png))
+        self._inc_stats('screenshots/transcoded_bytes', len(image))
+        defer.returnValue(item)
+
+    def _run(self, png, args):
+        # Spooled screenshots are read by workers from disk; PayloadRef
+        # itself must not be sent because it removes the file when the
+        # worker's copy is garbage collected.
+        if isinstance(png, PayloadRef):
+            worker_args = (png.path, None, args)
+        else:
+            worker_args = (None, png, args)
+        d = defer.Deferred()
+        timeout_call = reactor.callLater(
+            self.timeout, self._finish, d, None,
+            (False, 'Timed out after %s seconds' % self.timeout))
+        # The callback is called in a pool's result handler thread
+        self.pool.apply_async(
+            _transcode_in_worker, worker_args,
+            callback=lambda result: reactor.callFromThread(
+                self._finish, d, timeout_call, result)
+        )
+        return d
+
+    def _finish(self, d, timeout_call, result):
+        if d.called:  # timed out before
+            self._lost.discard(d)
+            return
+        if timeout_call is not None:
+            timeout_call.cancel()
+        else:
+            self._lost.add(d)
+        d.callback(result)
+
+    def _size(self, value):
+        return tuple(int(v) for v in value) if value else None
+
+    def _inc_stats(self, name, count=1):
+        if self.stats is not None:
+            self.stats.inc_value(name, count)
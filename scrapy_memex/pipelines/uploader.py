@@ -0,0 +1,188 @@
+import logging
+import threading
+import time
+from collections import deque
+
+from twisted.internet import defer, reactor, task
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+from scrapy import log
+
+
+class UploadPool(object):
+    """
+    Dedicated executor for S3 uploads.
+
+    Uploads run in their own threadpool instead of the reactor's default
+    one, so slow PUTs can't starve DNS resolution and other threaded work.
+    Every worker thread lazily opens its own connection with ``connect``
+    (boto connections are not thread-safe). The total size of payloads
+    waiting for or being uploaded is capped by ``max_inflight_bytes``:
+    :meth:`upload` doesn't fire until there is room, which pushes
+    backpressure into the item pipeline. Failed uploads are retried with
+    exponential backoff.
+
+    Settings::
+
+        S3_UPLOAD_POOL_SIZE = 10
+        S3_UPLOAD_MAX_INFLIGHT_BYTES = 64 * 1024 * 1024
+        S3_UPLOAD_MAX_RETRIES = 3
+        S3_UPLOAD_RETRY_BACKOFF = 1.0  # seconds, doubled on every retry
+        S3_UPLOAD_STATS_INTERVAL = 60
+
+    """
+
+    def __init__(self, connect, pool_size=10,
+                 max_inflight_bytes=64 * 1024 * 1024, max_retries=3,
+                 retry_backoff=1.0, stats=None, stats_prefix='s3',
+                 stats_interval=60):
+        self.connect = connect
+        self.max_inflight_bytes = max_inflight_bytes
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.stats = stats
+        self.stats_prefix = stats_prefix
+        self.stats_interval = stats_interval
+        self.threadpool = ThreadPool(minthreads=1, maxthreads=pool_size,
+                                     name=stats_prefix)
+        self.inflight_bytes = 0
+        self.queue_depth = 0
+        self.upload_count = 0
+        self._waiting = deque()  # (deferred, nbytes) waiting for room
+        self._local = threading.local()
+        self._last_count = 0
+        self._last_time = None
+        self._rate_task = task.LoopingCall(self._log_rate)
+
+    @classmethod
+    def from_settings(cls, settings, connect, stats=None, stats_prefix='s3'):
+        return cls(
+            connect,
+            pool_size=settings.getint('S3_UPLOAD_POOL_SIZE', 10),
+            max_inflight_bytes=settings.getint('S3_UPLOAD_MAX_INFLIGHT_BYTES',
+                                               64 * 1024 * 1024),
+            max_retries=settings.getint('S3_UPLOAD_MAX_RETRIES', 3),
+            retry_backoff=settings.getfloat('S3_UPLOAD_RETRY_BACKOFF', 1.0),
+            stats=stats,
+            stats_prefix=stats_prefix,
+            stats_interval=settings.getfloat('S3_UPLOAD_STATS_INTERVAL', 60),
+        )
+
+    def start(self):
+        self.threadpool.start()
+        self._last_time = time.time()
+        self._rate_task.start(self.stats_interval, now=False)
+
+    def stop(self):
+        if self._rate_task.running:
+            self._rate_task.stop()
+        self._log_rate()
+        self.threadpool.stop()
+
+    @defer.inlineCallbacks
+    def upload(self, func, nbytes, *args, **kwargs):
+        """
+        Call ``func(bucket, *args, **kwargs)`` in the upload threadpool
+        once ``nbytes`` fit into the in-flight budget. Return a Deferred
+        with the result of ``func``.
+        """
+        self._update_depth(1)
+        try:
+            yield self._acquire(nbytes)
+            try:
+                result = yield self._call_with_retries(func, *args, **kwargs)
+            finally:
+                self._release(nbytes)
+        finally:
+            self._update_depth(-1)
+        self.upload_count += 1
+        self._inc_stats('upload_count')
+        self._inc_stats('upload_bytes', nbytes)
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def _call_with_retries(self, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                result = yield deferToThreadPool(reactor, self.threadpool,
+                                                 self._call, func,
+                                                 *args, **kwargs)
+            except Exception as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    self._inc_stats('upload_failed_count')
+                    raise
+                delay = self.retry_backoff * 2 ** (attempt - 1)
+                log.msg("S3 upload failed (%s), retrying in %0.1fs "
+                        "(attempt %d of %d)" %
+                        (e, delay, attempt, self.max_retries),
+                        logging.WARNING)
+                self._inc_stats('upload_retry_count')
+                yield task.deferLater(reactor, delay, lambda: None)
+            else:
+                defer.returnValue(result)
+
+    def _call(self, func, *args, **kwargs):
+        # Runs in a worker thread
+        bucket = getattr(self._local, 'bucket', None)
+        if bucket is None:
+            bucket = self._local.bucket = self.connect()
+        try:
+            return func(bucket, *args, **kwargs)
+        except Exception:
+            # Don't reuse a connection which may be in a broken state
+            self._local.bucket = None
+            raise
+
+    def _acquire(self, nbytes):
+        # A payload larger than the whole budget is still let through
+        # when nothing else is in flight, otherwise it would wait forever.
+        if not self._waiting and self._has_room(nbytes):
+            self._set_inflight(nbytes)
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._waiting.append((d, nbytes))
+        return d
+
+    def _release(self, nbytes):
+        self._set_inflight(-nbytes)
+        while self._waiting and self._has_room(self._waiting[0][1]):
+            d, waiting_nbytes = self._waiting.popleft()
+            self._set_inflight(waiting_nbytes)
+            d.callback(None)
+
+    def _has_room(self, nbytes):
+        return (self.inflight_bytes == 0 or
+                self.inflight_bytes + nbytes <= self.max_inflight_bytes)
+
+    def _set_inflight(self, delta):
+        self.inflight_bytes += delta
+        if self.stats is not None:
+            key = '%s/inflight_bytes' % self.stats_prefix
+            self.stats.set_value(key, self.inflight_bytes)
+            self.stats.max_value('%s/max_inflight_bytes' % self.stats_prefix,
+                                 self.inflight_bytes)
+
+    def _update_depth(self, delta):
+        self.queue_depth += delta
+        if self.stats is not None:
+            self.stats.set_value('%s/queue_depth' % self.stats_prefix,
+                                 self.queue_depth)
+            self.stats.max_value('%s/max_queue_depth' % self.stats_prefix,
+                                 self.queue_depth)
+
+    def _log_rate(self):
+        now = time.time()
+        if self._last_time is None or now <= self._last_time:
+            return
+        rate = (self.upload_count - self._last_count) / (now - self._last_time)
+        self._last_count, self._last_time = self.upload_count, now
+        if self.stats is not None:
+            self.stats.set_value('%s/uploads_per_sec' % self.stats_prefix,
+                                 round(rate, 2))
+
+    def _inc_stats(self, name, count=1):
+        if self.stats is not None:
+            self.stats.inc_value('%s/%s' % (self.stats_prefix, name), count)
@@ -1,25 +1,32 @@
-from base64 import urlsafe_b64encode
-
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from scrapy_memex.pipelines.s3base import S3Pipeline
+from scrapy_memex.utils.payload import PayloadRef
 
 
 class UploadHtmlPipeline(S3Pipeline):
-    def __init__(self, settings):
+    STATS_PREFIX = 's3/html'
+
+    def __init__(self, settings, stats=None):
         self.uri = settings.get('S3_HTML_PATH')
-        super(UploadHtmlPipeline, self).__init__(settings)
+        super(UploadHtmlPipeline, self).__init__(settings, stats)
 
     @inlineCallbacks
     def process_item(self, item, spider):
-        if 'html' not in item:
+        if 'html' not in item or self.skip_item(item):
             returnValue(item)
-        html_utf8 = item['html'].encode('utf-8')
-        filename = urlsafe_b64encode(item['url']) + '.html'
-        keyname = '%s/%s/%s/%s' % (
-            self.root, spider.name, self.time_str, filename
-        )
-        url = yield self.store(keyname, html_utf8)
-        del item['html']
+        # Drop the unicode copy before the upload starts
+        html_utf8 = item.pop('html')
+        spooled = isinstance(html_utf8, PayloadRef)  # spooled as utf-8
+        if not spooled:
+            html_utf8 = html_utf8.encode('utf-8')
+        try:
+            url = yield self.store_payload(spider, item['url'], '.html',
+                                           html_utf8)
+        except Exception:
+            # keep the HTML in the item for later pipelines and exporters
+            item['html'] = (html_utf8 if spooled
+                            else html_utf8.decode('utf-8'))
+            raise
         item['html_url'] = url
         returnValue(item)
@@ -1,27 +1,58 @@
-from base64 import urlsafe_b64encode
-
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from scrapy_memex.pipelines.s3base import S3Pipeline
+from scrapy_memex.utils.payload import payload_head
+
+
+def image_extension(data):
+    """
+    Guess image file extension from its magic bytes.
+
+    >>> image_extension('\\x89PNG\\r\\n\\x1a\\n...')
+    '.png'
+    >>> image_extension('\\xff\\xd8\\xff\\xe0...')
+    '.jpg'
+    >>> image_extension('RIFF\\x00\\x00\\x00\\x00WEBPVP8 ')
+    '.webp'
+    """
+    if data.startswith('\xff\xd8\xff'):
+        return '.jpg'
+    if data.startswith('RIFF') and data[8:12] == 'WEBP':
+        return '.webp'
+    return '.png'
 
 
 class UploadScreenshotsPipeline(S3Pipeline):
+    """
+    Upload screenshots from ``item['png']`` (which may be transcoded to
+    another format by TranscodeScreenshotsPipeline) and, if present,
+    thumbnails and original screenshots.
+    """
 
-    def __init__(self, settings):
+    STATS_PREFIX = 's3/screenshots'
+
+    # item field => (field to store URL in, key suffix)
+    PAYLOAD_FIELDS = [
+        ('png', 'screenshot_url', ''),
+        ('screenshot_thumbnail', 'screenshot_thumbnail_url', '.thumb'),
+        ('screenshot_original', 'screenshot_original_url', '.orig'),
+    ]
+
+    def __init__(self, settings, stats=None):
         self.uri = settings.get('S3_SCREENSHOTS_PATH')
-        super(UploadScreenshotsPipeline, self).__init__(settings)
+        super(UploadScreenshotsPipeline, self).__init__(settings, stats)
 
     @inlineCallbacks
     def process_item(self, item, spider):
-        png = item.get('png')
-        if png is None:
+        if self.skip_item(item):
             returnValue(item)
-
-        keyname = '%s/%s/%s/%s' % (
-            self.root, spider.name, self.time_str,
-            urlsafe_b64encode(item['url']) + '.png'
-        )
-        url = yield self.store(keyname, png)
-        del item['png']
-        item['screenshot_url'] = url
+        for field, url_field, suffix in self.PAYLOAD_FIELDS:
+            data = item.get(field)
+            if data is None:
+                continue
+            extension = suffix + image_extension(payload_head(data, 12))
+            url = yield self.store_payload(spider, item['url'], extension,
+                                           data)
+            del item[field]
+            item[url_field] = url
         returnValue(item)
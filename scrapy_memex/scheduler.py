@@ -0,0 +1,151 @@
+import cPickle as pickle
+import logging
+import os
+import tempfile
+import time
+
+from scrapy import log
+from scrapy.utils.job import job_dir
+from scrapy.utils.misc import load_object
+from scrapy.utils.reqser import request_from_dict, request_to_dict
+
+from scrapy_memex.utils.frontier import HostFrontier
+
+
+class HostFrontierScheduler(object):
+    """
+    Scheduler for broad crawls which keeps pending requests on disk in
+    per-host queues (see :class:`scrapy_memex.utils.frontier.HostFrontier`)
+    and only returns requests whose download slot can fetch now::
+
+        SCHEDULER = 'scrapy_memex.scheduler.HostFrontierScheduler'
+        FRONTIER_HOT_WINDOW = 10000  # requests kept in memory
+        FRONTIER_BATCH_SIZE = 16     # requests read from disk at once per host
+
+    Requests are queued per download slot key (the host, or the
+    ``download_slot`` meta key). After a request is taken, its slot is
+    ready again after the slot delay (including delays set by
+    :class:`RobotsCrawlDelayMiddleware` and
+    :class:`AdaptiveThrottleMiddleware`); slots with requests waiting in
+    the downloader are skipped. Priorities order requests within a host;
+    hosts are taken in the order they become ready.
+
+    The queue database is ``JOBDIR/frontier.db`` when JOBDIR is set and a
+    temporary file otherwise. Requests which can't be serialized (e.g.
+    with callbacks which are not spider methods) are kept in memory and
+    are lost when the crawl is resumed.
+    """
+
+    def __init__(self, crawler, dupefilter, jobdir=None, hot_window=10000,
+                 batch_size=16, min_wait=0.1, logunser=False):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.df = dupefilter
+        self.jobdir = jobdir
+        self.hot_window = hot_window
+        self.batch_size = batch_size
+        self.min_wait = min_wait
+        self.logunser = logunser
+        self.default_delay = crawler.settings.getfloat('DOWNLOAD_DELAY')
+        self.frontier = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        dupefilter_cls = load_object(settings['DUPEFILTER_CLASS'])
+        return cls(
+            crawler,
+            dupefilter=dupefilter_cls.from_settings(settings),
+            jobdir=job_dir(settings),
+            hot_window=settings.getint('FRONTIER_HOT_WINDOW', 10000),
+            batch_size=settings.getint('FRONTIER_BATCH_SIZE', 16),
+            min_wait=settings.getfloat('FRONTIER_MIN_WAIT', 0.1),
+            logunser=settings.getbool('LOG_UNSERIALIZABLE_REQUESTS'),
+        )
+
+    def has_pending_requests(self):
+        return len(self) > 0
+
+    def open(self, spider):
+        self.spider = spider
+        if self.jobdir:
+            self.path = os.path.join(self.jobdir, 'frontier.db')
+        else:
+            fd, self.path = tempfile.mkstemp(prefix='frontier-', suffix='.db')
+            os.close(fd)
+        self.frontier = HostFrontier(
+            self.path, serialize=self._serialize,
+            deserialize=self._deserialize, delay=self._delay,
+            wait=self._wait, hot_window=self.hot_window,
+            batch_size=self.batch_size)
+        if self.frontier:
+            log.msg("Resuming crawl (%d requests scheduled)" %
+                    len(self.frontier), spider=spider)
+        return self.df.open()
+
+    def close(self, reason):
+        self.stats.set_value('frontier/hosts', len(self.frontier.hosts),
+                             spider=self.spider)
+        self.frontier.close(persist=bool(self.jobdir))
+        if not self.jobdir:
+            os.remove(self.path)
+        return self.df.close(reason)
+
+    def enqueue_request(self, request):
+        if not request.dont_filter and self.df.request_seen(request):
+            self.df.log(request, self.spider)
+            return False
+        key = self.crawler.engine.downloader._get_slot_key(request,
+                                                           self.spider)
+        self.frontier.push(key, request, request.priority)
+        self.stats.inc_value('scheduler/enqueued', spider=self.spider)
+        self.stats.max_value('frontier/hot_max', self.frontier.hot_count,
+                             spider=self.spider)
+        return True
+
+    def next_request(self):
+        request = self.frontier.pop()
+        if request is not None:
+            self.stats.inc_value('scheduler/dequeued', spider=self.spider)
+        elif self.frontier:
+            self.stats.inc_value('frontier/wait_count', spider=self.spider)
+            self._wake_engine()
+        return request
+
+    def __len__(self):
+        return len(self.frontier) if self.frontier is not None else 0
+
+    def _wake_engine(self):
+        """ Ask the engine for the next request when a host is ready """
+        ready = self.frontier.next_ready_time()
+        slot = getattr(self.crawler.engine, 'slot', None)
+        if ready is not None and slot is not None:
+            slot.nextcall.schedule(max(ready - time.time(), 0))
+
+    def _delay(self, key):
+        slot = self.crawler.engine.downloader.slots.get(key)
+        return slot.delay if slot is not None else self.default_delay
+
+    def _wait(self, key, now):
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is None:
+            return 0
+        if slot.queue and len(slot.queue) >= slot.free_transfer_slots():
+            return max(slot.delay, self.min_wait)
+        if slot.delay:
+            return slot.lastseen + slot.delay - now
+        return 0
+
+    def _serialize(self, request):
+        try:
+            return pickle.dumps(request_to_dict(request, self.spider),
+                                protocol=2)
+        except (ValueError, TypeError, pickle.PicklingError) as e:
+            if self.logunser:
+                log.msg("Unable to serialize request: %s - reason: %s" %
+                        (request, e), logging.ERROR, spider=self.spider)
+            self.stats.inc_value('scheduler/unserializable',
+                                 spider=self.spider)
+
+    def _deserialize(self, data):
+        return request_from_dict(pickle.loads(data), self.spider)
@@ -1,17 +1,55 @@
+import os
 import random
-from collections import defaultdict
 
 import scrapy
+from scrapy import signals
+from scrapy.utils.job import job_dir
 
-from scrapy_memex.utils.url import is_external_url, get_domain
-from scrapy_memex.utils.lists import split_list
+from scrapy_memex.utils.counters import CountMinSketch, DictCounter
+from scrapy_memex.utils.url import (
+    external_url_checker, get_domain, load_public_suffix_list
+)
+from scrapy_memex.utils.lists import Reservoir, split_list
 
 
 class BroadCrawlLimitsMiddleware(object):
+    """
+    Spider middleware that limits the number of internal and external
+    links followed from every page and the number of links followed to
+    every domain.
+
+    Per-domain counts are exact by default; on very broad crawls use
+    a Count-Min sketch with fixed memory instead (see
+    :class:`scrapy_memex.utils.counters.CountMinSketch` for error
+    bounds; counts can only be overestimated)::
+
+        BCL_DOMAIN_COUNTER = 'countmin'  # default is 'dict'
+        BCL_COUNTMIN_MEMORY = 16 * 1024 * 1024  # bytes
+        BCL_COUNTMIN_DEPTH = 4
+
+    Links are external when their registered domains (without public
+    suffixes) differ. A small built-in public suffix list is used unless
+    ``BCL_PUBLIC_SUFFIX_LIST`` points to a full ``public_suffix_list.dat``.
+
+    When JOBDIR is set, counts are saved there when the spider is closed
+    and restored when the crawl is resumed.
+
+    With ``BCL_STREAMING = True`` spider output is processed lazily: items
+    are passed through immediately and requests are limited as they come.
+    If ``BCL_RANDOMIZE_LINKS`` is also set, links are picked by reservoir
+    sampling, so only ``BCL_MAX_INTERNAL_LINKS + BCL_MAX_EXTERNAL_LINKS``
+    requests per page are kept in memory (they are yielded after the page
+    output is exhausted); per-request ``max_*_links`` meta keys can only
+    lower the limits in this mode.
+    """
+
+    COUNTERS_FILENAME = 'bcl_domain_counts'
 
     @classmethod
     def from_crawler(cls, crawler):
-        return cls(crawler.settings)
+        mw = cls(crawler.settings)
+        crawler.signals.connect(mw.spider_closed, signal=signals.spider_closed)
+        return mw
 
     def __init__(self, settings):
         self.max_internal_links = settings.getint('BCL_MAX_INTERNAL_LINKS', 10)
@@ -19,13 +57,44 @@ class BroadCrawlLimitsMiddleware(object):
         self.max_links_per_domain = settings.getint('BCL_MAX_LINKS_PER_DOMAIN',
                                                     10)
         self.randomize_links = settings.getbool('BCL_RANDOMIZE_LINKS', False)
-        self.random_seed = settings.getbool('BCL_RANDOM_SEED', 0)
+        self.random_seed = settings.getint('BCL_RANDOM_SEED', 0)
+        self.streaming = settings.getbool('BCL_STREAMING', False)
+        if settings.get('BCL_PUBLIC_SUFFIX_LIST'):
+            load_public_suffix_list(settings.get('BCL_PUBLIC_SUFFIX_LIST'))
         self.random = random.Random(self.random_seed)
-        self.links_per_domain_counts = defaultdict(int)
+        self.counters_path = None
+        if job_dir(settings):
+            self.counters_path = os.path.join(job_dir(settings),
+                                              self.COUNTERS_FILENAME)
+        self.links_per_domain_counts = self._create_counter(settings)
+
+    def _create_counter(self, settings):
+        backend = settings.get('BCL_DOMAIN_COUNTER', 'dict')
+        if backend == 'dict':
+            counter_cls = DictCounter
+        elif backend == 'countmin':
+            counter_cls = CountMinSketch
+        else:
+            raise ValueError("Unknown BCL_DOMAIN_COUNTER: %r" % backend)
+
+        if self.counters_path and os.path.exists(self.counters_path):
+            return counter_cls.load(self.counters_path)
+        if counter_cls is CountMinSketch:
+            return CountMinSketch.from_memory(
+                settings.getint('BCL_COUNTMIN_MEMORY', 16 * 1024 * 1024),
+                settings.getint('BCL_COUNTMIN_DEPTH', 4),
+            )
+        return DictCounter()
+
+    def spider_closed(self, spider):
+        if self.counters_path:
+            self.links_per_domain_counts.save(self.counters_path)
 
     def process_spider_output(self, response, result, spider):
         if response.meta.get('skip_broad_crawl_limits'):
             return result
+        if self.streaming:
+            return self._process_streaming(response, result)
         requests, items = split_list(result,
                                      lambda r: isinstance(r, scrapy.Request))
         if self.randomize_links:
@@ -35,33 +104,72 @@ class BroadCrawlLimitsMiddleware(object):
 
         return list(requests) + list(items)
 
+    def _process_streaming(self, response, result):
+        if self.randomize_links:
+            for r in self._process_streaming_random(response, result):
+                yield r
+            return
+        fits_links_count = self._links_count_checker(response)
+        for r in result:
+            if not isinstance(r, scrapy.Request):
+                yield r
+            elif fits_links_count(r) and self._fits_domain_limit(r):
+                yield r
+
+    def _process_streaming_random(self, response, result):
+        # Only as many requests as the limits allow are kept per page
+        external = Reservoir(self.max_external_links, self.random)
+        internal = Reservoir(self.max_internal_links, self.random)
+        is_external = external_url_checker(response.url)
+        for r in result:
+            if not isinstance(r, scrapy.Request):
+                yield r
+            elif is_external(r.url):
+                external.add(r)
+            else:
+                internal.add(r)
+        requests = self._randomize_requests(external.items + internal.items)
+        requests = self._filter_links_count(requests, response)
+        for r in self._filter_domain_limit(requests):
+            yield r
+
     def _randomize_requests(self, requests):
-        return self.random.shuffle(requests)
+        self.random.shuffle(requests)
+        return requests
 
     def _filter_domain_limit(self, requests):
-        for r in requests:
-            domain = get_domain(r.url)
-            doesnt_exceeds_domain_limit = (
-                self.links_per_domain_counts[domain] <
-                self.max_links_per_domain
-            )
-            if doesnt_exceeds_domain_limit:
-                self.links_per_domain_counts[domain] += 1
-                yield r
+        return (r for r in requests if self._fits_domain_limit(r))
+
+    def _fits_domain_limit(self, request):
+        domain = get_domain(request.url)
+        if self.links_per_domain_counts[domain] < self.max_links_per_domain:
+            self.links_per_domain_counts.increment(domain)
+            return True
+        return False
 
     def _filter_links_count(self, requests, response):
-        external_links_count = 0
-        internal_links_count = 0
-        for r in requests:
-            max_external_links = r.meta.get('max_external_links',
-                                            self.max_external_links)
-            max_internal_links = r.meta.get('max_internal_links',
-                                            self.max_internal_links)
-            if is_external_url(response.url, r.url):
-                if external_links_count < max_external_links:
-                    yield r
-                external_links_count += 1
+        fits_links_count = self._links_count_checker(response)
+        return (r for r in requests if fits_links_count(r))
+
+    def _links_count_checker(self, response):
+        """
+        Return a function which tells if a request from ``response``
+        fits into per-page limits; it must be called for every request
+        in order.
+        """
+        counts = {'external': 0, 'internal': 0}
+        is_external = external_url_checker(response.url)
+
+        def fits_links_count(r):
+            if is_external(r.url):
+                kind = 'external'
+                limit = r.meta.get('max_external_links',
+                                   self.max_external_links)
             else:
-                if internal_links_count < max_internal_links:
-                    yield r
-                internal_links_count += 1
+                kind = 'internal'
+                limit = r.meta.get('max_internal_links',
+                                   self.max_internal_links)
+            fits = counts[kind] < limit
+            counts[kind] += 1
+            return fits
+        return fits_links_count
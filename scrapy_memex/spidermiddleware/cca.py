@@ -1,22 +1,73 @@
+import base64
+import logging
+
 from scrapy_memex_api.convert import response2cca
+from scrapy import log, signals
 from scrapy.item import Item, DictItem, Field
 from scrapy.exceptions import NotConfigured
-from scrapy.contrib.exporter import JsonLinesItemExporter
 from scrapy.utils.project import data_path
 
+from scrapy_memex.utils.ccabodies import (
+    BodyStore, find_path, get_path, set_path
+)
+from scrapy_memex.utils.itemwriter import BackgroundItemWriter
+from scrapy_memex.utils.payload import PayloadSpool
+
 
 class CcaMiddleware(object):
+    """
+    Spider middleware that builds a CCA record for every response.
+    Records are yielded as items, or, if the spider has ``cca_path``
+    attribute, written to that file by a background writer thread
+    (see :class:`scrapy_memex.utils.itemwriter.BackgroundItemWriter`)::
+
+        CCA_WRITER_QUEUE_SIZE = 1000
+        CCA_WRITER_BATCH_SIZE = 100
+        CCA_WRITER_BATCH_TIMEOUT = 1.0
+        CCA_ROTATE_SIZE = 0  # bytes, 0 disables size-based rotation
+        CCA_ROTATE_INTERVAL = 0  # seconds, 0 disables time-based rotation
+        CCA_COMPRESSION = None  # 'gzip' or 'zstd'
+
+    With ``CCA_BODIES_OUT_OF_LINE = True`` raw bodies are not base64-encoded
+    into records written to ``cca_path``: they are stored by the writer
+    thread in compressed segments next to the CCA file (rotated at
+    ``CCA_BODY_SEGMENT_SIZE`` bytes), and records only hold a reference
+    to them. Use :func:`scrapy_memex.utils.ccabodies.iter_cca_records`
+    to read records back with bodies included.
 
-    def __init__(self):
+    With ``CCA_SKIP_NEAR_DUPLICATES = True`` no records are built for
+    responses found to be near-duplicates by
+    :class:`scrapy_memex.spidermiddleware.neardup.NearDuplicateMiddleware`.
+    """
+
+    BODY_MARKER = 'scrapy-memex-cca-body'
+
+    def __init__(self, settings=None, stats=None, spool=None):
         self.item_class = None  # Cached dynamic CcaItem class
-        self.exporters_by_path = {}
+        self.writers_by_path = {}
+        self.settings = settings
+        self.stats = stats
+        self.spool = spool
+        self.bodies_out_of_line = (
+            settings is not None and
+            settings.getbool('CCA_BODIES_OUT_OF_LINE', False)
+        )
+        self.body_stores_by_path = {}
+        self._body_path = None  # keys leading to the body in CCA records
+        self.skip_near_duplicates = (
+            settings is not None and
+            settings.getbool('CCA_SKIP_NEAR_DUPLICATES', False)
+        )
 
     @classmethod
     def from_crawler(cls, crawler):
         enabled = crawler.settings.getbool('CCA_ENABLED', True)
         if not enabled:
             raise NotConfigured
-        return cls()
+        mw = cls(crawler.settings, crawler.stats,
+                 PayloadSpool.from_settings(crawler.settings))
+        crawler.signals.connect(mw.spider_closed, signal=signals.spider_closed)
+        return mw
 
     def process_spider_output(self, response, result, spider):
         items = []
@@ -24,18 +75,68 @@ class CcaMiddleware(object):
             if isinstance(r, Item):
                 items.append(r)
             yield r
-        cca = response2cca(response, base64=True)
-        cca['features'] = {'items': items}
-        cca_item = self.create_item(cca)
+        if self.skip_near_duplicates and response.meta.get('near_duplicate'):
+            if self.stats is not None:
+                self.stats.inc_value('cca/near_duplicate_skipped')
+            return
         cca_path = self.get_cca_path(spider)
+        if cca_path is not None and self.bodies_out_of_line:
+            cca = self.cca_without_body(response)
+        else:
+            cca = response2cca(response, base64=True)
+        if self.spool is not None and self.spool.enabled:
+            cca = self.spool_payloads(cca)
         if cca_path is None:
-            yield cca_item
+            cca['features'] = {'items': items}
+            yield self.create_item(cca)
         else:
-            exporter = self.exporters_by_path.get(cca_path)
-            if exporter is None:
-                exporter = JsonLinesItemExporter(open(cca_path, 'a+'))
-                self.exporters_by_path[cca_path] = exporter
-            exporter.export_item(cca_item)
+            # Items are serialized in the writer thread while pipelines
+            # may still modify them, so a snapshot is exported.
+            cca['features'] = {'items': [dict(item) for item in items]}
+            self.get_writer(cca_path).write(self.create_item(cca))
+
+    def cca_without_body(self, response):
+        """
+        Return a CCA record with the raw body (not base64-encoded) in
+        place of the base64 one; it is moved to a BodyStore by the writer.
+        """
+        if self._body_path is None:
+            marker_cca = response2cca(response.replace(body=self.BODY_MARKER),
+                                      base64=True)
+            self._body_path = find_path(marker_cca,
+                                        base64.b64encode(self.BODY_MARKER))
+            if self._body_path is None:
+                log.msg("Can't find body in CCA records, storing bodies "
+                        "inline", logging.WARNING)
+                self.bodies_out_of_line = False
+                return response2cca(response, base64=True)
+        cca = response2cca(response.replace(body=''), base64=True)
+        set_path(cca, self._body_path, response.body)
+        return cca
+
+    def get_writer(self, cca_path):
+        writer = self.writers_by_path.get(cca_path)
+        if writer is None:
+            prepare = None
+            if self.bodies_out_of_line:
+                body_store = BodyStore(cca_path, self.settings.getint(
+                    'CCA_BODY_SEGMENT_SIZE', 256 * 1024 * 1024
+                ))
+                self.body_stores_by_path[cca_path] = body_store
+                prepare = lambda item: self._store_body(item, body_store)
+            writer = BackgroundItemWriter.from_settings(
+                self.settings, cca_path, self.stats, prepare=prepare
+            )
+            writer.start()
+            self.writers_by_path[cca_path] = writer
+        return writer
+
+    def _store_body(self, item, body_store):
+        # Called in the writer thread
+        body = get_path(item, self._body_path)
+        ref = body_store.store(item.get('url', ''), body)
+        set_path(item, self._body_path, ref)
+        return item
 
     def create_item(self, values):
         if self.item_class is None:
@@ -47,3 +148,27 @@ class CcaMiddleware(object):
 
     def get_cca_path(self, spider):
         return getattr(spider, 'cca_path', None)
+
+    def spool_payloads(self, values):
+        """Replace large strings (e.g. base64 body) with spooled payloads"""
+        spooled = {}
+        for key, value in values.iteritems():
+            if isinstance(value, dict):
+                value = self.spool_payloads(value)
+            elif isinstance(value, basestring):
+                if isinstance(value, unicode):
+                    encoded = value.encode('utf-8')
+                else:
+                    encoded = value
+                if len(encoded) >= self.spool.threshold:
+                    value = self.spool.spool(encoded)
+            spooled[key] = value
+        return spooled
+
+    def spider_closed(self, spider):
+        for writer in self.writers_by_path.values():
+            writer.close()
+        for body_store in self.body_stores_by_path.values():
+            body_store.close()
+        if self.spool is not None:
+            self.spool.close()
@@ -0,0 +1,85 @@
+from scrapy.http import Request
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.misc import load_object
+
+
+class LinkScorerMiddleware(object):
+    """
+    Spider middleware which scores outgoing requests before they are
+    scheduled. Scores go to ``request.meta['score']`` (used e.g. by
+    SplashEnablerScoreMiddleware) and ``score * LINK_SCORER_PRIORITY_SCALE``
+    is added to ``request.priority``, so better links are fetched first.
+
+    Requests are scored in batches of up to ``LINK_SCORER_BATCH_SIZE``
+    (usually all links of a page at once); items pass through immediately.
+    Anchor text is taken from ``link_text`` meta key (set by CrawlSpider
+    rules). Requests with ``dont_score`` meta key are left as is.
+
+    Settings::
+
+        SPIDER_MIDDLEWARES = {
+            'scrapy_memex.spidermiddleware.linkscorer.LinkScorerMiddleware':
+                800,
+        }
+        LINK_SCORER_ENABLED = True
+        LINK_SCORER = 'scrapy_memex.utils.linkscoring.HashedLinearScorer'
+        LINK_SCORER_MODEL = '/path/to/model.npz'
+        LINK_SCORER_PRIORITY_SCALE = 100
+        LINK_SCORER_BATCH_SIZE = 1000
+
+    A scorer is a class with ``from_settings(settings)`` classmethod and
+    ``score_links(parent_url, links)`` method returning a score for every
+    (url, anchor text) tuple in ``links``; see
+    :class:`scrapy_memex.utils.linkscoring.HashedLinearScorer`.
+    """
+
+    DEFAULT_SCORER = 'scrapy_memex.utils.linkscoring.HashedLinearScorer'
+
+    def __init__(self, scorer, priority_scale=100, batch_size=1000,
+                 stats=None):
+        self.scorer = scorer
+        self.priority_scale = priority_scale
+        self.batch_size = batch_size
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('LINK_SCORER_ENABLED'):
+            raise NotConfigured
+        scorer_cls = load_object(settings.get('LINK_SCORER',
+                                              cls.DEFAULT_SCORER))
+        return cls(
+            scorer_cls.from_settings(settings),
+            priority_scale=settings.getfloat('LINK_SCORER_PRIORITY_SCALE',
+                                             100),
+            batch_size=settings.getint('LINK_SCORER_BATCH_SIZE', 1000),
+            stats=crawler.stats,
+        )
+
+    def process_spider_output(self, response, result, spider):
+        batch = []
+        for r in result:
+            if isinstance(r, Request) and not r.meta.get('dont_score'):
+                batch.append(r)
+                if len(batch) >= self.batch_size:
+                    for request in self._score(response, batch):
+                        yield request
+                    batch = []
+            else:
+                yield r
+        for request in self._score(response, batch):
+            yield request
+
+    def _score(self, response, requests):
+        if not requests:
+            return requests
+        links = [(r.url, r.meta.get('link_text') or u'') for r in requests]
+        scores = self.scorer.score_links(response.url, links)
+        for request, score in zip(requests, scores):
+            score = float(score)
+            request.meta['score'] = score
+            request.priority += int(round(score * self.priority_scale))
+        if self.stats is not None:
+            self.stats.inc_value('link_scorer/scored_count', len(requests))
+        return requests
@@ -0,0 +1,117 @@
+from scrapy.exceptions import NotConfigured
+from scrapy.http import Request, TextResponse
+from scrapy.item import BaseItem
+
+from scrapy_memex.utils.simhash import SimHashIndex, html_tokens, simhash
+
+
+class NearDuplicateMiddleware(object):
+    """
+    Spider middleware which finds responses with nearly the same text as
+    a page seen before (session id variants, calendar pages, boilerplate
+    listings) using SimHash fingerprints, and prunes the crawl there::
+
+        NEARDUP_ENABLED = True
+        NEARDUP_MAX_DISTANCE = 3  # bits out of 64
+        NEARDUP_INDEX_SIZE = 1000000  # fingerprints kept
+        NEARDUP_MIN_TOKENS = 50  # shorter pages are not checked
+        NEARDUP_MAX_BYTES = 1000000  # body bytes tokenized; 0 is no limit
+        NEARDUP_MAX_LINKS = 0  # links followed from near-duplicates
+
+    The URL of the page a response duplicates is stored in
+    ``response.meta['near_duplicate']`` before the spider callback is
+    called. Requests from near-duplicates beyond the first
+    ``NEARDUP_MAX_LINKS`` are dropped. Items are flagged only if their
+    class declares the field (``near_duplicate = scrapy.Field()``):
+    ``near_duplicate`` is set in them, and ``S3_SKIP_NEAR_DUPLICATES``
+    skips their S3 uploads. ``CCA_SKIP_NEAR_DUPLICATES`` skips CCA
+    records of near-duplicate responses.
+
+    A page fetched again (e.g. with Splash) is not a duplicate of itself.
+    The share of near-duplicates is in ``neardup/duplicate_ratio`` stats.
+    """
+
+    def __init__(self, index, max_distance=3, min_tokens=50, max_links=0,
+                 max_bytes=0, stats=None):
+        self.index = index
+        self.max_distance = max_distance
+        self.min_tokens = min_tokens
+        self.max_links = max_links
+        self.max_bytes = max_bytes
+        self.stats = stats
+        self.checked = 0
+        self.duplicates = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('NEARDUP_ENABLED'):
+            raise NotConfigured
+        max_distance = settings.getint('NEARDUP_MAX_DISTANCE', 3)
+        # fingerprints within max_distance bits share one of the bands
+        index = SimHashIndex(
+            bands=max_distance + 1,
+            max_size=settings.getint('NEARDUP_INDEX_SIZE', 1000000))
+        return cls(
+            index,
+            max_distance=max_distance,
+            min_tokens=settings.getint('NEARDUP_MIN_TOKENS', 50),
+            max_links=settings.getint('NEARDUP_MAX_LINKS', 0),
+            max_bytes=settings.getint('NEARDUP_MAX_BYTES', 1000000),
+            stats=crawler.stats,
+        )
+
+    def process_spider_input(self, response, spider):
+        if not isinstance(response, TextResponse):
+            return
+        tokens = html_tokens(self._text(response))
+        if len(tokens) < self.min_tokens:
+            return
+        fingerprint = simhash(tokens)
+        self.checked += 1
+        match = self.index.find(fingerprint, self.max_distance)
+        if match is not None and match[1] != response.url:
+            self.duplicates += 1
+            response.meta['near_duplicate'] = match[1]
+        else:
+            self.index.add(fingerprint, response.url)
+        self._update_stats()
+
+    def process_spider_output(self, response, result, spider):
+        original = response.meta.get('near_duplicate')
+        if original is None:
+            for r in result:
+                yield r
+            return
+        links = 0
+        for r in result:
+            if isinstance(r, Request):
+                links += 1
+                if links > self.max_links:
+                    self._inc_stats('neardup/dropped_links')
+                    continue
+            elif (isinstance(r, BaseItem) and
+                    'near_duplicate' in getattr(r, 'fields', ())):
+                r['near_duplicate'] = original
+            yield r
+
+    def _text(self, response):
+        if self.max_bytes and len(response.body) > self.max_bytes:
+            # a multibyte character cut in the middle is dropped
+            return response.body[:self.max_bytes].decode(response.encoding,
+                                                         'ignore')
+        return response.body_as_unicode()
+
+    def _update_stats(self):
+        if self.stats is None:
+            return
+        self.stats.set_value('neardup/checked_count', self.checked)
+        self.stats.set_value('neardup/duplicate_count', self.duplicates)
+        self.stats.set_value('neardup/duplicate_ratio',
+                             float(self.duplicates) / self.checked)
+        self.stats.set_value('neardup/index_size', len(self.index))
+        self.stats.set_value('neardup/evicted_count', self.index.evicted)
+
+    def _inc_stats(self, key):
+        if self.stats is not None:
+            self.stats.inc_value(key)
@@ -0,0 +1,56 @@
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.item import BaseItem
+
+from scrapy_memex.utils.payload import PayloadSpool
+
+
+class PayloadSpoolMiddleware(object):
+    """
+    Spider middleware that spools large item payloads to disk as soon as
+    items leave the spider, so they are passed through the item pipeline
+    by reference (see :class:`scrapy_memex.utils.payload.PayloadSpool`
+    for spool settings)::
+
+        PAYLOAD_SPOOL_ENABLED = True
+        PAYLOAD_SPOOL_FIELDS = ['html', 'png']
+
+    Text fields are spooled as UTF-8. S3 pipelines and
+    ``scrapy_memex.exporters.PayloadJsonLinesItemExporter`` read spooled
+    payloads from disk; other consumers of these fields need to use
+    :func:`scrapy_memex.utils.payload.read_payload`.
+    """
+
+    def __init__(self, spool, fields):
+        self.spool = spool
+        self.fields = fields
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        spool = PayloadSpool.from_settings(crawler.settings)
+        if not spool.enabled:
+            raise NotConfigured
+        fields = crawler.settings.getlist('PAYLOAD_SPOOL_FIELDS',
+                                          ['html', 'png'])
+        mw = cls(spool, fields)
+        crawler.signals.connect(mw.spider_closed, signal=signals.spider_closed)
+        return mw
+
+    def process_spider_output(self, response, result, spider):
+        for r in result:
+            if isinstance(r, BaseItem):
+                self._spool_fields(r)
+            yield r
+
+    def _spool_fields(self, item):
+        for field in self.fields:
+            value = item.get(field)
+            if not isinstance(value, basestring):
+                continue
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            if len(value) >= self.spool.threshold:
+                item[field] = self.spool.spool(value)
+
+    def spider_closed(self, spider):
+        self.spool.close()
@@ -1,21 +1,275 @@
-import copy
+import os
+import sqlite3
+import tempfile
+
+from scrapy import signals
 from scrapy.http import Request
 from scrapy.exceptions import NotConfigured
+from scrapy.utils.job import job_dir
+
+from scrapy_memex.utils.lru import LRUCache
+
+# RefererChainStore used to pickle chains (one per process)
+_chain_store = None
+
+
+class RefererChain(object):
+    """
+    Immutable chain of referer URLs, oldest first.
+
+    Every chain is a node pointing to its parent chain, so children share
+    their ancestors instead of copying them. The chain behaves like
+    a read-only list (``len``, iteration, indexing, comparison with
+    lists); use :meth:`to_list` to get a plain list.
+
+    When a :class:`RefererChainStore` is set with :func:`set_chain_store`
+    chains are pickled as ids in it (see there); otherwise they are
+    pickled as flat lists of all their URLs.
+
+    >>> chain = RefererChain.from_list(['a', 'b']).append('c')
+    >>> chain
+    RefererChain(['a', 'b', 'c'])
+    >>> len(chain), chain[0], chain[-1], chain == ['a', 'b', 'c']
+    (3, 'a', 'c', True)
+    >>> chain.append('d', max_length=2).to_list()
+    ['c', 'd']
+    """
+
+    __slots__ = ('url', 'parent', 'length', '_store', '_id')
+
+    def __init__(self, url, parent=None):
+        self.url = url
+        self.parent = parent
+        self.length = 1 if parent is None else parent.length + 1
+        self._store = self._id = None  # RefererChainStore id
+
+    @classmethod
+    def from_list(cls, urls):
+        chain = None
+        for url in urls:
+            chain = cls(url, chain)
+        return chain
+
+    def append(self, url, max_length=0):
+        """Return a new chain with ``url`` at the end"""
+        if max_length and self.length >= max_length:
+            if max_length == 1:
+                return RefererChain(url)
+            parent = RefererChain.from_list(self.to_list()[-max_length + 1:])
+            return RefererChain(url, parent)
+        return RefererChain(url, self)
+
+    def to_list(self):
+        urls = []
+        node = self
+        while node is not None:
+            urls.append(node.url)
+            node = node.parent
+        urls.reverse()
+        return urls
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def __getitem__(self, index):
+        if index == -1:
+            return self.url
+        return self.to_list()[index]
+
+    def __eq__(self, other):
+        if isinstance(other, RefererChain):
+            other = other.to_list()
+        return self.to_list() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'RefererChain(%r)' % self.to_list()
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        if _chain_store is not None:
+            return _chain_from_store, (_chain_store.add(self),)
+        # Pickle as a flat list: recursive pickling of a deep chain
+        # would hit the recursion limit.
+        return _chain_from_list, (self.to_list(),)
+
+
+def _chain_from_list(urls):
+    return RefererChain.from_list(urls)
+
+
+def _chain_from_store(chain_id):
+    if _chain_store is None:
+        raise ValueError("Can't load referer chain %d: no chain store is "
+                         "set" % chain_id)
+    return _chain_store.get(chain_id)
+
+
+def set_chain_store(store):
+    """ Pickle chains as ids in ``store`` (a RefererChainStore or None) """
+    global _chain_store
+    _chain_store = store
+
+
+class RefererChainStore(object):
+    """
+    Side table of pickled referer chains, in a sqlite database. A chain
+    is stored once, as a row with the id of its parent chain and its last
+    URL, and pickled as its id, so pickled requests take constant space
+    whatever their depth. Chains loaded back share their ancestors;
+    ``cache_size`` chains are kept in memory by id.
+
+    >>> import cPickle as pickle
+    >>> store = RefererChainStore(':memory:')
+    >>> set_chain_store(store)
+    >>> chain = RefererChain.from_list(['a', 'b'])
+    >>> data = pickle.dumps([chain.append('c'), chain.append('d')], 2)
+    >>> len(store)
+    4
+    >>> store._nodes = LRUCache()  # as after a restart
+    >>> c, d = pickle.loads(data)
+    >>> c, d.to_list(), c.parent is d.parent
+    (RefererChain(['a', 'b', 'c']), ['a', 'b', 'd'], True)
+    >>> set_chain_store(None)
+    >>> store.close()
+    """
+
+    def __init__(self, path, cache_size=100000):
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.text_factory = str
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS chains ('
+            ' id INTEGER PRIMARY KEY, parent INTEGER, url TEXT)'
+        )
+        self._nodes = LRUCache(cache_size)
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM chains').fetchone()[0]
+
+    def add(self, chain):
+        """ Store ``chain`` and its ancestors if needed; return its id """
+        new = []
+        node = chain
+        while node is not None and node._store is not self:
+            new.append(node)
+            node = node.parent
+        parent_id = node._id if node is not None else None
+        if new:
+            self.db.execute('BEGIN')
+            for node in reversed(new):
+                node._id = self.db.execute(
+                    'INSERT INTO chains (parent, url) VALUES (?, ?)',
+                    (parent_id, node.url)).lastrowid
+                node._store = self
+                self._nodes[node._id] = node
+                parent_id = node._id
+            self.db.execute('COMMIT')
+        return chain._id
+
+    def get(self, chain_id):
+        """ Return the chain stored with ``chain_id`` """
+        rows = []
+        node_id = chain_id
+        while node_id is not None and node_id not in self._nodes:
+            row = self.db.execute('SELECT parent, url FROM chains'
+                                  ' WHERE id = ?', (node_id,)).fetchone()
+            if row is None:
+                raise KeyError(chain_id)
+            rows.append((node_id, row[1]))
+            node_id = row[0]
+        node = self._nodes[node_id] if node_id is not None else None
+        for node_id, url in reversed(rows):
+            node = RefererChain(url, node)
+            node._store, node._id = self, node_id
+            self._nodes[node_id] = node
+        return node
+
+    def close(self):
+        self.db.close()
 
 
 class RefererChainMiddleware(object):
+    """
+    Spider middleware that stores the chain of referers of every request
+    in ``request.meta['referers']`` (as a :class:`RefererChain`)::
+
+        REFERER_CHAIN_ENABLED = True
+        REFERER_CHAIN_MAX_LENGTH = 0  # keep only the N most recent; 0 - all
+        REFERER_CHAIN_STORE = True  # pickle chains as ids in a side table
+
+    With ``REFERER_CHAIN_STORE`` chains of requests written to disk queues
+    are stored in a :class:`RefererChainStore`, in
+    ``JOBDIR/referer_chains.db`` when JOBDIR is set (so that the crawl can
+    be resumed) and in a temporary file otherwise. Only one crawler per
+    process can use it.
+    """
+
+    STORE_FILENAME = 'referer_chains.db'
 
     @classmethod
     def from_crawler(cls, crawler):
-        if not crawler.settings.getbool('REFERER_CHAIN_ENABLED'):
+        settings = crawler.settings
+        if not settings.getbool('REFERER_CHAIN_ENABLED'):
             raise NotConfigured
-        return cls()
+        mw = cls(settings.getint('REFERER_CHAIN_MAX_LENGTH', 0))
+        if settings.getbool('REFERER_CHAIN_STORE', True):
+            mw.open_store(job_dir(settings))
+            crawler.signals.connect(mw.spider_closed,
+                                    signal=signals.spider_closed)
+        return mw
+
+    def __init__(self, max_length=0):
+        self.max_length = max_length
+        self.store = None
+        self.store_path = None
+        self.temporary_store = False
+
+    def open_store(self, jobdir=None):
+        if jobdir:
+            self.store_path = os.path.join(jobdir, self.STORE_FILENAME)
+        else:
+            fd, self.store_path = tempfile.mkstemp(prefix='referer-chains-',
+                                                   suffix='.db')
+            os.close(fd)
+            self.temporary_store = True
+        self.store = RefererChainStore(self.store_path)
+        set_chain_store(self.store)
+
+    def spider_closed(self, spider):
+        # Disk queues are closed (and pickled) before spider_closed
+        set_chain_store(None)
+        self.store.close()
+        if self.temporary_store:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(self.store_path + suffix):
+                    os.remove(self.store_path + suffix)
 
     def process_spider_output(self, response, result, spider):
+        # All requests from a page share the same chain object
+        referers = self._child_chain(response)
+
         def _append_referer(r):
             if isinstance(r, Request):
-                referers = copy.deepcopy(response.meta.get('referers', []))
-                referers.append(response.url)
                 r.meta['referers'] = referers
             return r
         return (_append_referer(r) for r in result or ())
+
+    def _child_chain(self, response):
+        parent = response.meta.get('referers')
+        if parent is not None and not isinstance(parent, RefererChain):
+            parent = RefererChain.from_list(parent)  # plain list
+        if parent is None:
+            return RefererChain(response.url)
+        return parent.append(response.url, self.max_length)
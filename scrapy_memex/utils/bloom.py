@@ -0,0 +1,227 @@
+"""
+Bloom filters over 128-bit digests, with bit arrays in mmaps so they can
+live in files (and be reopened) or in anonymous memory.
+
+A :class:`ScalableBloomFilter` adds a new, larger filter with a lower
+false positive rate when the last one is full (Almeida et al., "Scalable
+Bloom Filters"), so the total false positive rate stays below
+``error_rate`` however many items are added.
+"""
+import json
+import math
+import mmap
+import os
+import struct
+
+_unpack_digest = struct.Struct('<QQ').unpack
+
+
+def bloom_size(capacity, error_rate):
+    """
+    Return (number of bits, number of hashes) of a Bloom filter for
+    ``capacity`` items with ``error_rate`` false positive rate; the number
+    of bits is rounded up to whole bytes.
+
+    >>> bloom_size(1000000, 1e-6)
+    (28755176, 20)
+    """
+    num_bits = int(math.ceil(-capacity * math.log(error_rate) /
+                             math.log(2) ** 2))
+    num_bits = (num_bits + 7) // 8 * 8
+    num_hashes = max(1, int(round(num_bits * math.log(2) / capacity)))
+    return num_bits, num_hashes
+
+
+class BloomFilter(object):
+    """
+    Fixed size Bloom filter. Items are digests of at least 16 bytes (e.g.
+    md5 or sha1); ``num_hashes`` bit positions are derived from the two
+    64-bit halves of the digest.
+
+    >>> import hashlib
+    >>> bloom = BloomFilter(*bloom_size(1000, 0.01))
+    >>> bloom.add(hashlib.md5('a').digest())
+    False
+    >>> bloom.add(hashlib.md5('a').digest())
+    True
+    >>> hashlib.md5('b').digest() in bloom
+    False
+    """
+
+    def __init__(self, num_bits, num_hashes, path=None):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.path = path
+        num_bytes = (num_bits + 7) // 8
+        if path is None:
+            self._file = None
+            self._bits = mmap.mmap(-1, num_bytes)
+        else:
+            self._file = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+            self._file.truncate(num_bytes)  # sparse until bits are set
+            self._bits = mmap.mmap(self._file.fileno(), num_bytes)
+
+    @property
+    def num_bytes(self):
+        return len(self._bits)
+
+    def _positions(self, digest):
+        # enhanced double hashing (Dillinger & Manolios); plain
+        # h1 + i * h2 repeats positions when h2 shares factors with num_bits
+        h1, h2 = _unpack_digest(digest[:16])
+        num_bits = self.num_bits
+        h1 %= num_bits
+        h2 %= num_bits
+        positions = []
+        for i in xrange(self.num_hashes):
+            positions.append(h1)
+            h1 = (h1 + h2) % num_bits
+            h2 = (h2 + i + 1) % num_bits
+        return positions
+
+    def __contains__(self, digest):
+        bits = self._bits
+        for pos in self._positions(digest):
+            if not ord(bits[pos >> 3]) & (1 << (pos & 7)):
+                return False
+        return True
+
+    def add(self, digest):
+        """ Add ``digest``; return True if it was (probably) there already """
+        bits = self._bits
+        seen = True
+        for pos in self._positions(digest):
+            byte = ord(bits[pos >> 3])
+            mask = 1 << (pos & 7)
+            if not byte & mask:
+                bits[pos >> 3] = chr(byte | mask)
+                seen = False
+        return seen
+
+    def flush(self):
+        if self._file is not None:
+            self._bits.flush()
+
+    def close(self):
+        self.flush()
+        self._bits.close()
+        if self._file is not None:
+            self._file.close()
+
+
+class ScalableBloomFilter(object):
+    """
+    Bloom filter which grows as items are added. Filter ``i`` holds
+    ``initial_capacity * growth ** i`` items with false positive rate
+    ``error_rate * (1 - tightening) * tightening ** i``.
+
+    With ``directory``, bit arrays are ``bloom-<i>.bits`` files there and
+    parameters and item counts are saved to ``bloom.json`` by
+    :meth:`flush` and :meth:`close`; an existing filter in ``directory``
+    is reopened with its own parameters.
+
+    >>> import hashlib
+    >>> bloom = ScalableBloomFilter(initial_capacity=100, error_rate=1e-6)
+    >>> sum(bloom.add(hashlib.md5(str(i)).digest()) for i in range(1000))
+    0
+    >>> len(bloom), len(bloom.filters)
+    (1000, 4)
+    >>> hashlib.md5('10').digest() in bloom
+    True
+    """
+
+    def __init__(self, initial_capacity=1000000, error_rate=1e-6, growth=2,
+                 tightening=0.5, directory=None):
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        self.growth = growth
+        self.tightening = tightening
+        self.directory = directory
+        self.filters = []
+        self.counts = []
+        if directory is not None:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            if os.path.exists(self._meta_path):
+                self._load()
+        if not self.filters:
+            self._add_filter()
+
+    @property
+    def _meta_path(self):
+        return os.path.join(self.directory, 'bloom.json')
+
+    def _load(self):
+        with open(self._meta_path) as f:
+            meta = json.load(f)
+        self.initial_capacity = meta['initial_capacity']
+        self.error_rate = meta['error_rate']
+        self.growth = meta['growth']
+        self.tightening = meta['tightening']
+        for count in meta['counts']:
+            self._add_filter()
+            self.counts[-1] = count
+
+    def _add_filter(self):
+        i = len(self.filters)
+        num_bits, num_hashes = bloom_size(self._capacity(i),
+                                          self._error_rate(i))
+        path = None
+        if self.directory is not None:
+            path = os.path.join(self.directory, 'bloom-%d.bits' % i)
+        self.filters.append(BloomFilter(num_bits, num_hashes, path))
+        self.counts.append(0)
+
+    def _capacity(self, i):
+        return int(self.initial_capacity * self.growth ** i)
+
+    def _error_rate(self, i):
+        return self.error_rate * (1 - self.tightening) * self.tightening ** i
+
+    def __len__(self):
+        return sum(self.counts)
+
+    @property
+    def num_bytes(self):
+        return sum(bloom.num_bytes for bloom in self.filters)
+
+    def __contains__(self, digest):
+        return any(digest in bloom for bloom in self.filters)
+
+    def add(self, digest):
+        """ Add ``digest``; return True if it was (probably) there already """
+        last = len(self.filters) - 1
+        for bloom in self.filters[:last]:
+            if digest in bloom:
+                return True
+        if self.counts[last] >= self._capacity(last):
+            if digest in self.filters[last]:
+                return True
+            self._add_filter()
+            last += 1
+        if self.filters[last].add(digest):
+            return True
+        self.counts[last] += 1
+        return False
+
+    def flush(self):
+        if self.directory is None:
+            return
+        for bloom in self.filters:
+            bloom.flush()
+        meta = {
+            'initial_capacity': self.initial_capacity,
+            'error_rate': self.error_rate,
+            'growth': self.growth,
+            'tightening': self.tightening,
+            'counts': self.counts,
+        }
+        tmp_path = self._meta_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.rename(tmp_path, self._meta_path)
+
+    def close(self):
+        self.flush()
+        for bloom in self.filters:
+            bloom.close()
@@ -0,0 +1,143 @@
+import base64
+import gzip
+import json
+import os
+import zlib
+
+from scrapy_memex.utils.payload import iter_payload
+from scrapy_memex.utils.segments import (
+    SegmentWriter, format_locator, parse_locator, read_record
+)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def find_path(values, target):
+    """
+    Return a tuple of keys leading to ``target`` in nested dicts.
+
+    >>> find_path({'a': 1, 'b': {'c': 'x'}}, 'x')
+    ('b', 'c')
+    >>> find_path({'a': 1}, 'x')
+    """
+    for key, value in values.iteritems():
+        if value == target:
+            return (key,)
+        if isinstance(value, dict):
+            path = find_path(value, target)
+            if path is not None:
+                return (key,) + path
+    return None
+
+
+def set_path(values, path, value):
+    """
+    >>> d = {'b': {'c': 'x'}}
+    >>> set_path(d, ('b', 'c'), 'y')
+    >>> d
+    {'b': {'c': 'y'}}
+    """
+    for key in path[:-1]:
+        values = values[key]
+    values[path[-1]] = value
+
+
+def get_path(values, path):
+    for key in path:
+        values = values[key]
+    return values
+
+
+class BodyStore(object):
+    """
+    Stores raw response bodies out of line for CCA records: every body
+    is gzip-compressed separately and appended to rolling tar segments
+    next to the CCA file, so it can be read back with one ranged read.
+    :meth:`store` returns a reference which replaces the body in the
+    record: ``{'locator': '<segment>#bytes=<start>-<end>',
+    'encoding': 'gzip'}``; segment names are relative to the directory
+    of the CCA file.
+    """
+
+    def __init__(self, cca_path, max_size=256 * 1024 * 1024):
+        directory = os.path.dirname(os.path.abspath(cca_path))
+        prefix = os.path.basename(cca_path) + '-bodies'
+        self.writer = SegmentWriter(directory, prefix, max_size,
+                                    max_age=float('inf'))
+
+    def store(self, key, body):
+        """ Store ``body`` (a str or a spooled PayloadRef) """
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        chunks = [compressor.compress(chunk) for chunk in iter_payload(body)]
+        chunks.append(compressor.flush())
+        data = ''.join(chunks)
+        name = base64.urlsafe_b64encode(key) + '.gz'
+        segment_name, offset, length = self.writer.append(key, name, data)
+        return {
+            'locator': format_locator(segment_name, offset, length),
+            'encoding': 'gzip',
+        }
+
+    def close(self):
+        self.writer.close()
+
+
+def read_body(ref, directory):
+    """Read a body stored by BodyStore; return raw bytes"""
+    segment_name, offset, length = parse_locator(ref['locator'])
+    data = read_record(os.path.join(directory, segment_name), offset, length)
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+def _is_body_ref(value):
+    return isinstance(value, dict) and 'locator' in value
+
+
+def rehydrate(record, directory):
+    """Put base64-encoded bodies back in place of body references"""
+    for key, value in record.iteritems():
+        if _is_body_ref(value):
+            record[key] = base64.b64encode(read_body(value, directory))
+        elif isinstance(value, dict):
+            rehydrate(value, directory)
+    return record
+
+
+def iter_cca_records(path, rehydrate_bodies=True):
+    """
+    Iterate over records of a CCA JSON lines file (optionally gzip or
+    zstd compressed, as written by CcaMiddleware). With
+    ``rehydrate_bodies`` bodies stored out of line are loaded back, so
+    records look exactly like the inline ones.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    if path.endswith('.gz'):
+        f = gzip.open(path, 'rb')
+    elif path.endswith('.zst'):
+        f = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+        f = _iter_lines(f)
+    else:
+        f = open(path, 'rb')
+    for line in f:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if rehydrate_bodies:
+            rehydrate(record, directory)
+        yield record
+
+
+def _iter_lines(f, chunk_size=1024 * 1024):
+    pending = ''
+    for chunk in iter(lambda: f.read(chunk_size), ''):
+        lines = (pending + chunk).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
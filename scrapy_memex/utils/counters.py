@@ -0,0 +1,119 @@
+import array
+import cPickle as pickle
+import hashlib
+import json
+import math
+import struct
+from collections import defaultdict
+
+
+class DictCounter(defaultdict):
+    """
+    Exact counter; memory grows with the number of distinct keys.
+
+    >>> c = DictCounter()
+    >>> c.increment('example.com')
+    >>> c['example.com'], c['example.org']
+    (1, 0)
+    """
+
+    def __init__(self, *args):
+        super(DictCounter, self).__init__(int, *args)
+
+    def __getitem__(self, key):
+        # Don't create entries on lookups
+        return self.get(key, 0)
+
+    def increment(self, key, count=1):
+        self[key] = self.get(key, 0) + count
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump(dict(self), f, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            return cls(pickle.load(f))
+
+
+class CountMinSketch(object):
+    """
+    Approximate counter with fixed memory (``width * depth`` 32-bit
+    counters), see Cormode & Muthukrishnan, "An Improved Data Stream
+    Summary: The Count-Min Sketch and its Applications".
+
+    Counts are never underestimated. With N total increments, an estimate
+    exceeds the true count by more than ``e / width * N`` with probability
+    at most ``exp(-depth)``. Conservative update (only the smallest
+    counters of a key are increased) makes errors smaller in practice.
+
+    For crawl limits an overestimate means a domain hits its limit a bit
+    early; no domain ever gets more links than the limit allows.
+
+    >>> c = CountMinSketch(width=1000, depth=4)
+    >>> for i in range(5):
+    ...     c.increment('example.com')
+    >>> c['example.com'], c['example.org']
+    (5, 0)
+    """
+
+    def __init__(self, width=1024 * 1024, depth=4, counters=None):
+        self.width = width
+        self.depth = depth
+        if counters is None:
+            counters = array.array('i', [0]) * (width * depth)
+        self.counters = counters
+
+    @classmethod
+    def from_memory(cls, memory, depth=4):
+        """Create a sketch which uses about ``memory`` bytes"""
+        width = max(1, memory // (4 * depth))
+        return cls(width, depth)
+
+    @classmethod
+    def from_error(cls, epsilon, delta):
+        """
+        Create a sketch where an estimate exceeds the true count by more
+        than ``epsilon * N`` with probability at most ``delta``.
+
+        >>> c = CountMinSketch.from_error(0.001, 0.01)
+        >>> c.width, c.depth
+        (2719, 5)
+        """
+        return cls(int(math.ceil(math.e / epsilon)),
+                   int(math.ceil(math.log(1 / delta))))
+
+    def __getitem__(self, key):
+        counters = self.counters
+        return min(counters[i] for i in self._indexes(key))
+
+    def increment(self, key, count=1):
+        counters = self.counters
+        indexes = self._indexes(key)
+        value = min(counters[i] for i in indexes) + count
+        for i in indexes:
+            if counters[i] < value:
+                counters[i] = value
+
+    def _indexes(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        width = self.width
+        return [i * width + (h1 + i * h2) % width
+                for i in xrange(self.depth)]
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(json.dumps({'width': self.width, 'depth': self.depth}))
+            f.write('\n')
+            self.counters.tofile(f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            header = json.loads(f.readline())
+            counters = array.array('i')
+            counters.fromfile(f, header['width'] * header['depth'])
+        return cls(header['width'], header['depth'], counters)
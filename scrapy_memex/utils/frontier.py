@@ -0,0 +1,230 @@
+"""
+Crawl frontier with one priority queue per host (or download slot) kept
+in a sqlite database, and a heap of hosts keyed by the time they can be
+fetched next, so taking a request never scans hosts which are not ready.
+
+Only a few requests per host are in memory ("hot"), at most
+``hot_window`` for all hosts together; requests of the least recently
+used hosts are written back to disk when there are more.
+"""
+import bisect
+import cPickle as pickle
+import heapq
+import sqlite3
+import time
+
+from scrapy_memex.utils.lru import LRUCache
+
+
+class _HostQueue(object):
+    __slots__ = ['hot', 'on_disk', 'disk_first', 'next_fetch', 'scheduled']
+
+    def __init__(self):
+        # (-priority, seq, obj) entries, highest priority first
+        self.hot = []
+        self.on_disk = 0
+        # (-priority, seq) of the first request on disk (a lower bound)
+        self.disk_first = None
+        self.next_fetch = 0
+        self.scheduled = False
+
+
+def _pickle(obj):
+    return pickle.dumps(obj, protocol=2)
+
+
+class HostFrontier(object):
+    """
+    Requests (any objects) are pushed with a host key and a priority;
+    :meth:`pop` returns the highest priority object (first pushed among
+    equal priorities) of a host which is ready to be fetched.
+
+    After a host is popped it is ready again in ``delay(key)`` seconds;
+    ``wait(key, now)`` may postpone a ready host by returning the number
+    of seconds to wait. Objects are stored with ``serialize`` (it should
+    return None for objects which can't be stored, they are kept in
+    memory) and loaded with ``deserialize``. Requests are read from disk
+    ``batch_size`` at a time per host, and written ``write_batch`` at a
+    time. Next fetch times of ``recent_hosts`` hosts are remembered after
+    their queues become empty.
+
+    >>> frontier = HostFrontier(':memory:', delay=lambda key: 10,
+    ...                         hot_window=2, batch_size=2)
+    >>> for i, (key, priority) in enumerate([('a', 0), ('a', 0), ('b', 0),
+    ...                                      ('a', 5), ('b', 1)]):
+    ...     frontier.push(key, 'r%d' % i, priority)
+    >>> frontier.pop(now=0), frontier.pop(now=0), frontier.pop(now=0)
+    ('r3', 'r4', None)
+    >>> frontier.next_ready_time(), len(frontier)
+    (10, 3)
+    >>> [frontier.pop(now=10) for _ in range(3)]
+    ['r0', 'r2', None]
+    """
+
+    def __init__(self, path, serialize=_pickle, deserialize=pickle.loads,
+                 delay=None, wait=None, hot_window=10000, batch_size=16,
+                 write_batch=100, recent_hosts=100000):
+        self.serialize = serialize
+        self.deserialize = deserialize
+        self.delay = delay or (lambda key: 0)
+        self.wait = wait
+        self.hot_window = hot_window
+        self.batch_size = batch_size
+        self.write_batch = write_batch
+        self.hosts = {}
+        self.hot_count = 0
+        self.disk_count = 0
+        self._heap = []  # (ready time, key)
+        self._lru = LRUCache(float('inf'))  # hosts with hot requests
+        # next fetch times of hosts without requests
+        self._recent = LRUCache(recent_hosts)
+        self._writes = []
+        self.db = sqlite3.connect(path)
+        self.db.text_factory = str
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS queue ('
+            ' seq INTEGER PRIMARY KEY, key TEXT, priority INTEGER,'
+            ' data BLOB)'
+        )
+        self.db.execute(
+            'CREATE INDEX IF NOT EXISTS queue_key'
+            ' ON queue (key, priority DESC, seq)'
+        )
+        self._seq = self.db.execute(
+            'SELECT COALESCE(MAX(seq), 0) FROM queue').fetchone()[0] + 1
+        for key, count, top in self.db.execute(
+                'SELECT key, COUNT(*), MAX(priority) FROM queue GROUP BY key'):
+            q = self.hosts[key] = _HostQueue()
+            q.on_disk = count
+            q.disk_first = (-top, 0)
+            self.disk_count += count
+            self._schedule(key, q)
+
+    def __len__(self):
+        return self.hot_count + self.disk_count
+
+    def push(self, key, obj, priority=0):
+        seq = self._seq
+        self._seq += 1
+        q = self.hosts.get(key)
+        if q is None:
+            q = self.hosts[key] = _HostQueue()
+            q.next_fetch = self._recent.pop(key, 0)
+        entry = (-priority, seq, obj)
+        if not (q.on_disk and entry > q.disk_first and
+                self._to_disk(key, q, entry)):
+            bisect.insort(q.hot, entry)
+            self.hot_count += 1
+            self._lru[key] = q
+            if len(q.hot) > self.batch_size:
+                self._spill(key, q, len(q.hot) - self.batch_size)
+            if self.hot_count > self.hot_window:
+                self._evict()
+        if not q.scheduled:
+            self._schedule(key, q)
+
+    def pop(self, now=None):
+        """ Return a request of a host which is ready, or None """
+        if now is None:
+            now = time.time()
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            _, key = heapq.heappop(heap)
+            q = self.hosts[key]
+            if self.wait is not None:
+                wait = self.wait(key, now)
+                if wait > 0:
+                    heapq.heappush(heap, (now + wait, key))
+                    continue
+            if not q.hot or (q.on_disk and q.disk_first < q.hot[0][:2]):
+                self._load(key, q)
+            entry = q.hot.pop(0)
+            self.hot_count -= 1
+            if self.hot_count > self.hot_window:
+                self._evict()
+            q.next_fetch = now + self.delay(key)
+            if q.hot or q.on_disk:
+                heapq.heappush(heap, (q.next_fetch, key))
+            else:
+                del self.hosts[key]
+                self._recent[key] = q.next_fetch
+            if not q.hot:
+                self._lru.pop(key)
+            return entry[2]
+
+    def next_ready_time(self):
+        """ Return the time the next host is ready, or None if it's empty """
+        if self._heap:
+            return self._heap[0][0]
+
+    def _schedule(self, key, q):
+        q.scheduled = True
+        heapq.heappush(self._heap, (q.next_fetch, key))
+
+    def _to_disk(self, key, q, entry):
+        data = self.serialize(entry[2])
+        if data is None:
+            return False
+        self._writes.append((entry[1], key, -entry[0], sqlite3.Binary(data)))
+        if q.on_disk == 0 or entry[:2] < q.disk_first:
+            q.disk_first = entry[:2]
+        q.on_disk += 1
+        self.disk_count += 1
+        if len(self._writes) >= self.write_batch:
+            self._flush()
+        return True
+
+    def _spill(self, key, q, n):
+        """ Write up to ``n`` lowest priority hot requests of ``key`` """
+        kept = []
+        while n and q.hot:
+            entry = q.hot.pop()
+            if self._to_disk(key, q, entry):
+                self.hot_count -= 1
+                n -= 1
+            else:
+                kept.append(entry)
+        q.hot.extend(reversed(kept))
+        if not q.hot:
+            self._lru.pop(key)
+
+    def _evict(self):
+        lru = self._lru
+        while self.hot_count > self.hot_window and lru:
+            key, q = lru.popoldest()
+            self._spill(key, q, len(q.hot))
+            # requests left are the ones which can't be stored
+
+    def _load(self, key, q):
+        self._flush()
+        rows = self.db.execute(
+            'SELECT seq, priority, data FROM queue WHERE key = ?'
+            ' ORDER BY priority DESC, seq LIMIT ?', (key, self.batch_size)
+        ).fetchall()
+        with self.db:
+            self.db.executemany('DELETE FROM queue WHERE seq = ?',
+                                [(row[0],) for row in rows])
+        q.on_disk -= len(rows)
+        self.disk_count -= len(rows)
+        q.disk_first = (-rows[-1][1], rows[-1][0]) if q.on_disk else None
+        for seq, priority, data in rows:
+            bisect.insort(q.hot, (-priority, seq, self.deserialize(str(data))))
+        self.hot_count += len(rows)
+        self._lru[key] = q
+
+    def _flush(self):
+        if self._writes:
+            with self.db:
+                self.db.executemany('INSERT INTO queue VALUES (?, ?, ?, ?)',
+                                    self._writes)
+            self._writes = []
+
+    def close(self, persist=False):
+        """ Close the database; with ``persist`` hot requests are saved """
+        if persist:
+            for key, q in self.hosts.items():
+                self._spill(key, q, len(q.hot))
+        self._flush()
+        self.db.close()
@@ -0,0 +1,200 @@
+import gzip
+import logging
+import threading
+import time
+import traceback
+from Queue import Queue, Empty
+
+from twisted.internet import task
+
+from scrapy import log
+
+from scrapy_memex.exporters import PayloadJsonLinesItemExporter
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+_CLOSE = object()
+
+
+class BackgroundItemWriter(object):
+    """
+    Exports items as JSON lines from a background thread.
+
+    :meth:`write` puts items into a bounded queue; when the queue is full
+    it blocks until the writer thread catches up. The thread serializes
+    and writes items in batches, flushing after every batch, and rotates
+    output files by size and/or age. Items must not be modified after
+    they are passed to :meth:`write`. If ``prepare`` is set, it is called
+    with every item in the writer thread right before it is exported.
+
+    Output goes to ``path`` itself unless rotation is enabled; rotated
+    files are named ``<path>.<timestamp>-<seq>``. ``.gz`` or ``.zst`` is
+    appended when compression is used.
+    """
+
+    EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+
+    def __init__(self, path, queue_size=1000, batch_size=100,
+                 batch_timeout=1.0, rotate_size=0, rotate_interval=0,
+                 compression=None, stats=None, stats_prefix='writer',
+                 stats_interval=60, prepare=None):
+        if compression not in (None, 'gzip', 'zstd'):
+            raise ValueError("Unsupported compression %r" % compression)
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError("zstd compression requires 'zstandard' package")
+        self.path = path
+        self.queue = Queue(queue_size)
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.rotate_size = rotate_size
+        self.rotate_interval = rotate_interval
+        self.compression = compression
+        self.stats = stats
+        self.stats_prefix = stats_prefix
+        self.stats_interval = stats_interval
+        self.prepare = prepare
+        self.items_written = 0
+        self._file = self._raw_file = self._exporter = None
+        self._opened_at = None
+        self._seq = 0
+        self._thread = threading.Thread(target=self._run,
+                                        name='itemwriter %s' % path)
+        self._thread.daemon = True
+        self._last_count = 0
+        self._last_time = None
+        self._stats_task = task.LoopingCall(self._update_stats)
+
+    @classmethod
+    def from_settings(cls, settings, path, stats=None, stats_prefix='cca',
+                      prepare=None):
+        return cls(
+            path,
+            queue_size=settings.getint('CCA_WRITER_QUEUE_SIZE', 1000),
+            batch_size=settings.getint('CCA_WRITER_BATCH_SIZE', 100),
+            batch_timeout=settings.getfloat('CCA_WRITER_BATCH_TIMEOUT', 1.0),
+            rotate_size=settings.getint('CCA_ROTATE_SIZE', 0),
+            rotate_interval=settings.getfloat('CCA_ROTATE_INTERVAL', 0),
+            compression=settings.get('CCA_COMPRESSION') or None,
+            stats=stats,
+            stats_prefix=stats_prefix,
+            stats_interval=settings.getfloat('CCA_STATS_INTERVAL', 60),
+            prepare=prepare,
+        )
+
+    def start(self):
+        self._thread.start()
+        self._last_time = time.time()
+        self._stats_task.start(self.stats_interval, now=False)
+
+    def write(self, item):
+        self.queue.put(item)
+        if self.stats is not None:
+            depth = self.queue.qsize()
+            self.stats.set_value('%s/queue_depth' % self.stats_prefix, depth)
+            self.stats.max_value('%s/max_queue_depth' % self.stats_prefix,
+                                 depth)
+
+    def close(self):
+        """Write out queued items and close the file (blocks)"""
+        if self._stats_task.running:
+            self._stats_task.stop()
+        self.queue.put(_CLOSE)
+        self._thread.join()
+        self._update_stats()
+
+    def _run(self):
+        closing = False
+        while not closing:
+            try:
+                batch = [self.queue.get(timeout=self.batch_timeout)]
+            except Empty:
+                batch = []  # idle; still check if the file is due to rotate
+            deadline = time.time() + self.batch_timeout
+            while batch and len(batch) < self.batch_size:
+                if batch[-1] is _CLOSE:
+                    break
+                try:
+                    batch.append(self.queue.get(
+                        timeout=max(0, deadline - time.time())
+                    ))
+                except Empty:
+                    break
+            if batch and batch[-1] is _CLOSE:
+                closing = True
+                batch.pop()
+            try:
+                self._write_batch(batch)
+            except Exception:
+                log.msg("Error writing items to %s:\n%s" %
+                        (self.path, traceback.format_exc()), logging.ERROR)
+        self._close_file()
+
+    def _write_batch(self, batch):
+        if not batch:
+            if self._should_rotate():
+                self._close_file()
+            return
+        if self._file is not None and self._should_rotate():
+            self._close_file()
+        if self._file is None:
+            self._open_file()
+        for item in batch:
+            if self.prepare is not None:
+                item = self.prepare(item)
+            self._exporter.export_item(item)
+        self._file.flush()
+        self.items_written += len(batch)
+
+    def _should_rotate(self):
+        if self._file is None:
+            return False
+        if self.rotate_size and self._raw_file.tell() >= self.rotate_size:
+            return True
+        return bool(self.rotate_interval and
+                    time.time() - self._opened_at >= self.rotate_interval)
+
+    def _open_file(self):
+        path = self.path
+        if self.rotate_size or self.rotate_interval:
+            path = '%s.%s-%05d' % (path, time.strftime('%Y%m%d%H%M%S'),
+                                   self._seq)
+            self._seq += 1
+        path += self.EXTENSIONS.get(self.compression, '')
+        self._raw_file = open(path, 'ab')
+        if self.compression == 'gzip':
+            self._file = gzip.GzipFile(fileobj=self._raw_file, mode='ab')
+        elif self.compression == 'zstd':
+            self._file = zstandard.ZstdCompressor().stream_writer(
+                self._raw_file
+            )
+        else:
+            self._file = self._raw_file
+        self._exporter = PayloadJsonLinesItemExporter(self._file)
+        self._opened_at = time.time()
+
+    def _close_file(self):
+        if self._file is None:
+            return
+        if self._file is not self._raw_file:
+            self._file.close()
+        if not self._raw_file.closed:
+            self._raw_file.close()
+        self._file = self._raw_file = self._exporter = None
+
+    def _update_stats(self):
+        if self.stats is None:
+            return
+        now = time.time()
+        count = self.items_written
+        self.stats.set_value('%s/items_written' % self.stats_prefix, count)
+        self.stats.set_value('%s/queue_depth' % self.stats_prefix,
+                             self.queue.qsize())
+        if self._last_time is not None and now > self._last_time:
+            rate = (count - self._last_count) / (now - self._last_time)
+            self.stats.set_value('%s/items_per_sec' % self.stats_prefix,
+                                 round(rate, 2))
+        self._last_count, self._last_time = count, now
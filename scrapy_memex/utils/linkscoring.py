@@ -0,0 +1,141 @@
+"""
+Link scoring with hashed features and a linear or logistic model.
+
+Features of a link are tokens of its URL, anchor text and parent page,
+prefixed by their kind (``u:``, ``h:``, ``a:``, ``p:``) and hashed into
+``dim`` buckets. A whole page of links is scored at once: weights of all
+features are gathered and summed per link with ``numpy.bincount``.
+
+Models are ``.npz`` files with ``weights`` (``dim`` floats), ``bias`` and
+``kind`` ('linear' or 'logistic'); see :func:`save_model`.
+"""
+import re
+import zlib
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from scrapy_memex.utils.url import _host, _netloc, _site_name
+
+_tokenize = re.compile(r'[a-z0-9]+').findall
+_path_match = re.compile(r'[a-z][a-z0-9+.-]*://[^/?#]*([^?#]*)(\?[^#]*)?',
+                         re.IGNORECASE).match
+
+MODEL_KINDS = ('linear', 'logistic')
+
+
+def _check_numpy():
+    if np is None:
+        raise ImportError("link scoring requires 'numpy' package")
+
+
+def link_features(url, anchor_text=u'', parent_url=None):
+    """
+    Return feature strings of a link.
+
+    >>> sorted(link_features('http://www.example.com/news/a-1.html?p=2',
+    ...                      u'Read more', 'http://example.com/'))
+    ['a:more', 'a:read', 'h:example.com', 'h:www.example.com', \
+'p:h:example.com', 'p:internal', 'u:depth=2', 'u:ext=html', 'u:query', 'u:t:1', 'u:t:a', 'u:t:html', \
+'u:t:news']
+    """
+    host = _host(_netloc(url))
+    features = ['h:' + host]
+    if host.startswith('www.'):
+        features.append('h:' + host[4:])
+    m = _path_match(url)
+    path, query = (m.group(1), m.group(2)) if m else ('', None)
+    path = path.lower()
+    features.extend('u:t:' + token for token in set(_tokenize(path)))
+    features.append('u:depth=%d' % min(path.count('/'), 10))
+    last = path.rsplit('/', 1)[-1]
+    if '.' in last:
+        features.append('u:ext=' + last.rsplit('.', 1)[-1][:8])
+    if query:
+        features.append('u:query')
+    if anchor_text:
+        text = anchor_text.lower()
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        features.extend('a:' + token for token in set(_tokenize(text)))
+    if parent_url is not None:
+        internal = _site_name(_netloc(parent_url)) == _site_name(_netloc(url))
+        features.append('p:internal' if internal else 'p:external')
+        features.append('p:h:' + _host(_netloc(parent_url)))
+    return features
+
+
+def hash_features(features, dim):
+    """
+    >>> hash_features(['h:example.com', 'a:news'], 1024)
+    [641, 823]
+    """
+    return [(zlib.crc32(f) & 0xffffffff) % dim for f in features]
+
+
+class HashedLinearScorer(object):
+    """
+    Score links with a linear (or logistic) model over hashed features.
+    This is the default ``LINK_SCORER``; other scorers need the same
+    ``from_settings`` and ``score_links`` methods.
+    """
+
+    def __init__(self, weights, bias=0.0, kind='logistic'):
+        _check_numpy()
+        if kind not in MODEL_KINDS:
+            raise ValueError("Unknown model kind: %r" % kind)
+        self.weights = np.asarray(weights, dtype=np.float32)
+        self.dim = len(self.weights)
+        self.bias = float(bias)
+        self.kind = kind
+
+    @classmethod
+    def load(cls, path):
+        _check_numpy()
+        model = np.load(path)
+        return cls(model['weights'], float(model['bias']),
+                   str(model['kind']))
+
+    @classmethod
+    def from_settings(cls, settings):
+        path = settings.get('LINK_SCORER_MODEL')
+        if not path:
+            raise ValueError("LINK_SCORER_MODEL is not set")
+        return cls.load(path)
+
+    def score_links(self, parent_url, links):
+        """
+        Return an array of scores for ``links``, a list of
+        (url, anchor text) tuples found on ``parent_url``.
+        """
+        rows = []
+        cols = []
+        dim = self.dim
+        for i, (url, text) in enumerate(links):
+            indexes = hash_features(link_features(url, text, parent_url), dim)
+            rows.extend([i] * len(indexes))
+            cols.extend(indexes)
+        return self.score_hashed(np.array(rows, dtype=np.intp),
+                                 np.array(cols, dtype=np.intp), len(links))
+
+    def score_hashed(self, rows, cols, n):
+        """ Score ``n`` links with features ``cols`` of links ``rows`` """
+        if n == 0:
+            return np.zeros(0)
+        scores = np.bincount(rows, weights=self.weights[cols], minlength=n)
+        scores += self.bias
+        if self.kind == 'logistic':
+            scores = 1.0 / (1.0 + np.exp(-scores))
+        return scores
+
+
+def save_model(path, weights, bias=0.0, kind='logistic'):
+    """ Save a model for :class:`HashedLinearScorer` """
+    _check_numpy()
+    if kind not in MODEL_KINDS:
+        raise ValueError("Unknown model kind: %r" % kind)
+    with open(path, 'wb') as f:
+        np.savez(f, weights=np.asarray(weights, dtype=np.float32),
+                 bias=bias, kind=kind)
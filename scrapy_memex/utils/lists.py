@@ -1,3 +1,6 @@
+import random
+
+
 def split_list(list_, condition):
     """Split list into two lists based on condition"""
     true, false = [], []
@@ -7,3 +10,36 @@ def split_list(list_, condition):
         else:
             false.append(item)
     return true, false
+
+
+class Reservoir(object):
+    """
+    Uniform random sample of at most ``size`` items from a stream of
+    unknown length (reservoir sampling, Algorithm R); uses O(size) memory.
+
+    >>> import random
+    >>> r = Reservoir(3, random.Random(0))
+    >>> for i in range(100):
+    ...     r.add(i)
+    >>> len(r.items), r.seen
+    (3, 100)
+    >>> r = Reservoir(0)
+    >>> r.add(1)
+    >>> r.items
+    []
+    """
+
+    def __init__(self, size, random_=random):
+        self.size = size
+        self.random = random_
+        self.items = []
+        self.seen = 0
+
+    def add(self, item):
+        if len(self.items) < self.size:
+            self.items.append(item)
+        elif self.size > 0:
+            j = self.random.randint(0, self.seen)
+            if j < self.size:
+                self.items[j] = item
+        self.seen += 1
@@ -0,0 +1,132 @@
+import functools
+
+
+_PREV, _NEXT, _KEY, _VALUE = 0, 1, 2, 3
+
+
+class LRUCache(object):
+    """
+    Dict-like cache which holds at most ``maxsize`` entries, evicting
+    the least recently used ones.
+
+    >>> cache = LRUCache(2)
+    >>> cache['a'] = 1
+    >>> cache['b'] = 2
+    >>> cache['a']
+    1
+    >>> cache['c'] = 3
+    >>> 'b' in cache, 'a' in cache, len(cache)
+    (False, True, 2)
+    >>> cache.get('b', 'missing')
+    'missing'
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._map = {}
+        # Circular doubly linked list; root.next is the oldest entry
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+    def __len__(self):
+        return len(self._map)
+
+    def __contains__(self, key):
+        return key in self._map
+
+    def __getitem__(self, key):
+        link = self._map[key]
+        self._move_to_end(link)
+        return link[_VALUE]
+
+    def get(self, key, default=None):
+        link = self._map.get(key)
+        if link is None:
+            return default
+        self._move_to_end(link)
+        return link[_VALUE]
+
+    def __setitem__(self, key, value):
+        link = self._map.get(key)
+        if link is not None:
+            link[_VALUE] = value
+            self._move_to_end(link)
+            return
+        root = self._root
+        if len(self._map) >= self.maxsize:
+            oldest = root[_NEXT]
+            root[_NEXT] = oldest[_NEXT]
+            oldest[_NEXT][_PREV] = root
+            del self._map[oldest[_KEY]]
+        last = root[_PREV]
+        link = [last, root, key, value]
+        last[_NEXT] = root[_PREV] = self._map[key] = link
+
+    def __delitem__(self, key):
+        link = self._map.pop(key)
+        link[_PREV][_NEXT] = link[_NEXT]
+        link[_NEXT][_PREV] = link[_PREV]
+
+    def pop(self, key, default=None):
+        if key not in self._map:
+            return default
+        value = self._map[key][_VALUE]
+        del self[key]
+        return value
+
+    def popoldest(self):
+        """
+        Remove and return the (key, value) pair used least recently.
+
+        >>> cache = LRUCache()
+        >>> cache['a'], cache['b'] = 1, 2
+        >>> cache.popoldest(), len(cache)
+        (('a', 1), 1)
+        """
+        if not self._map:
+            raise KeyError('popoldest(): cache is empty')
+        oldest = self._root[_NEXT]
+        key, value = oldest[_KEY], oldest[_VALUE]
+        del self[key]
+        return key, value
+
+    def clear(self):
+        self._map.clear()
+        root = self._root
+        root[:] = [root, root, None, None]
+
+    def _move_to_end(self, link):
+        root = self._root
+        if root[_PREV] is link:
+            return
+        link[_PREV][_NEXT] = link[_NEXT]
+        link[_NEXT][_PREV] = link[_PREV]
+        last = root[_PREV]
+        link[_PREV], link[_NEXT] = last, root
+        last[_NEXT] = root[_PREV] = link
+
+
+def lru_cached(maxsize=10000):
+    """
+    Memoize a single-argument function in an LRUCache (available as
+    ``func.cache``).
+
+    >>> @lru_cached(10)
+    ... def double(x):
+    ...     return x * 2
+    >>> double(2), len(double.cache)
+    (4, 1)
+    """
+    def decorator(func):
+        cache = LRUCache(maxsize)
+        missing = object()
+
+        @functools.wraps(func)
+        def wrapper(arg):
+            value = cache.get(arg, missing)
+            if value is missing:
+                value = cache[arg] = func(arg)
+            return value
+        wrapper.cache = cache
+        return wrapper
+    return decorator
@@ -0,0 +1,154 @@
+import base64
+import mmap
+import os
+import shutil
+import tempfile
+from cStringIO import StringIO
+
+from scrapy.utils.project import data_path
+
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class PayloadRef(object):
+    """
+    Handle to a payload spooled to disk. The file is removed when the
+    last reference to the handle goes away, i.e. when every item,
+    request or exporter holding it is done with it.
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        return '<PayloadRef %s (%d bytes)>' % (self.path, self.size)
+
+    def __del__(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def open(self):
+        return open(self.path, 'rb')
+
+    def read(self):
+        with self.open() as f:
+            return f.read()
+
+    def head(self, size):
+        with self.open() as f:
+            return f.read(size)
+
+    def mmap(self):
+        with self.open() as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def open_payload(data):
+    """Return a file object for a payload (str or PayloadRef)"""
+    if isinstance(data, PayloadRef):
+        return data.open()
+    return StringIO(data)
+
+
+def iter_payload(data, chunk_size=CHUNK_SIZE):
+    """
+    Iterate over payload contents in chunks; str payloads are
+    not copied (chunks are buffers).
+
+    >>> [str(chunk) for chunk in iter_payload('abcde', 2)]
+    ['ab', 'cd', 'e']
+    """
+    if isinstance(data, PayloadRef):
+        with data.open() as f:
+            for chunk in iter(lambda: f.read(chunk_size), ''):
+                yield chunk
+    else:
+        for i in xrange(0, len(data), chunk_size):
+            yield buffer(data, i, chunk_size)
+
+
+def payload_head(data, size):
+    if isinstance(data, PayloadRef):
+        return data.head(size)
+    return data[:size]
+
+
+def read_payload(data):
+    if isinstance(data, PayloadRef):
+        return data.read()
+    return data
+
+
+class PayloadSpool(object):
+    """
+    Writes payloads larger than a threshold to a spool directory and
+    returns :class:`PayloadRef` handles instead, so they are not kept in
+    memory while items travel through middlewares and pipelines.
+
+    Settings::
+
+        PAYLOAD_SPOOL_ENABLED = True
+        PAYLOAD_SPOOL_THRESHOLD = 1024 * 1024  # bytes
+        PAYLOAD_SPOOL_DIR = None  # default is .scrapy/spool
+
+    Every spool uses its own temporary subdirectory, which is removed
+    by :meth:`close`.
+    """
+
+    def __init__(self, directory, threshold=1024 * 1024, enabled=True):
+        self.base_directory = directory
+        self.threshold = threshold
+        self.enabled = enabled
+        self.directory = None
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            settings.get('PAYLOAD_SPOOL_DIR') or data_path('spool'),
+            threshold=settings.getint('PAYLOAD_SPOOL_THRESHOLD', 1024 * 1024),
+            enabled=settings.getbool('PAYLOAD_SPOOL_ENABLED', False),
+        )
+
+    def spool(self, data):
+        """Return a PayloadRef for large ``data`` or ``data`` itself"""
+        if not self.enabled or len(data) < self.threshold:
+            return data
+        return self._write([data])
+
+    def spool_b64decode(self, encoded):
+        """
+        Like ``spool(base64.b64decode(encoded))``, but large payloads are
+        decoded chunk by chunk straight to disk.
+        """
+        if not self.enabled or len(encoded) * 3 / 4 < self.threshold:
+            return base64.b64decode(encoded)
+        step = CHUNK_SIZE * 4  # decode whole 4-char groups only
+        return self._write(
+            base64.b64decode(encoded[i:i + step])
+            for i in xrange(0, len(encoded), step)
+        )
+
+    def close(self):
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+    def _write(self, chunks):
+        if self.directory is None:
+            if not os.path.exists(self.base_directory):
+                os.makedirs(self.base_directory)
+            self.directory = tempfile.mkdtemp(dir=self.base_directory)
+        fd, path = tempfile.mkstemp(dir=self.directory)
+        size = 0
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+        return PayloadRef(path, size)
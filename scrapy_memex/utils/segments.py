@@ -0,0 +1,124 @@
+import os
+import re
+import tarfile
+import time
+
+from scrapy_memex.utils.payload import open_payload
+
+
+def format_locator(url, offset, length):
+    """
+    Return a ranged-read locator for a record stored in a segment.
+    The fragment uses HTTP Range syntax (last byte is inclusive).
+
+    >>> format_locator('http://example.com/seg.tar', 512, 100)
+    'http://example.com/seg.tar#bytes=512-611'
+    """
+    return '%s#bytes=%d-%d' % (url, offset, offset + length - 1)
+
+
+def parse_locator(locator):
+    """
+    Split a locator into (url, offset, length).
+
+    >>> parse_locator('http://example.com/seg.tar#bytes=512-611')
+    ('http://example.com/seg.tar', 512, 100)
+    """
+    url, _, fragment = locator.rpartition('#')
+    m = re.match(r'bytes=(\d+)-(\d+)$', fragment)
+    if not url or m is None:
+        raise ValueError("Not a segment locator: %r" % locator)
+    start, end = int(m.group(1)), int(m.group(2))
+    return url, start, end - start + 1
+
+
+def read_record(path, offset, length):
+    """Read a single record from a local segment file"""
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return f.read(length)
+
+
+class SegmentWriter(object):
+    """
+    Append records to rolling tar segments in ``directory``.
+
+    Every segment gets an index file next to it (same name plus ``.idx``)
+    with one ``key<TAB>offset<TAB>length`` line per record; offsets point
+    at the record payload, so a record can be fetched with a single ranged
+    read without parsing the tar headers. A segment is closed once it grows
+    over ``max_size`` bytes or gets older than ``max_age`` seconds;
+    ``on_close(segment_path, index_path)`` is called for every closed
+    segment.
+    """
+
+    def __init__(self, directory, prefix, max_size=256 * 1024 * 1024,
+                 max_age=600, on_close=None):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_size = max_size
+        self.max_age = max_age
+        self.on_close = on_close
+        self.seq = 0
+        self.segment_name = None
+        self._tar = None
+        self._index = None
+        self._opened_at = None
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def append(self, key, name, data):
+        """
+        Add ``data`` (a str or a PayloadRef) as tar member ``name``
+        indexed by ``key``.
+        Return (segment_name, offset, length) of the payload.
+        """
+        if self._tar is None:
+            self._open()
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        fp = open_payload(data)
+        try:
+            self._tar.addfile(info, fp)
+        finally:
+            fp.close()
+        # tar.offset now points past the zero-padded payload
+        blocks, remainder = divmod(len(data), tarfile.BLOCKSIZE)
+        padded = (blocks + bool(remainder)) * tarfile.BLOCKSIZE
+        offset = self._tar.offset - padded
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        self._index.write('%s\t%d\t%d\n' % (key, offset, len(data)))
+        location = (self.segment_name, offset, len(data))
+        if self._tar.offset >= self.max_size:
+            self.rotate()
+        return location
+
+    def maybe_rotate(self):
+        if (self._tar is not None and
+                time.time() - self._opened_at >= self.max_age):
+            self.rotate()
+
+    def rotate(self):
+        if self._tar is None:
+            return
+        self._tar.close()
+        self._index.close()
+        segment_path = os.path.join(self.directory, self.segment_name)
+        self._tar = self._index = None
+        if self.on_close is not None:
+            self.on_close(segment_path, segment_path + '.idx')
+
+    close = rotate
+
+    def _open(self):
+        self.segment_name = self._segment_name(self.seq)
+        self.seq += 1
+        path = os.path.join(self.directory, self.segment_name)
+        self._tar = tarfile.open(path, 'w')
+        self._index = open(path + '.idx', 'w')
+        self._opened_at = time.time()
+
+    def _segment_name(self, seq):
+        return '%s-%d-%05d.tar' % (self.prefix, os.getpid(), seq)
@@ -0,0 +1,146 @@
+"""
+SimHash fingerprints of page text and an index which finds fingerprints
+within a small Hamming distance of a given one.
+
+A 64-bit SimHash is built from hashed word shingles: bit ``i`` is set if
+most shingles (by count) have bit ``i`` set, so pages sharing most of
+their text get fingerprints differing in a few bits only.
+"""
+import collections
+import hashlib
+import re
+import struct
+
+from scrapy_memex.utils.lru import LRUCache
+
+_unpack_hash = struct.Struct('<Q').unpack
+_strip_blocks = re.compile(r'<(script|style|noscript)\b.*?</\1\s*>|<!--.*?-->',
+                           re.IGNORECASE | re.DOTALL).sub
+_strip_tags = re.compile(r'<[^>]*>').sub
+_tokenize = re.compile(r'\w+', re.UNICODE).findall
+# bit => byte values with that bit set
+_BYTES_WITH_BIT = [[v for v in xrange(256) if v & (1 << bit)]
+                   for bit in xrange(8)]
+
+
+def html_tokens(html):
+    """
+    Return lowercased words of the text of ``html`` (a unicode string).
+
+    >>> html_tokens(u'<p>Hello, <b>World</b></p><script>var x;</script>')
+    [u'hello', u'world']
+    """
+    text = _strip_tags(' ', _strip_blocks(' ', html))
+    return _tokenize(text.lower())
+
+
+def simhash(tokens, shingle_size=3):
+    """
+    Return the 64-bit SimHash of ``tokens`` shingles.
+
+    >>> a = simhash(u'the quick brown fox jumps over the lazy dog'.split())
+    >>> b = simhash(u'the quick brown fox jumped over the lazy dog'.split())
+    >>> c = simhash(u'lorem ipsum dolor sit amet consectetur adipiscing elit'
+    ...             .split())
+    >>> hamming_distance(a, b) < hamming_distance(a, c)
+    True
+    """
+    if len(tokens) < shingle_size:
+        shingle_size = max(len(tokens), 1)
+    counts = collections.Counter(
+        u' '.join(tokens[i:i + shingle_size])
+        for i in xrange(max(len(tokens) - shingle_size + 1, 0)))
+    # per byte of the hashes: byte value => count of shingles
+    byte_counts = [[0] * 256 for _ in xrange(8)]
+    for shingle, count in counts.iteritems():
+        h = _unpack_hash(hashlib.md5(shingle.encode('utf-8')).digest()[:8])[0]
+        for byte_counts_j in byte_counts:
+            byte_counts_j[h & 0xff] += count
+            h >>= 8
+    half = sum(counts.itervalues()) / 2.0
+    fingerprint = 0
+    for j, byte_counts_j in enumerate(byte_counts):
+        for bit in xrange(8):
+            if sum(byte_counts_j[v] for v in _BYTES_WITH_BIT[bit]) > half:
+                fingerprint |= 1 << (j * 8 + bit)
+    return fingerprint
+
+
+def hamming_distance(a, b):
+    """
+    >>> hamming_distance(0b1011, 0b0110)
+    3
+    """
+    return bin(a ^ b).count('1')
+
+
+class SimHashIndex(object):
+    """
+    Index of 64-bit fingerprints for near-duplicate lookups. Fingerprints
+    are split into ``bands`` bands; two fingerprints within
+    ``bands - 1`` bits of each other share at least one band, so only
+    fingerprints sharing a band are compared. At most ``max_size``
+    fingerprints (with their values) are kept, least recently matched or
+    added ones are evicted first.
+
+    >>> index = SimHashIndex(bands=4, max_size=2)
+    >>> index.add(0xffff, 'a')
+    >>> index.add(0xffff << 16, 'b')
+    >>> index.find(0xfffe, max_distance=3)
+    (65535, 'a')
+    >>> index.add(0xffff << 32, 'c')  # evicts 'b'
+    >>> index.find(0xffff << 16, max_distance=3) is None
+    True
+    """
+
+    def __init__(self, bands=4, max_size=1000000):
+        self.bands = bands
+        self.band_bits = 64 // bands
+        self.max_size = max_size
+        self._band_mask = (1 << self.band_bits) - 1
+        self._buckets = [{} for _ in xrange(bands)]
+        self._values = LRUCache(float('inf'))
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._values)
+
+    def _keys(self, fingerprint):
+        bits, mask = self.band_bits, self._band_mask
+        return [(fingerprint >> (i * bits)) & mask for i in xrange(self.bands)]
+
+    def find(self, fingerprint, max_distance=None):
+        """
+        Return (fingerprint, value) of the closest indexed fingerprint
+        within ``max_distance`` bits (``bands - 1`` by default), or None.
+        """
+        if max_distance is None:
+            max_distance = self.bands - 1
+        best = None
+        best_distance = max_distance + 1
+        for buckets, key in zip(self._buckets, self._keys(fingerprint)):
+            for candidate in buckets.get(key, ()):
+                distance = hamming_distance(fingerprint, candidate)
+                if distance < best_distance:
+                    best, best_distance = candidate, distance
+        if best is None:
+            return None
+        return best, self._values[best]
+
+    def add(self, fingerprint, value):
+        if fingerprint in self._values:
+            self._values[fingerprint] = value
+            return
+        if len(self._values) >= self.max_size:
+            self._remove(*self._values.popoldest())
+        self._values[fingerprint] = value
+        for buckets, key in zip(self._buckets, self._keys(fingerprint)):
+            buckets.setdefault(key, set()).add(fingerprint)
+
+    def _remove(self, fingerprint, value):
+        self.evicted += 1
+        for buckets, key in zip(self._buckets, self._keys(fingerprint)):
+            bucket = buckets[key]
+            bucket.discard(fingerprint)
+            if not bucket:
+                del buckets[key]
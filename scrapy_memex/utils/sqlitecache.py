@@ -0,0 +1,106 @@
+import os
+import sqlite3
+import time
+
+
+class SqliteCache(object):
+    """
+    Persistent key-value cache with per-entry expiration time and
+    least-recently-used eviction, stored in a sqlite database. Values are
+    byte strings.
+
+    The database uses WAL journal mode, so several processes on the same
+    machine can read it concurrently while one of them writes. Eviction
+    runs every ``evict_every`` writes: expired entries are removed first,
+    then the least recently used ones until there are at most
+    ``max_entries`` entries taking at most ``max_bytes`` bytes.
+
+    >>> cache = SqliteCache(':memory:', max_entries=2, evict_every=1)
+    >>> cache.set('a', '1')
+    >>> cache.set('b', '2', expires=time.time() - 1)
+    >>> cache.get('a'), cache.get('b')
+    ('1', None)
+    >>> cache.set('c', '3')
+    >>> cache.set('d', '4')
+    >>> cache.get('a'), cache.get('d')
+    (None, '4')
+    """
+
+    def __init__(self, path, max_entries=None, max_bytes=None,
+                 evict_every=100, timeout=30):
+        if path != ':memory:':
+            dirname = os.path.dirname(path)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.evict_every = evict_every
+        self._writes = 0
+        self.db = sqlite3.connect(path, timeout=timeout,
+                                  isolation_level=None)
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS cache ('
+            ' key TEXT PRIMARY KEY, value BLOB, expires REAL,'
+            ' accessed REAL, size INTEGER)'
+        )
+        self.db.execute(
+            'CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)'
+        )
+
+    def get(self, key):
+        """Return the value stored for ``key`` or None if it's expired"""
+        now = time.time()
+        row = self.db.execute(
+            'SELECT value, expires FROM cache WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        value, expires = row
+        if expires is not None and expires <= now:
+            return None
+        self.db.execute('UPDATE cache SET accessed = ? WHERE key = ?',
+                        (now, key))
+        return str(value)
+
+    def set(self, key, value, expires=None):
+        """Store ``value``; ``expires`` is a unix timestamp or None"""
+        self.db.execute(
+            'INSERT OR REPLACE INTO cache (key, value, expires, accessed, size)'
+            ' VALUES (?, ?, ?, ?, ?)',
+            (key, sqlite3.Binary(value), expires, time.time(), len(value))
+        )
+        self._writes += 1
+        if self._writes >= self.evict_every:
+            self._writes = 0
+            self.evict()
+
+    def delete(self, key):
+        self.db.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def evict(self):
+        self.db.execute('DELETE FROM cache WHERE expires <= ?',
+                        (time.time(),))
+        if self.max_entries is not None:
+            self.db.execute(
+                'DELETE FROM cache WHERE key IN ('
+                ' SELECT key FROM cache ORDER BY accessed DESC'
+                ' LIMIT -1 OFFSET ?)', (self.max_entries,)
+            )
+        if self.max_bytes is not None:
+            total = self.db.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM cache'
+            ).fetchone()[0]
+            if total > self.max_bytes:
+                rows = self.db.execute(
+                    'SELECT key, size FROM cache ORDER BY accessed'
+                ).fetchall()
+                for key, size in rows:
+                    if total <= self.max_bytes:
+                        break
+                    self.delete(key)
+                    total -= size
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,124 @@
+from scrapy_memex.utils.lru import LRUCache
+
+
+class SlotState(object):
+    """ Throttling state of a single download slot """
+    __slots__ = ['delay', 'concurrency', 'latency', 'error_rate', 'floor',
+                 'responses', '_increase']
+
+    def __init__(self, delay, concurrency, floor=0.0):
+        self.delay = delay
+        self.concurrency = concurrency
+        self.latency = None
+        self.error_rate = 0.0
+        self.floor = floor
+        self.responses = 0
+        self._increase = 0.0
+
+    def __repr__(self):
+        return "<SlotState delay=%0.2f concurrency=%d latency=%s " \
+               "error_rate=%0.2f floor=%0.2f>" % (
+                   self.delay, self.concurrency, self.latency,
+                   self.error_rate, self.floor)
+
+
+class ThrottleController(object):
+    """
+    Adaptive per-slot download delay and concurrency.
+
+    Delay follows observed latency (``latency / target_concurrency``, so
+    that about ``target_concurrency`` requests are in flight to a slot on
+    average), but never goes below the slot floor (e.g. Crawl-Delay from
+    robots.txt) or ``min_delay``. Errors (timeouts, 429, 5xx) multiply
+    delay by ``backoff`` and halve concurrency; while the error rate is
+    below ``error_threshold`` concurrency grows additively up to
+    ``max_concurrency`` (AIMD).
+
+    The controller doesn't depend on Scrapy, so it can be driven by a
+    simulated downloader (see ``benchmarks/simulate_throttle.py``).
+
+    >>> c = ThrottleController(start_delay=1.0, max_concurrency=4)
+    >>> c.set_floor('example.com', 2.0).delay
+    2.0
+    >>> for i in range(10):
+    ...     s = c.on_response('example.com', 0.5)
+    >>> s.delay, s.concurrency
+    (2.0, 4)
+    >>> for i in range(10):
+    ...     s = c.on_response('example.org', 0.5)
+    >>> round(s.delay, 3)
+    0.5
+    >>> s = c.on_response('example.org', None, error=True)
+    >>> round(s.delay, 3), s.concurrency
+    (2.0, 2)
+    """
+
+    def __init__(self, start_delay=1.0, min_delay=0.0, max_delay=60.0,
+                 target_concurrency=1.0, max_concurrency=8, backoff=2.0,
+                 error_delay=1.0, error_threshold=0.05, smoothing=0.3,
+                 max_slots=10000):
+        self.start_delay = start_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.target_concurrency = target_concurrency
+        self.max_concurrency = max_concurrency
+        self.backoff = backoff
+        self.error_delay = error_delay
+        self.error_threshold = error_threshold
+        self.smoothing = smoothing
+        self.slots = LRUCache(max_slots)
+
+    def get(self, key):
+        state = self.slots.get(key)
+        if state is None:
+            state = self.slots[key] = SlotState(self.start_delay,
+                                                self.max_concurrency)
+            self._clamp(state)
+        return state
+
+    def set_floor(self, key, delay):
+        """ Set the minimum delay of a slot """
+        state = self.get(key)
+        state.floor = delay or 0.0
+        self._clamp(state)
+        return state
+
+    def on_response(self, key, latency, error=False):
+        """
+        Update the slot state after a download which took ``latency``
+        seconds (None if unknown) and return the state.
+        """
+        state = self.get(key)
+        state.responses += 1
+        a = self.smoothing
+        if latency is not None:
+            if state.latency is None:
+                state.latency = latency
+            else:
+                state.latency = a * latency + (1 - a) * state.latency
+        state.error_rate = a * float(error) + (1 - a) * state.error_rate
+
+        if error:
+            state.delay = max(state.delay, self.error_delay) * self.backoff
+            state.concurrency = max(1, state.concurrency // 2)
+            state._increase = 0.0
+        elif state.latency is not None:
+            target = state.latency / self.target_concurrency
+            if state.responses == 1:
+                state.delay = target
+            else:
+                # move halfway, so a single fast response after errors
+                # doesn't reset the delay
+                state.delay = (state.delay + target) / 2.0
+            if (state.error_rate < self.error_threshold and
+                    state.concurrency < self.max_concurrency):
+                state._increase += 1.0 / state.concurrency
+                if state._increase >= 1:
+                    state.concurrency += 1
+                    state._increase = 0.0
+        self._clamp(state)
+        return state
+
+    def _clamp(self, state):
+        delay = min(max(state.delay, self.min_delay), self.max_delay)
+        state.delay = max(delay, state.floor)
@@ -1,16 +1,229 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 import re
+import urllib
 import urlparse
 
+from scrapy_memex.utils.lru import lru_cached
+
 has_scheme = re.compile(r"[a-z]+://.+", re.IGNORECASE).match
+_netloc_match = re.compile(r"[a-z][a-z0-9+.-]*://([^/?#]*)",
+                           re.IGNORECASE).match
+_www_prefix_sub = re.compile(r'^www\d*\.').sub
+
+HOST_CACHE_SIZE = 100000
+
+DEFAULT_PORTS = {'http': '80', 'https': '443'}
+_PATH_SAFE_CHARS = "/%;:@&=+$,!~*'()"
+_UNRESERVED_CHARS = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+                              '0123456789-._~')
+_percent_escape_sub = re.compile(r'%([0-9a-fA-F]{2})').sub
+
+# A small subset of https://publicsuffix.org/list/ used when no full list
+# is loaded with load_public_suffix_list().
+DEFAULT_PUBLIC_SUFFIXES = u"""
+com net org edu gov mil int info biz name pro mobi asia tel travel xxx
+aero coop museum jobs cat io co me tv cc ws fm am ly to onion
+uk co.uk org.uk me.uk ltd.uk plc.uk net.uk ac.uk gov.uk sch.uk nhs.uk
+au com.au net.au org.au edu.au gov.au asn.au id.au
+nz co.nz org.nz net.nz ac.nz govt.nz geek.nz school.nz
+jp co.jp ne.jp or.jp ac.jp go.jp ad.jp ed.jp gr.jp lg.jp
+cn com.cn net.cn org.cn gov.cn edu.cn ac.cn
+kr co.kr or.kr ne.kr go.kr ac.kr re.kr
+in co.in net.in org.in firm.in gen.in ind.in ac.in edu.in gov.in
+br com.br net.br org.br gov.br edu.br
+ar com.ar net.ar org.ar gob.ar edu.ar
+mx com.mx net.mx org.mx gob.mx edu.mx
+za co.za org.za net.za gov.za ac.za web.za
+tr com.tr net.tr org.tr gov.tr edu.tr bel.tr
+ru com.ru net.ru org.ru msk.ru spb.ru
+ua com.ua net.ua org.ua kiev.ua
+hk com.hk net.hk org.hk gov.hk edu.hk
+tw com.tw net.tw org.tw gov.tw edu.tw idv.tw
+sg com.sg net.sg org.sg gov.sg edu.sg
+my com.my net.my org.my gov.my edu.my
+ca de fr it es nl be ch at se no fi dk pl pt ie gr cz sk hu ro bg
+eu us ws su by kz il ir is lt lv ee si hr rs ba mk al md ge am az
+"""
+# Labels which are often public second-level suffixes (com.vn, co.il);
+# without the full list registered domains ending with them are unknown.
+_GENERIC_SECOND_LEVEL = frozenset(u"""
+ac co com edu go gob gov mil ne net or org
+""".split())
+
+
+class PublicSuffixTrie(object):
+    """
+    Trie of public suffix rules (Public Suffix List format, including
+    wildcard and exception rules), keyed by labels from right to left.
+
+    >>> trie = PublicSuffixTrie([u'com', u'uk', u'co.uk', u'*.ck', u'!www.ck'])
+    >>> trie.registered_domain('static.example.co.uk')
+    'example.co.uk'
+    >>> trie.registered_domain('example.com')
+    'example.com'
+    >>> trie.registered_domain('a.b.example.ck')
+    'b.example.ck'
+    >>> trie.registered_domain('www.ck')
+    'www.ck'
+    >>> trie.registered_domain('co.uk')
+    'co.uk'
+    >>> trie.registered_domain('127.0.0.1')
+    '127.0.0.1'
+    """
+
+    TERMINAL = None  # key marking the end of a rule
+
+    def __init__(self, rules):
+        self.root = {}
+        for rule in rules:
+            self.add(rule)
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as f:
+            return cls(line.decode('utf-8').split()[0] for line in f
+                       if line.strip() and not line.startswith('//'))
+
+    def add(self, rule):
+        rule = rule.strip().lower()
+        try:
+            rule = rule.encode('idna')
+        except UnicodeError:
+            rule = rule.encode('utf-8')
+        exception = rule.startswith('!')
+        labels = rule.lstrip('!').split('.')
+        node = self.root
+        for label in reversed(labels[1:] if exception else labels):
+            node = node.setdefault(label, {})
+        if exception:
+            node['!' + labels[0]] = {self.TERMINAL: True}
+        else:
+            node[self.TERMINAL] = True
+
+    def suffix_length(self, labels):
+        """
+        Number of labels of the public suffix of a hostname split into
+        ``labels``. Unknown TLDs are public suffixes (the implicit ``*``
+        rule of the Public Suffix List).
+        """
+        node = self.root
+        length = 1
+        for i, label in enumerate(reversed(labels)):
+            if '!' + label in node:
+                return i
+            if label in node:
+                node = node[label]
+                if self.TERMINAL in node:
+                    length = i + 1
+            elif '*' in node:
+                node = node['*']
+                length = i + 1
+            else:
+                break
+        return length
+
+    def registered_domain(self, host):
+        """
+        Return the registered domain of ``host`` (public suffix plus one
+        label). Hosts which are public suffixes themselves and IP
+        addresses are returned as is.
+        """
+        if _is_ip(host):
+            return host
+        labels = host.split('.')
+        length = self.suffix_length(labels) + 1
+        if length >= len(labels):
+            return host
+        return '.'.join(labels[-length:])
+
+
+_default_public_suffixes = _public_suffixes = PublicSuffixTrie(
+    DEFAULT_PUBLIC_SUFFIXES.split())
+
+
+def load_public_suffix_list(path):
+    """Use the full Public Suffix List from ``path`` (public_suffix_list.dat)"""
+    global _public_suffixes
+    _public_suffixes = PublicSuffixTrie.from_file(path)
+    _registered_domain.cache.clear()
+    _site_name.cache.clear()
+
+
+def _is_ip(host):
+    return host.replace('.', '').isdigit() or ':' in host
+
+
+def _netloc(url):
+    m = _netloc_match(url)
+    if m is None:
+        return urlparse.urlsplit(add_scheme_if_missing(url)).netloc
+    return m.group(1)
+
+
+@lru_cached(HOST_CACHE_SIZE)
+def _host(netloc):
+    """
+    Lowercased host from netloc, without credentials, port and
+    trailing dot.
+
+    >>> _host('user:pwd@Example.COM:8080')
+    'example.com'
+    >>> _host('[::1]:8080')
+    '::1'
+    >>> _host('example.com.')
+    'example.com'
+    """
+    host = netloc.rpartition('@')[2]
+    if host.startswith('['):
+        host = host[1:].partition(']')[0]
+    else:
+        host = host.partition(':')[0]
+    return host.rstrip('.').lower()
+
+
+@lru_cached(HOST_CACHE_SIZE)
+def _hostname(netloc):
+    return _www_prefix_sub('', _host(netloc))
+
+
+@lru_cached(HOST_CACHE_SIZE)
+def _registered_domain(host):
+    return _public_suffixes.registered_domain(host)
+
+
+@lru_cached(HOST_CACHE_SIZE)
+def _site_name(netloc):
+    """
+    Registered domain without its public suffix, or the hostname if
+    the registered domain is unknown: the host is a public suffix, or
+    the suffix is not in the default list (e.g. ``shop.com.vn``).
+    """
+    host = _host(netloc)
+    if _is_ip(host):
+        return host
+    domain = _registered_domain(host)
+    name = domain.split('.', 1)[0]
+    if domain == host and '.' in host:
+        labels = host.split('.')
+        if _public_suffixes.suffix_length(labels) == len(labels):
+            return host
+    if (_public_suffixes is _default_public_suffixes and
+            name in _GENERIC_SECOND_LEVEL and domain.count('.') == 1):
+        return _www_prefix_sub('', host)
+    return name
 
 
 def get_domain(url):
-    host = urlparse.urlparse(url).netloc
-    if ":" in host:
-        host.split(":", 1)[0]
-    return host
+    """
+    Return the host of ``url``, without port.
+
+    >>> get_domain("http://www.example.com:8080/foo")
+    'www.example.com'
+    >>> get_domain("http://3223423wfawefawf.onion")
+    '3223423wfawefawf.onion'
+    """
+    return _host(_netloc(url))
 
 
 def get_hostname(url):
@@ -34,14 +247,23 @@ def get_hostname(url):
     >>> get_hostname("127.0.0.1")
     '127.0.0.1'
     """
-    url = add_scheme_if_missing(url)
     try:
-        domain = urlparse.urlparse(url).hostname or ''
+        return _hostname(_netloc(url.strip()))
     except Exception:
-        domain = ''
-    else:
-        domain = re.sub(r'^www\d*\.', '', domain)
-    return domain
+        return ''
+
+
+def get_registered_domain(url):
+    """
+    Return the registered domain of ``url`` (public suffix plus one
+    label).
+
+    >>> get_registered_domain("http://static.example.co.uk/foo")
+    'example.co.uk'
+    >>> get_registered_domain("http://www.example.com")
+    'example.com'
+    """
+    return _registered_domain(_host(_netloc(url)))
 
 
 def add_scheme_if_missing(url):
@@ -59,6 +281,84 @@ def add_scheme_if_missing(url):
     return url if has_scheme(url) else "http://" + url
 
 
+def _query_param_matcher(names):
+    """
+    Return a function which tells if a query parameter is one of
+    ``names``; a trailing '*' matches any name with that prefix.
+    """
+    exact = set(name.lower() for name in names if not name.endswith('*'))
+    prefixes = tuple(name[:-1].lower() for name in names if name.endswith('*'))
+    return lambda name: (name.lower() in exact or
+                         bool(prefixes) and name.lower().startswith(prefixes))
+
+
+def canonicalize_url(url, strip_www=True, ignore_scheme=True,
+                     strip_params=()):
+    """
+    Return a canonical form of ``url`` for duplicate detection: scheme
+    and host are lowercased, default ports, credentials and fragments
+    removed, query arguments sorted and the ``strip_params`` query
+    arguments dropped (a trailing '*' strips every argument with that
+    prefix). With ``strip_www`` 'www' prefixes are stripped from the host
+    (see :func:`get_hostname`) and with ``ignore_scheme`` https URLs are
+    the same as http ones.
+
+    >>> canonicalize_url("HTTPS://user@WWW.Example.com:443/a b?b=2&a=1&a=&c#x")
+    'http://example.com/a%20b?a=&a=1&b=2&c='
+    >>> canonicalize_url("http://example.com:8080", ignore_scheme=False)
+    'http://example.com:8080/'
+    >>> canonicalize_url("http://example.com/?utm_source=x&id=3&sid=y",
+    ...                  strip_params=['utm_*', 'SID'])
+    'http://example.com/?id=3'
+    """
+    return _canonicalize_url(url, strip_www, ignore_scheme,
+                             _query_param_matcher(strip_params)
+                             if strip_params else None)
+
+
+def canonical_url_function(strip_www=True, ignore_scheme=True,
+                           strip_params=()):
+    """
+    Return ``canonicalize_url`` with its options bound; parameters to
+    strip are prepared only once.
+    """
+    is_stripped = (_query_param_matcher(strip_params) if strip_params
+                   else None)
+    return lambda url: _canonicalize_url(url, strip_www, ignore_scheme,
+                                         is_stripped)
+
+
+def _normalize_escape(match):
+    """ Decode escaped unreserved characters, uppercase other escapes """
+    char = chr(int(match.group(1), 16))
+    return char if char in _UNRESERVED_CHARS else match.group(0).upper()
+
+
+def _canonicalize_url(url, strip_www, ignore_scheme, is_stripped):
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    scheme, netloc, path, query, _ = urlparse.urlsplit(
+        add_scheme_if_missing(url))
+    scheme = scheme.lower()
+    host = _hostname(netloc) if strip_www else _host(netloc)
+    if ':' in host:
+        host = '[%s]' % host
+    port = netloc.rpartition('@')[2].rpartition(']')[2].partition(':')[2]
+    if port and DEFAULT_PORTS.get(scheme) != port:
+        host += ':' + port
+    if ignore_scheme and scheme == 'https':
+        scheme = 'http'
+    path = urllib.quote(_percent_escape_sub(_normalize_escape, path),
+                        _PATH_SAFE_CHARS) or '/'
+    if query:
+        args = urlparse.parse_qsl(query, keep_blank_values=True)
+        if is_stripped is not None:
+            args = [(k, v) for k, v in args if not is_stripped(k)]
+        args.sort()
+        query = urllib.urlencode(args).replace('+', '%20')
+    return urlparse.urlunsplit((scheme, host, path, query, ''))
+
+
 def get_robotstxt_url(url):
     """
     >>> get_robotstxt_url("https://example.com/foo/bar?baz=1")
@@ -88,10 +388,44 @@ def is_external_url(source_url, target_url):
 
     >>> is_external_url("http://example.com", "http://static.example.co.uk")
     False
+
+    Sites under public suffixes missing from the built-in list are
+    compared by hostname, unless the full list is loaded with
+    :func:`load_public_suffix_list`:
+
+    >>> is_external_url("http://shop-a.com.vn", "http://shop-b.com.vn")
+    True
+    >>> is_external_url("http://news.co.il", "http://bank.co.il")
+    True
+    >>> is_external_url("http://foo.com.pl", "http://www.foo.com.pl/x")
+    False
+    >>> is_external_url("http://co.uk", "http://example.co.uk")
+    True
+    """
+    return _site_name(_netloc(source_url)) != _site_name(_netloc(target_url))
+
+
+def external_url_checker(source_url):
+    """
+    Return a function which tells if a URL is external to ``source_url``
+    (see :func:`is_external_url`); the source URL is parsed only once.
+
+    >>> is_external = external_url_checker("http://example.com/foo")
+    >>> is_external("http://www.example.com/bar"), is_external("http://b.com")
+    (False, True)
     """
-    p1 = get_hostname(source_url)
-    p2 = get_hostname(target_url)
-    return p1 != p2
+    source = _site_name(_netloc(source_url))
+    return lambda url: _site_name(_netloc(url)) != source
+
 
-if __name__ == "__main__":
-    print get_domain("http://3223423wfawefawf.onion")
+def external_url_flags(source_url, urls):
+    """
+    Batch version of :func:`is_external_url`.
+
+    >>> external_url_flags("http://example.com", ["http://a.example.com",
+    ...                                           "http://example.org/x",
+    ...                                           "http://other.org/"])
+    [False, False, True]
+    """
+    is_external = external_url_checker(source_url)
+    return [is_external(url) for url in urls]